@@ -1,14 +1,33 @@
+import argparse
+import hashlib
+import io
+import json
+import logging
 import os
+import re
+import shutil
 import subprocess
 import datetime
+import tarfile
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import mysql.connector
 from dotenv import load_dotenv
-from mega import Mega
-import pyminizip
+
+from BackupRemote import ChunkedUploader, open_backend
+from BackupStore import open_store, site_sources
 # import zipfile
 # заархивировать файлы
 #  zip -r -9 billing_configs.zip /home/user/scripts/Backup/billing/
 
+# Каждый дамп и папка сайта пишутся одним проходом: mysqldump/tar | gzip | openssl enc > файл.
+# Промежуточных .sql на диске нет. Восстановление:
+#   openssl enc -d -aes-256-cbc -pbkdf2 -iter 200000 -pass env:ZIP_PASSWORD -in billing_backup_<дата>.sql.gz.enc | gunzip | mysql billing
+# Папка сайта архивируется инкрементально (см. «Инкрементальный бэкап сайта»), восстановление —
+#   python RestoreBackup.py site --to /tmp/site [--at 20240131_030000]
+
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
@@ -18,36 +37,204 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAMES = [os.getenv('DB_NAME'), os.getenv('DB_PAY_NAME')]  # Список баз данных
 SITE_FOLDER = os.getenv('SITE_FOLDER')
 BACKUP_DIR = '/home/user/scripts/Backup'
-ARCHIVE_NAME = os.path.join(BACKUP_DIR, f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+BACKUP_STAMP = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+DUMP_SUFFIX = '.sql.gz.enc'
+SITE_SUFFIX = '.tar.gz.enc'
+# Манифест последнего бэкапа сайта: путь -> [размер, mtime_ns, sha256]
+SITE_MANIFEST = os.path.join(BACKUP_DIR, 'site_manifest.json')
+# Полный архив сайта раз в SITE_FULL_EVERY_DAYS дней, между ними — только изменения
+SITE_FULL_EVERY_DAYS = int(os.getenv('SITE_FULL_EVERY_DAYS', 7))
+# 0 — каждый раз полный архив
+SITE_INCREMENTAL = os.getenv('SITE_INCREMENTAL', '1') != '0'
+# Хранилище с дедупликацией (см. BackupStore.py): local:<папка> или mega:<папка>.
+# Если задано, дампы и сайт сохраняются туда вместо отдельных архивов.
+BACKUP_STORE = os.getenv('BACKUP_STORE')
 ZIP_PASSWORD = os.getenv('ZIP_PASSWORD')
 LOG_FILE = os.path.join(BACKUP_DIR, 'backup.log')  # Файл для записи логов
+# Сколько дампов снимать одновременно
+DUMP_PARALLELISM = int(os.getenv('DUMP_PARALLELISM', 2))
+# pigz сжимает на всех ядрах, если установлен
+COMPRESS_COMMAND = [shutil.which('pigz') or 'gzip', '-c', '-6']
+# Пароль передаётся через переменную окружения только процессу openssl
+ENCRYPT_COMMAND = ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-iter', '200000', '-salt', '-pass', 'env:BACKUP_PASSPHRASE']
+DECRYPT_COMMAND = ['openssl', 'enc', '-d', '-aes-256-cbc', '-pbkdf2', '-iter', '200000', '-pass', 'env:BACKUP_PASSPHRASE']
 
 # Учетные данные для mega.nz
 MEGA_EMAIL = os.getenv('MEGA_EMAIL')
 MEGA_PASSWORD = os.getenv('MEGA_PASSWORD')
 MEGA_FOLDER = 'Happylink'
+# Куда выгружать архивы: mega:<папка> или local:<папка> (например, смонтированный диск)
+UPLOAD_TARGET = os.getenv('UPLOAD_TARGET', f'mega:{MEGA_FOLDER}')
+# Кэш handle папок на mega.nz, чтобы не скачивать список всех файлов аккаунта
+MEGA_CACHE = os.path.join(BACKUP_DIR, '.mega_folders.json')
+
+# Ротация «дед-отец-сын»: сколько последних дней, недель и месяцев хранить (по одному бэкапу на период)
+KEEP_DAILY = int(os.getenv('KEEP_DAILY', 7))
+KEEP_WEEKLY = int(os.getenv('KEEP_WEEKLY', 4))
+KEEP_MONTHLY = int(os.getenv('KEEP_MONTHLY', 6))
 
 # Функция для записи в лог с текущей датой и временем
 def write_log(message):
     with open(LOG_FILE, 'a') as log_file:
         log_file.write(f"--\n{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}\n")
 
-# Функция для удаления старого бэкапа для каждой базы данных
-def delete_old_backups(db_names):
-    try:
-        for db_name in db_names:
-            backup_files = os.listdir(BACKUP_DIR)
-            db_backup_files = [f for f in backup_files if f.startswith(db_name) and f.endswith('.sql')]
-            
-            if db_backup_files:
-                old_backup = max([os.path.join(BACKUP_DIR, f) for f in db_backup_files], key=os.path.getctime)
-                os.remove(old_backup)
-                write_log(f"Старый бэкап для {db_name} ({old_backup}) удален.")
-            else:
-                write_log(f"Старый бэкап для {db_name} не найден.")
-                
-    except Exception as e:
-        write_log(f"Ошибка при удалении старых бэкапов: {e}")
+
+# Повторы выгрузки из BackupRemote.py — тоже в backup.log
+class WriteLogHandler(logging.Handler):
+    def emit(self, record):
+        write_log(self.format(record))
+
+remote_log = logging.getLogger('BackupRemote')
+remote_log.addHandler(WriteLogHandler())
+remote_log.setLevel(logging.INFO)
+remote_log.propagate = False
+
+# =====================================
+#      Ротация бэкапов (GFS)
+# =====================================
+# Бэкап — <серия>_backup_<дата>[_full|_incr]<расширение>; серия — имя базы или site.
+# На удалённой стороне большой архив — это <имя>.partNNNN и <имя>.parts (см. BackupRemote.py).
+ARTIFACT_RE = re.compile(
+    r'^(?P<series>.+?)_backup_(?P<stamp>\d{8}_\d{6})(?:_(?P<kind>full|incr))?'
+    r'(?:\.sql\.gz\.enc|\.tar\.gz\.enc|\.sql)$'
+)
+LEGACY_ARCHIVE_RE = re.compile(r'^backup_(?P<stamp>\d{8}_\d{6})\.zip$')
+REMOTE_PART_RE = re.compile(r'\.part\d{4}$|\.parts$')
+
+Artifact = namedtuple('Artifact', 'name series stamp kind')
+
+def parse_artifact(name):
+    match = ARTIFACT_RE.match(name)
+    if match:
+        return Artifact(name, match['series'], match['stamp'], match['kind'] or 'full')
+    match = LEGACY_ARCHIVE_RE.match(name)
+    if match:
+        return Artifact(name, 'archive', match['stamp'], 'full')
+    return None
+
+def index_artifacts(object_names):
+    """Один проход по списку объектов: имя бэкапа -> (Artifact, [объекты, из которых он состоит])."""
+    index = {}
+    for object_name in object_names:
+        artifact = parse_artifact(REMOTE_PART_RE.sub('', object_name))
+        if artifact:
+            index.setdefault(artifact.name, (artifact, []))[1].append(object_name)
+    return index
+
+def gfs_keep(artifacts, daily=KEEP_DAILY, weekly=KEEP_WEEKLY, monthly=KEEP_MONTHLY):
+    """
+    Имена бэкапов, которые остаются: в каждой серии — самый новый бэкап каждого из последних
+    daily дней, weekly недель и monthly месяцев. Для оставленного инкрементального архива
+    остаются и все архивы его цепочки до полного.
+    """
+    rules = (
+        (daily, lambda moment: moment.date()),
+        (weekly, lambda moment: moment.isocalendar()[:2]),
+        (monthly, lambda moment: (moment.year, moment.month)),
+    )
+    series = {}
+    for artifact in artifacts:
+        series.setdefault(artifact.series, []).append(artifact)
+
+    keep = {}
+    for name, items in series.items():
+        items.sort(key=lambda artifact: artifact.stamp, reverse=True)
+        for count, period in rules:
+            seen = set()
+            for artifact in items:
+                if len(seen) >= count:
+                    break
+                bucket = period(datetime.datetime.strptime(artifact.stamp, '%Y%m%d_%H%M%S'))
+                if bucket not in seen:
+                    seen.add(bucket)
+                    keep.setdefault(artifact.name, artifact)
+
+        # Цепочки инкрементальных архивов: от каждого оставленного incr назад до full
+        chain_needed = False
+        for artifact in items:      # от новых к старым
+            if artifact.name in keep:
+                chain_needed = artifact.kind == 'incr'
+            elif chain_needed:
+                keep[artifact.name] = artifact
+                chain_needed = artifact.kind == 'incr'
+            if artifact.kind == 'full':
+                chain_needed = False
+    return set(keep)
+
+def retention_plan(index):
+    """(оставить, удалить) — списки Artifact по возрастанию даты."""
+    keep = gfs_keep([artifact for artifact, _ in index.values()])
+    artifacts = sorted((artifact for artifact, _ in index.values()), key=lambda artifact: (artifact.series, artifact.stamp))
+    return [a for a in artifacts if a.name in keep], [a for a in artifacts if a.name not in keep]
+
+def apply_retention(dry_run=False, upload_target=UPLOAD_TARGET, store_spec=BACKUP_STORE):
+    """
+    Применяет GFS к бэкапам в BACKUP_DIR, на upload_target и к снимкам хранилища store_spec.
+    Каждое место просматривается один раз. dry_run — только отчёт.
+    """
+    report = []
+
+    # Локальная папка: один scandir
+    with os.scandir(BACKUP_DIR) as entries:
+        local = {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+    index = index_artifacts(local)
+    kept, expired = retention_plan(index)
+    freed = 0
+    removed = 0
+    for artifact in expired:
+        if artifact.name + ChunkedUploader.JOURNAL_SUFFIX in local:
+            report.append(f"local: {artifact.name} оставлен — выгрузка не завершена")
+            continue
+        freed += local[artifact.name]
+        removed += 1
+        report.append(f"local: удалить {artifact.name}")
+        if not dry_run:
+            os.remove(os.path.join(BACKUP_DIR, artifact.name))
+    # Архивы с незавершённой выгрузкой остаются на диске и считаются оставленными
+    report.append(f"local: оставить {len(kept) + len(expired) - removed}, удалить {removed}, "
+                  f"освободится {freed / 1024 / 1024:.1f} МБ")
+
+    # Удалённая сторона: один list()
+    if upload_target:
+        try:
+            backend = open_backend(upload_target, MEGA_EMAIL, MEGA_PASSWORD, MEGA_CACHE)
+            index = index_artifacts(backend.list())
+            kept, expired = retention_plan(index)
+            for artifact in expired:
+                report.append(f"{backend}: удалить {artifact.name} (объектов {len(index[artifact.name][1])})")
+                if not dry_run:
+                    for object_name in index[artifact.name][1]:
+                        backend.delete(object_name)
+            report.append(f"{backend}: оставить {len(kept)}, удалить {len(expired)}")
+        except Exception as e:
+            report.append(f"{upload_target}: ошибка ротации: {e}")
+
+    # Хранилище с дедупликацией: снимки <дата>_<серия>, затем удаление ненужных кусков
+    if store_spec:
+        try:
+            store = open_store(store_spec, cache_path=MEGA_CACHE)
+            snapshots = {}
+            for snapshot in store.snapshots():
+                stamp, series = snapshot[:15], snapshot[16:]
+                snapshots[snapshot] = Artifact(snapshot, series, stamp, 'full')
+            keep = gfs_keep(snapshots.values())
+            expired = [snapshot for snapshot in snapshots if snapshot not in keep]
+            for snapshot in expired:
+                report.append(f"{store_spec}: удалить снимок {snapshot}")
+                if not dry_run:
+                    store.forget(snapshot)
+            # В режиме отчёта снимки не удалены, поэтому считаем только уже осиротевшие куски
+            unused = store.gc(dry_run=dry_run)
+            report.append(f"{store_spec}: оставить снимков {len(keep)}, удалить {len(expired)}, "
+                          f"ненужных кусков {unused}")
+        except Exception as e:
+            report.append(f"{store_spec}: ошибка ротации: {e}")
+
+    if dry_run:
+        print("\n".join(report))
+    else:
+        write_log("Ротация бэкапов:\n" + "\n".join(report))
+    return report
 
 # Функция для очистки таблицы system_events
 def truncate_table():
@@ -69,74 +256,331 @@ def truncate_table():
             cursor.close()
             connection.close()
 
-# Функция для создания дампов баз данных
-def create_backup(db_names):
-    backup_files = [SITE_FOLDER]
-    for db_name in db_names:
-        backup_file = os.path.join(BACKUP_DIR, f"{db_name}_backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.sql")
-        backup_files.append(backup_file)
-        
-        result = subprocess.run(f"mysqldump -u {DB_USER} -p{DB_PASSWORD} --routines --triggers {db_name} > {backup_file}", shell=True)
-        
-        if result.returncode == 0:
-            write_log(f"Дамп базы данных {db_name} успешно сохранен в {backup_file}")
+# Результат одного потока бэкапа: коды возврата команд, время в секундах, текст ошибок
+BackupResult = namedtuple('BackupResult', 'name path returncodes seconds error')
+
+def mysql_defaults_file():
+    """
+    Временный файл с [client] user/password для --defaults-extra-file:
+    пароль не попадает ни в командную строку, ни в shell. Удалять после использования.
+    """
+    def quote(value):
+        return '"' + (value or '').replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    fd, path = tempfile.mkstemp(prefix='mysqldump_', suffix='.cnf')   # создаётся с правами 0600
+    with os.fdopen(fd, 'w') as f:
+        f.write(f"[client]\nuser={quote(DB_USER)}\npassword={quote(DB_PASSWORD)}\n")
+    return path
+
+def require_passphrase():
+    """Без ZIP_PASSWORD openssl зашифровал бы пустым паролем: архив выглядел бы защищённым, но не был бы."""
+    if not ZIP_PASSWORD:
+        write_log("Не задан ZIP_PASSWORD, бэкап не создаётся")
+        raise SystemExit("Не задан ZIP_PASSWORD")
+
+def run_pipeline(name, commands, output_path, feed=None):
+    """
+    Соединяет команды трубами и пишет вывод последней в output_path через .part-файл.
+    Память не растёт с размером данных: их держат только буферы труб.
+    feed(stdin), если задан, сам пишет данные на вход первой команды.
+    Файл появляется под своим именем, только если все команды и feed завершились успешно.
+    """
+    part_path = output_path + '.part'
+    started = time.monotonic()
+    processes = []
+    try:
+        with open(part_path, 'wb') as out:
+            stdin = subprocess.PIPE if feed else None
+            for i, command in enumerate(commands):
+                env = dict(os.environ, BACKUP_PASSPHRASE=ZIP_PASSWORD) if command in (ENCRYPT_COMMAND, DECRYPT_COMMAND) else None
+                stderr = tempfile.TemporaryFile()
+                process = subprocess.Popen(
+                    command, stdin=stdin, stderr=stderr, env=env,
+                    stdout=out if i == len(commands) - 1 else subprocess.PIPE,
+                )
+                if stdin not in (None, subprocess.PIPE):
+                    stdin.close()       # трубу держит только следующий процесс, иначе он не увидит EOF
+                stdin = process.stdout
+                processes.append((command, process, stderr))
+            if feed:
+                with processes[0][1].stdin as pipe:
+                    feed(pipe)
+            for _, process, _ in processes:
+                process.wait()
+    except (OSError, ValueError, tarfile.TarError) as e:
+        for _, process, _ in processes:
+            process.kill()
+            process.wait()
+        os.remove(part_path)
+        return BackupResult(name, output_path, [-1], time.monotonic() - started, str(e))
+
+    returncodes = [process.returncode for _, process, _ in processes]
+    errors = []
+    for command, process, stderr in processes:
+        stderr.seek(0)
+        text = stderr.read().decode(errors='replace').strip()
+        stderr.close()
+        if process.returncode != 0:
+            errors.append(f"{command[0]}: код {process.returncode}" + (f", {text}" if text else ""))
+
+    if errors:
+        os.remove(part_path)        # неполный бэкап хуже, чем никакого
+    else:
+        os.replace(part_path, output_path)
+    return BackupResult(name, output_path, returncodes, time.monotonic() - started, '; '.join(errors))
+
+def mysqldump_command(db_name, defaults_file):
+    return [
+        'mysqldump', f'--defaults-extra-file={defaults_file}',
+        '--single-transaction', '--quick', '--routines', '--triggers', db_name,
+    ]
+
+def dump_database(db_name, defaults_file):
+    """mysqldump | gzip | openssl enc > <база>_backup_<дата>.sql.gz.enc"""
+    dump_command = mysqldump_command(db_name, defaults_file)
+    output_path = os.path.join(BACKUP_DIR, f"{db_name}_backup_{BACKUP_STAMP}{DUMP_SUFFIX}")
+    return run_pipeline(db_name, [dump_command, COMPRESS_COMMAND, ENCRYPT_COMMAND], output_path)
+
+# =====================================
+#   Инкрементальный бэкап сайта
+# =====================================
+# site_backup_<дата>_full.tar.gz.enc — все файлы, site_backup_<дата>_incr.tar.gz.enc — новые и
+# изменённые с прошлого бэкапа. Первым элементом в каждом архиве лежит SITE_MANIFEST_MEMBER:
+# полный список файлов на момент бэкапа, по нему при восстановлении удаляются удалённые файлы.
+# full и previous в манифесте — даты полного и предыдущего архива цепочки: по ним RestoreBackup.py
+# замечает пропущенный или чужой инкрементальный архив.
+SITE_MANIFEST_MEMBER = '.backup_manifest.json'
+SITE_KINDS = ('full', 'incr')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def scan_site(folder, previous_files):
+    """
+    Обходит папку одним проходом stat; хэш считается только для файлов,
+    у которых размер или mtime отличаются от previous_files.
+    """
+    files = {}
+    hashed = 0
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                path = os.path.relpath(entry.path, folder)
+                known = previous_files.get(path)
+                if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                    files[path] = known
+                else:
+                    files[path] = [stat.st_size, stat.st_mtime_ns, file_sha256(entry.path)]
+                    hashed += 1
+    return files, hashed
+
+def load_site_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_site_manifest(manifest, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+def site_backup_kind(previous, stamp):
+    """'full', если полного архива ещё нет или он старше SITE_FULL_EVERY_DAYS, иначе 'incr'."""
+    if not SITE_INCREMENTAL or previous is None:
+        return 'full'
+    age = datetime.datetime.strptime(stamp, '%Y%m%d_%H%M%S') - datetime.datetime.strptime(previous['full'], '%Y%m%d_%H%M%S')
+    if age >= datetime.timedelta(days=SITE_FULL_EVERY_DAYS):
+        return 'full'
+    return 'incr'
+
+def archive_site(folder=SITE_FOLDER):
+    """Полный или инкрементальный архив сайта: tar (Python) | gzip | openssl enc."""
+    folder = os.path.abspath(folder)
+    previous = load_site_manifest(SITE_MANIFEST)
+    kind = site_backup_kind(previous, BACKUP_STAMP)
+    previous_files = previous['files'] if previous else {}
+    files, hashed = scan_site(folder, previous_files)
+
+    if kind == 'full':
+        changed = sorted(files)
+    else:
+        changed = sorted(path for path, info in files.items()
+                         if path not in previous_files or previous_files[path][2] != info[2])
+    deleted = len(previous_files.keys() - files.keys()) if kind == 'incr' else 0
+    manifest = {
+        'created': BACKUP_STAMP,
+        'kind': kind,
+        'full': BACKUP_STAMP if kind == 'full' else previous['full'],
+        'previous': previous['created'] if kind == 'incr' else None,
+        'files': files,
+    }
+
+    def feed(pipe):
+        with tarfile.open(fileobj=pipe, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            data = json.dumps(manifest).encode()
+            info = tarfile.TarInfo(SITE_MANIFEST_MEMBER)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+            for path in changed:
+                try:
+                    tar.add(os.path.join(folder, path), arcname=path, recursive=False)
+                except FileNotFoundError:
+                    pass        # удалён после сканирования — в следующем бэкапе попадёт в удалённые
+
+    output_path = os.path.join(BACKUP_DIR, f"site_backup_{BACKUP_STAMP}_{kind}{SITE_SUFFIX}")
+    result = run_pipeline('site', [COMPRESS_COMMAND, ENCRYPT_COMMAND], output_path, feed=feed)
+    if not result.error:
+        save_site_manifest(manifest, SITE_MANIFEST)
+        write_log(f"Сайт ({kind}): файлов {len(files)}, в архиве {len(changed)}, "
+                  f"удалено {deleted}, пересчитано хэшей {hashed}")
+    return result
+
+# Функция для создания бэкапов баз данных и папки сайта (до DUMP_PARALLELISM одновременно)
+def create_backup(db_names, parallelism=DUMP_PARALLELISM):
+    require_passphrase()
+    defaults_file = mysql_defaults_file()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+            jobs = [pool.submit(dump_database, db_name, defaults_file) for db_name in db_names]
+            if SITE_FOLDER:
+                jobs.append(pool.submit(archive_site))
+            results = [job.result() for job in jobs]
+    finally:
+        os.remove(defaults_file)
+
+    backup_files = []
+    for result in results:
+        if not result.error:
+            backup_files.append(result.path)
+            size = os.path.getsize(result.path) / 1024 / 1024
+            write_log(f"Бэкап {result.name} сохранен в {result.path} ({size:.1f} МБ) за {result.seconds:.1f} с")
         else:
-            write_log(f"Ошибка при создании дампа базы данных {db_name}")
+            write_log(f"Ошибка при создании бэкапа {result.name} ({result.seconds:.1f} с): {result.error}")
+    failed = [result.name for result in results if result.error]
+    write_log(f"Бэкапы: успешно {len(results) - len(failed)} из {len(results)}"
+              + (f", ошибки: {', '.join(failed)}" if failed else ""))
     
-    #print(backup_files)
     return backup_files
 
-# Функция для архивирования файлов
-def archive_backup_files(backup_files, password=ZIP_PASSWORD):
+# =====================================
+#   Хранилище с дедупликацией
+# =====================================
+class CommandOutput:
+    """stdout команды как поток; в конце потока — исключение, если команда завершилась с ошибкой."""
+
+    def __init__(self, command):
+        self.command = command
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and self.process.wait() != 0:
+            self.stderr.seek(0)
+            raise RuntimeError(f"{self.command[0]}: код {self.process.returncode}, "
+                               f"{self.stderr.read().decode(errors='replace').strip()}")
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
+
+def backup_to_store(db_names, store_spec=BACKUP_STORE):
+    """
+    Дампы баз и папка сайта — снимками в хранилище с дедупликацией; выгружаются только новые куски.
+    Снимки пишутся по очереди: нарезка и шифрование занимают процессор, а не ждут диск.
+    """
     try:
-        for backup_file in backup_files:
-            # Создаём архив сразу для всех файлов
-            pyminizip.compress_multiple(backup_files, [], ARCHIVE_NAME, password, 5)
-        
-        write_log(f"Файлы успешно заархивированы в {ARCHIVE_NAME} с паролем")
+        store = open_store(store_spec, cache_path=MEGA_CACHE)
     except Exception as e:
-        write_log(f"Ошибка при архивировании файлов: {e}")
+        write_log(f"Ошибка при открытии хранилища {store_spec}: {e}")
+        return []
 
-# Функция для загрузки архива на mega.nz и добавления ссылки в лог
-def upload_to_mega(archive_name):
+    jobs = [(db_name, None) for db_name in db_names]
+    if SITE_FOLDER:
+        jobs.append(('site', SITE_FOLDER))
+
+    snapshots = []
+    defaults_file = mysql_defaults_file()
     try:
-        # Initialize Mega instance and log in
-        mega = Mega()
-        m = mega.login(MEGA_EMAIL, MEGA_PASSWORD)
-        
-        # Find or create the 'Happylink' folder
-        folder_name = MEGA_FOLDER
-        folder = None
-        folders = m.get_files()
-        
-        # Check if the folder exists
-        for file_id, details in folders.items():
-            if details['a'].get('n') == folder_name and details['t'] == 1:
-                folder = details
-                break
-        
-        # If the folder doesn't exist, create it
-        if folder is None:
-            folder = m.create_folder(folder_name)
-            folder_id = folder[0]['f'][0]['h']
-        else:
-            folder_id = folder['h']
-        
-        # Upload the file to the 'Happylink' folder
-        file = m.upload(archive_name, folder_id)
-        public_link = m.get_upload_link(file)
-        
-        # Log the success message with the public link
-        write_log(f"Архив {archive_name} успешно загружен в папку {folder_name} на mega.nz. \n Ссылка: {public_link}")
-    
-    except Exception as e:
-        # Log the error if something goes wrong
-        write_log(f"Ошибка при загрузке архива на mega.nz: {e}")
+        for name, folder in jobs:
+            before = dict(store.stats)
+            started = time.monotonic()
+            output = None
+            try:
+                if folder:
+                    snapshot = store.backup(name, BACKUP_STAMP, site_sources(folder), store.latest_snapshot(name))
+                else:
+                    output = CommandOutput(mysqldump_command(name, defaults_file))
+                    snapshot = store.backup(name, BACKUP_STAMP, [(f"{name}.sql", output)])
+            except Exception as e:
+                write_log(f"Ошибка при сохранении {name} в хранилище ({time.monotonic() - started:.1f} с): {e}")
+                continue
+            finally:
+                if output:
+                    output.close()
+            snapshots.append(snapshot)
+            delta = {key: store.stats[key] - before[key] for key in store.stats}
+            write_log(f"Снимок {snapshot} за {time.monotonic() - started:.1f} с: "
+                      f"{delta['bytes'] / 1024 / 1024:.1f} МБ, новых кусков {delta['new_chunks']} из {delta['chunks']}, "
+                      f"выгружено {delta['uploaded_bytes'] / 1024 / 1024:.1f} МБ")
+    finally:
+        os.remove(defaults_file)
+    return snapshots
+
+# Функция для выгрузки архивов (по умолчанию на mega.nz) частями, с продолжением прерванной выгрузки
+def upload_archives(archive_names, target=UPLOAD_TARGET):
+    backend = open_backend(target, MEGA_EMAIL, MEGA_PASSWORD, MEGA_CACHE)
+    uploader = ChunkedUploader(backend)
+
+    # Сначала — архивы, выгрузка которых прервалась в прошлый раз
+    unfinished = [
+        os.path.join(BACKUP_DIR, name[:-len(ChunkedUploader.JOURNAL_SUFFIX)])
+        for name in sorted(os.listdir(BACKUP_DIR)) if name.endswith(ChunkedUploader.JOURNAL_SUFFIX)
+    ]
+    archive_names = [path for path in unfinished if os.path.exists(path) and path not in archive_names] + list(archive_names)
+
+    for archive_name in archive_names:
+        started = time.monotonic()
+        try:
+            parts = uploader.upload(archive_name)
+            write_log(f"Архив {archive_name} выгружен в {backend} (частей {parts}) за {time.monotonic() - started:.1f} с")
+        except Exception as e:
+            write_log(f"Ошибка при выгрузке архива {archive_name} в {backend}: {e}")
 
 # Основная логика выполнения
 if __name__ == "__main__":
-    delete_old_backups(DB_NAMES)  # Удаление старых бэкапов для всех баз данных
-    truncate_table()  # Очистка таблицы system_events (в первой базе данных)
-    backup_files = create_backup(DB_NAMES)  # Создание новых бэкапов для всех баз данных
-    archive_backup_files(backup_files)  # Архивирование бэкапов
-    upload_to_mega(ARCHIVE_NAME)  # Загрузка архива на mega.nz
+    parser = argparse.ArgumentParser(description="Ночной бэкап баз данных и сайта")
+    parser.add_argument('--retention-dry-run', action='store_true', help="только показать, что удалит ротация")
+    parser.add_argument('--retention-only', action='store_true', help="только ротация, без нового бэкапа")
+    args = parser.parse_args()
+
+    if args.retention_dry_run:
+        apply_retention(dry_run=True)
+        raise SystemExit(0)
+    if not args.retention_only:
+        require_passphrase()  # До очистки таблицы и дампов
+        truncate_table()  # Очистка таблицы system_events (в первой базе данных)
+        if BACKUP_STORE:
+            backup_to_store(DB_NAMES)  # Снимки в хранилище с дедупликацией
+        else:
+            backup_files = create_backup(DB_NAMES)  # Дампы баз и папка сайта, сразу сжатые и зашифрованные
+            upload_archives(backup_files)  # Выгрузка архивов на mega.nz
+    apply_retention()  # Удаление старых бэкапов локально, на mega.nz и в хранилище (GFS)
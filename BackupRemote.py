@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Хранилища объектов для бэкапов: имя объекта -> байты.
+# LocalBackend — папка на диске (в том числе для проверок без сети), MegaBackend — папка на mega.nz.
+#
+#   open_backend('local:/mnt/backup')
+#   open_backend('mega:HappylinkStore', email=..., password=...)
+#
+# Большие архивы выгружаются частями (ChunkedUploader): части идут параллельно, каждая
+# с повторами, а журнал рядом с архивом позволяет продолжить прерванную выгрузку.
+#
+#   python BackupRemote.py upload local:/mnt/offsite billing_backup_<дата>.sql.gz.enc
+#   python BackupRemote.py fetch mega:Happylink billing_backup_<дата>.sql.gz.enc /tmp/billing.sql.gz.enc
+
+load_dotenv()
+
+# Размер части, параллельность и повторы выгрузки
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', 64 * 1024 * 1024))
+UPLOAD_ATTEMPTS = int(os.getenv('UPLOAD_ATTEMPTS', 5))
+UPLOAD_BACKOFF = float(os.getenv('UPLOAD_BACKOFF', 2))
+MEGA_WORKERS = int(os.getenv('MEGA_WORKERS', 4))
+
+# Повторы и ход выгрузки; Backup.py пишет эти сообщения в свой backup.log
+log = logging.getLogger('BackupRemote')
+
+
+class LocalBackend:
+    """Объекты — файлы в папке root; '/' в имени объекта — подпапки."""
+
+    # Сколько объектов можно записывать одновременно
+    max_workers = 4
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def __repr__(self):
+        return f"local:{self.root}"
+
+    def _path(self, name):
+        path = os.path.normpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Недопустимое имя объекта: {name}")
+        return path
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def put(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Через временный файл: прерванная запись не оставляет обрезанный объект
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.put_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, name):
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.root):
+            for file_name in files:
+                if file_name.startswith('.put_'):
+                    continue
+                name = os.path.relpath(os.path.join(root, file_name), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+
+class MegaBackend:
+    """
+    Объекты — файлы в одной папке mega.nz. В Mega нет путей, поэтому '/' в имени
+    заменяется на '~'.
+
+    Handle папки кэшируется в cache_path: для выгрузки не нужен get_files(), который
+    скачивает список всех файлов аккаунта. Список файлов папки загружается, только когда
+    он действительно нужен (list, get, delete, exists), и дальше ведётся локально.
+    Пока он не загружен, put заменяет только файлы, записанные в этом запуске: имена частей
+    уникальны, а файлы, которые перезаписываются (config хранилища), сначала проверяются exists.
+    Каждый поток работает со своей сессией mega.py.
+    """
+
+    SEPARATOR = '~'
+
+    def __init__(self, folder, email, password, cache_path=None, workers=4):
+        self.folder = folder
+        self.email = email
+        self.password = password
+        self.cache_path = cache_path
+        self.max_workers = workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._folder_id = self._load_cached_folder()
+        self._nodes = None      # имя объекта -> (handle, node)
+        self._written = {}      # то же для файлов, записанных до загрузки списка
+
+    def __repr__(self):
+        return f"mega:{self.folder}"
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _load_cached_folder(self):
+        # Кэш — {"<email>/<папка>": handle}: одним файлом пользуются все папки и аккаунты
+        return self._read_cache().get(f"{self.email}/{self.folder}") if self.cache_path else None
+
+    def _save_cached_folder(self):
+        if not self.cache_path:
+            return
+        cache = self._read_cache()
+        cache[f"{self.email}/{self.folder}"] = self._folder_id
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    def _session(self):
+        m = getattr(self._local, 'm', None)
+        if m is None:
+            from mega import Mega
+            m = self._local.m = Mega().login(self.email, self.password)
+        return m
+
+    def _load_nodes(self):
+        """Полный список файлов аккаунта: находит (или создаёт) папку и её содержимое."""
+        files = self._session().get_files()
+        with self._lock:
+            for handle, node in files.items():
+                if node['t'] == 1 and node['a'].get('n') == self.folder:
+                    self._folder_id = handle
+                    break
+            else:
+                self._folder_id = self._session().create_folder(self.folder)[0]['f'][0]['h']
+            self._save_cached_folder()
+            self._nodes = {
+                node['a']['n'].replace(self.SEPARATOR, '/'): (handle, node)
+                for handle, node in files.items()
+                if node['t'] == 0 and node.get('p') == self._folder_id and isinstance(node.get('a'), dict)
+            }
+
+    def _nodes_loaded(self):
+        if self._nodes is None:
+            self._load_nodes()
+        return self._nodes
+
+    def exists(self, name):
+        return name in self._nodes_loaded()
+
+    def put(self, name, data):
+        if self._folder_id is None:
+            self._load_nodes()
+        fd, tmp_path = tempfile.mkstemp(prefix='mega_put_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            remote_name = name.replace('/', self.SEPARATOR)
+            try:
+                response = self._session().upload(tmp_path, self._folder_id, dest_filename=remote_name)
+            except Exception:
+                # Папку могли удалить или переименовать — обновляем handle и пробуем ещё раз
+                self._load_nodes()
+                response = self._session().upload(tmp_path, self._folder_id, dest_filename=remote_name)
+        finally:
+            os.remove(tmp_path)
+        node = response['f'][0]
+        with self._lock:
+            nodes = self._nodes if self._nodes is not None else self._written
+            old = nodes.get(name)
+            nodes[name] = (node['h'], node)
+        # Старый файл удаляется только после успешной выгрузки нового
+        if old and old[0] != node['h']:
+            self._session().destroy(old[0])
+
+    def get(self, name):
+        handle, node = self._nodes_loaded()[name]
+        with tempfile.TemporaryDirectory(prefix='mega_get_') as tmp_dir:
+            self._session().download((handle, node), dest_path=tmp_dir, dest_filename='object')
+            with open(os.path.join(tmp_dir, 'object'), 'rb') as f:
+                return f.read()
+
+    def delete(self, name):
+        nodes = self._nodes_loaded()
+        with self._lock:
+            old = nodes.pop(name, None)
+        if old:
+            self._session().destroy(old[0])
+
+    def list(self, prefix=''):
+        return sorted(name for name in self._nodes_loaded() if name.startswith(prefix))
+
+
+def open_backend(spec, email=None, password=None, cache_path=None):
+    """'local:<папка>' или 'mega:<папка на mega.nz>'; cache_path — кэш handle папки Mega."""
+    kind, _, location = spec.partition(':')
+    if kind == 'local' and location:
+        return LocalBackend(location)
+    if kind == 'mega' and location:
+        return MegaBackend(location, email, password, cache_path, workers=MEGA_WORKERS)
+    raise ValueError(f"Неизвестное хранилище: {spec!r} (ожидается local:<папка> или mega:<папка>)")
+
+
+def with_retry(action, description, attempts=UPLOAD_ATTEMPTS, backoff=UPLOAD_BACKOFF):
+    """Повторяет action() с растущей паузой; после последней попытки пробрасывает ошибку."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1)
+            log.warning(f"{description}: {e}; попытка {attempt}/{attempts}, повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+
+class ChunkedUploader:
+    """
+    Выгрузка файла частями <имя>.partNNNN и описанием <имя>.parts, которое пишется последним:
+    пока его нет, файл на удалённой стороне считается неполным. Файлы не больше одной части
+    выгружаются одним объектом <имя>.
+
+    Журнал <файл>.upload.json хранит выгруженные части; если выгрузка прервалась, следующий
+    запуск для того же файла (тот же размер и mtime) в то же хранилище выгружает только
+    недостающие части. Журнал для другого хранилища отбрасывается.
+    """
+
+    JOURNAL_SUFFIX = '.upload.json'
+
+    def __init__(self, backend, part_size=UPLOAD_PART_SIZE, workers=None, attempts=UPLOAD_ATTEMPTS):
+        self.backend = backend
+        self.part_size = part_size
+        self.workers = workers or backend.max_workers
+        self.attempts = attempts
+
+    def _journal(self, path, remote_name, stat):
+        journal_path = path + self.JOURNAL_SUFFIX
+        try:
+            with open(journal_path) as f:
+                journal = json.load(f)
+            if (journal['target'], journal['remote_name'], journal['size'], journal['mtime_ns'],
+                    journal['part_size']) == \
+                    (repr(self.backend), remote_name, stat.st_size, stat.st_mtime_ns, self.part_size):
+                return journal_path, journal
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return journal_path, {'target': repr(self.backend), 'remote_name': remote_name, 'size': stat.st_size,
+                              'mtime_ns': stat.st_mtime_ns, 'part_size': self.part_size, 'parts': {}}
+
+    def upload(self, path, remote_name=None):
+        """Выгружает файл; возвращает число частей, выгруженных в этот раз."""
+        remote_name = remote_name or os.path.basename(path)
+        stat = os.stat(path)
+        if stat.st_size <= self.part_size:
+            with open(path, 'rb') as f:
+                data = f.read()
+            with_retry(lambda: self.backend.put(remote_name, data), f"Выгрузка {remote_name}", self.attempts)
+            return 1
+
+        journal_path, journal = self._journal(path, remote_name, stat)
+        count = (stat.st_size + self.part_size - 1) // self.part_size
+        lock = threading.Lock()
+
+        def save_journal():
+            with open(journal_path + '.tmp', 'w') as f:
+                json.dump(journal, f)
+            os.replace(journal_path + '.tmp', journal_path)
+
+        def upload_part(index):
+            with open(path, 'rb') as f:
+                f.seek(index * self.part_size)
+                data = f.read(self.part_size)
+            part_name = f"{remote_name}.part{index:04d}"
+            with_retry(lambda: self.backend.put(part_name, data), f"Выгрузка {part_name}", self.attempts)
+            with lock:
+                journal['parts'][str(index)] = hashlib.sha256(data).hexdigest()
+                save_journal()
+
+        missing = [index for index in range(count) if str(index) not in journal['parts']]
+        save_journal()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(upload_part, index) for index in missing]:
+                future.result()
+
+        description = {
+            'size': stat.st_size,
+            'part_size': self.part_size,
+            'parts': [journal['parts'][str(index)] for index in range(count)],
+        }
+        with_retry(lambda: self.backend.put(f"{remote_name}.parts", json.dumps(description).encode()),
+                   f"Выгрузка {remote_name}.parts", self.attempts)
+        os.remove(journal_path)
+        return len(missing)
+
+
+def fetch(backend, remote_name, path):
+    """Скачивает файл, выгруженный ChunkedUploader, и проверяет sha256 частей."""
+    parts_name = f"{remote_name}.parts"
+    with open(path + '.part', 'wb') as out:
+        if backend.exists(parts_name):
+            description = json.loads(backend.get(parts_name))
+            for index, sha256 in enumerate(description['parts']):
+                data = backend.get(f"{remote_name}.part{index:04d}")
+                if hashlib.sha256(data).hexdigest() != sha256:
+                    raise ValueError(f"Часть {index} файла {remote_name} повреждена")
+                out.write(data)
+        else:
+            out.write(backend.get(remote_name))
+    os.replace(path + '.part', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка архивов бэкапа")
+    sub = parser.add_subparsers(dest='command', required=True)
+    upload_parser = sub.add_parser('upload', help="выгрузить файлы (с продолжением прерванной выгрузки)")
+    upload_parser.add_argument('target', help="local:<папка> или mega:<папка>")
+    upload_parser.add_argument('files', nargs='+')
+    fetch_parser = sub.add_parser('fetch', help="скачать и собрать файл")
+    fetch_parser.add_argument('target')
+    fetch_parser.add_argument('name')
+    fetch_parser.add_argument('path')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+    backend = open_backend(args.target, os.getenv('MEGA_EMAIL'), os.getenv('MEGA_PASSWORD'))
+    if args.command == 'upload':
+        uploader = ChunkedUploader(backend)
+        for path in args.files:
+            started = time.monotonic()
+            parts = uploader.upload(path)
+            log.info(f"{path}: выгружено частей {parts} за {time.monotonic() - started:.1f} с")
+    else:
+        fetch(backend, args.name, args.path)
+
+
+if __name__ == "__main__":
+    main()
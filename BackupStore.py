@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from BackupRemote import open_backend
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+# Хранилище бэкапов с дедупликацией: дампы и файлы сайта режутся на куски по содержимому,
+# каждый кусок хранится один раз под своим хэшем, сжат zlib и зашифрован AES-GCM.
+# Снимок — зашифрованный список файлов и их кусков. За ночь выгружаются только новые куски.
+#
+#   python BackupStore.py --store local:/mnt/backup-store snapshots
+#   python BackupStore.py --store local:/mnt/backup-store restore 20240131_030000_site --to /tmp/site
+#   python BackupStore.py --store mega:HappylinkStore cat 20240131_030000_billing billing.sql | mysql billing
+#
+# Пароль — ZIP_PASSWORD (из окружения или .env). Нужен пакет cryptography.
+#
+# Объекты в хранилище:
+#   config                 — соль и параметры нарезки (открытым текстом)
+#   chunks/<id[:2]>/<id>   — куски; id = HMAC-SHA256 содержимого, по нему не угадать данные
+#   snapshots/<дата>_<имя> — снимки
+
+load_dotenv()
+
+# Нарезка по содержимому: каждый байт через таблицу превращается в 0 или 1 (bytes.translate),
+# и граница куска ставится после первого за CHUNK_MIN места, где последние CHUNK_BITS байт дают
+# заданный шаблон (bytes.find). Это скользящий хэш окна из CHUNK_BITS байт, посчитанный на скорости
+# C для каждой позиции, поэтому он одинаково работает для дампов, картинок и архивов: после вставки
+# или удаления данных границы дальше по файлу не сдвигаются. Таблица и шаблон выводятся из ключа
+# хранилища, так что по размерам кусков нельзя судить о содержимом.
+CHUNK_MIN = 64 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+# Граница встречается в среднем раз в 2^CHUNK_BITS байт после CHUNK_MIN, то есть средний кусок —
+# CHUNK_MIN + 2^CHUNK_BITS = 64 + 256 = 320 КБ (на случайных данных так и выходит; на SQL-дампах
+# шаблон совпадает реже, и куски примерно вдвое больше)
+CHUNK_BITS = 18
+READ_SIZE = 8 * 1024 * 1024
+
+NONCE_SIZE = 12
+
+
+# Байты делятся на 1 и 0 поровну внутри каждой группы, иначе в тексте и дампах (цифры, hex,
+# латиница) единиц или нулей было бы заметно больше, шаблон совпадал бы реже и куски росли
+BYTE_GROUPS = (
+    b'0123456789', b'abcdef', b'ghijklmnopqrstuvwxyz', b'ABCDEF', b'GHIJKLMNOPQRSTUVWXYZ',
+    bytes(range(32, 48)) + bytes(range(58, 65)) + bytes(range(91, 97)) + bytes(range(123, 127)),
+    bytes(range(32)) + b'\x7f', bytes(range(128, 256)),
+)
+
+
+def chunk_boundary(seed, bits=CHUNK_BITS):
+    """(таблица байт -> 0/1, шаблон из bits значений), выбранные по seed."""
+    table = bytearray(256)
+    for group in BYTE_GROUPS:
+        order = sorted(group, key=lambda value: hashlib.sha256(seed + bytes([value])).digest())
+        for value in order[:len(order) // 2]:
+            table[value] = 1
+    digest = hashlib.sha256(seed + b'pattern').digest()
+    pattern = bytes(digest[i // 8] >> (i % 8) & 1 for i in range(bits))
+    # Шаблон из одних 0 или 1 совпал бы на любой длинной серии одинаковых байт
+    if len(set(pattern)) == 1:
+        pattern = pattern[:-1] + bytes([1 - pattern[-1]])
+    return bytes(table), pattern
+
+
+def find_cut(bits, start, end, min_size, pattern):
+    """Позиция конца куска, начинающегося со start; end — если граница не нашлась."""
+    index = bits.find(pattern, start + max(0, min_size - len(pattern)), end)
+    return end if index < 0 else index + len(pattern)
+
+
+def iter_chunks(stream, boundary, min_size=CHUNK_MIN, max_size=CHUNK_MAX):
+    """
+    Режет поток на куски по содержимому, держа в памяти не больше READ_SIZE + max_size
+    (и столько же под биты). boundary — результат chunk_boundary().
+    """
+    table, pattern = boundary
+    buffer = b''
+    eof = False
+    while True:
+        while not eof and len(buffer) < READ_SIZE + max_size:
+            block = stream.read(READ_SIZE)
+            if not block:
+                eof = True
+            buffer += block
+        if not buffer:
+            return
+
+        bits = buffer.translate(table)
+        view = memoryview(buffer)
+        pos = 0
+        # Без EOF режем, только пока впереди есть целый max_size: иначе граница зависела бы от буфера
+        while pos < len(buffer) and (eof or len(buffer) - pos >= max_size):
+            cut = find_cut(bits, pos, min(len(buffer), pos + max_size), min_size, pattern)
+            yield bytes(view[pos:cut])
+            pos = cut
+        view.release()
+        buffer = buffer[pos:]
+
+
+class ChunkStore:
+    """Куски и снимки поверх backend (см. BackupRemote.py)."""
+
+    CONFIG = 'config'
+
+    def __init__(self, backend, password, workers=None):
+        if AESGCM is None:
+            raise RuntimeError("Для хранилища бэкапов нужен пакет cryptography")
+        if not password:
+            raise RuntimeError("Не задан пароль хранилища (ZIP_PASSWORD)")
+        self.backend = backend
+        self.workers = workers or backend.max_workers
+
+        if backend.exists(self.CONFIG):
+            self.config = json.loads(backend.get(self.CONFIG))
+        else:
+            self.config = {
+                'version': 2,
+                'salt': os.urandom(16).hex(),
+                'chunk_min': CHUNK_MIN,
+                'chunk_max': CHUNK_MAX,
+                'chunk_bits': CHUNK_BITS,
+            }
+            backend.put(self.CONFIG, json.dumps(self.config).encode())
+
+        # Один пароль -> ключ шифрования и ключ для id кусков
+        keys = hashlib.scrypt(password.encode(), salt=bytes.fromhex(self.config['salt']),
+                              n=2 ** 15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=64)
+        self._aead = AESGCM(keys[:32])
+        self._id_key = keys[32:]
+        # В хранилищах версии 1 была нарезка по якорям: куски режутся заново, старые уберёт gc()
+        self._boundary = chunk_boundary(hmac.new(self._id_key, b'chunk-boundary', hashlib.sha256).digest(),
+                                        self.config.get('chunk_bits', CHUNK_BITS))
+
+        self._known = None          # id кусков, которые уже есть в хранилище
+        self._futures = []
+        self._lock = threading.Lock()
+        self.stats = {'chunks': 0, 'new_chunks': 0, 'bytes': 0, 'new_bytes': 0, 'uploaded_bytes': 0}
+
+    # ---- куски ----
+    def chunk_id(self, data):
+        return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def chunk_name(chunk_id):
+        return f"chunks/{chunk_id[:2]}/{chunk_id}"
+
+    def _seal(self, data, name):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, name.encode())
+
+    def _open(self, blob, name):
+        # Имя объекта — associated data: кусок, подложенный под чужим именем, не расшифруется
+        return self._aead.decrypt(blob[:NONCE_SIZE], blob[NONCE_SIZE:], name.encode())
+
+    def known_chunks(self):
+        if self._known is None:
+            self._known = {name.rsplit('/', 1)[1] for name in self.backend.list('chunks/')}
+        return self._known
+
+    def _upload(self, chunk_id, data):
+        name = self.chunk_name(chunk_id)
+        blob = self._seal(zlib.compress(data, 6), name)
+        try:
+            self.backend.put(name, blob)
+        except Exception:
+            with self._lock:
+                self._known.discard(chunk_id)     # следующий снимок попробует выгрузить кусок снова
+            raise
+        with self._lock:
+            self.stats['uploaded_bytes'] += len(blob)
+
+    def store_stream(self, stream, pool, pending):
+        """Режет поток и отправляет новые куски в pool; возвращает (id кусков, размер)."""
+        known = self.known_chunks()
+        chunk_ids = []
+        size = 0
+        for data in iter_chunks(stream, self._boundary, self.config['chunk_min'], self.config['chunk_max']):
+            chunk_id = self.chunk_id(data)
+            chunk_ids.append(chunk_id)
+            size += len(data)
+            self.stats['chunks'] += 1
+            self.stats['bytes'] += len(data)
+            if chunk_id in known:
+                continue
+            with self._lock:
+                known.add(chunk_id)
+            self.stats['new_chunks'] += 1
+            self.stats['new_bytes'] += len(data)
+            # Не больше 2 * workers кусков в очереди: память не растёт, если выгрузка медленнее нарезки
+            pending.acquire()
+            future = pool.submit(self._upload, chunk_id, data)
+            future.add_done_callback(lambda _: pending.release())
+            self._futures.append(future)
+        return chunk_ids, size
+
+    def read_chunk(self, chunk_id):
+        name = self.chunk_name(chunk_id)
+        data = zlib.decompress(self._open(self.backend.get(name), name))
+        if not hmac.compare_digest(self.chunk_id(data), chunk_id):
+            raise ValueError(f"Кусок {chunk_id} повреждён")
+        return data
+
+    # ---- снимки ----
+    def backup(self, name, stamp, sources, previous=None):
+        """
+        Сохраняет снимок stamp_name. sources — список (путь в снимке, открытый поток или путь к файлу).
+        Файлы, у которых размер и mtime совпадают с previous, не читаются: куски берутся из previous.
+        Снимок записывается только после выгрузки всех его кусков.
+        """
+        previous_files = {entry['path']: entry for entry in previous['files']} if previous else {}
+        files = []
+        self._futures = []
+        pending = threading.BoundedSemaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for path, source in sources:
+                if isinstance(source, str):
+                    stat = os.stat(source)
+                    known = previous_files.get(path)
+                    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                        files.append(known)
+                        self.stats['chunks'] += len(known['chunks'])
+                        self.stats['bytes'] += known['size']
+                        continue
+                    with open(source, 'rb') as f:
+                        chunk_ids, size = self.store_stream(f, pool, pending)
+                    files.append({'path': path, 'size': size, 'mtime_ns': stat.st_mtime_ns,
+                                  'mode': stat.st_mode & 0o7777, 'chunks': chunk_ids})
+                else:
+                    chunk_ids, size = self.store_stream(source, pool, pending)
+                    files.append({'path': path, 'size': size, 'mtime_ns': None, 'mode': 0o600, 'chunks': chunk_ids})
+        for future in self._futures:
+            future.result()     # ошибка выгрузки любого куска — снимок не записывается
+
+        snapshot = {'name': name, 'created': stamp, 'files': files}
+        snapshot_name = f"snapshots/{stamp}_{name}"
+        self.backend.put(snapshot_name, self._seal(zlib.compress(json.dumps(snapshot).encode()), snapshot_name))
+        return snapshot_name
+
+    def snapshots(self, name=None):
+        """Имена снимков (без префикса snapshots/) по возрастанию даты."""
+        snapshots = [item.split('/', 1)[1] for item in self.backend.list('snapshots/')]
+        if name is not None:
+            snapshots = [item for item in snapshots if item.split('_', 2)[2] == name]
+        return snapshots
+
+    def load_snapshot(self, snapshot):
+        name = f"snapshots/{snapshot}"
+        return json.loads(zlib.decompress(self._open(self.backend.get(name), name)))
+
+    def latest_snapshot(self, name):
+        snapshots = self.snapshots(name)
+        return self.load_snapshot(snapshots[-1]) if snapshots else None
+
+    def forget(self, snapshot):
+        self.backend.delete(f"snapshots/{snapshot}")
+
+    def gc(self, dry_run=False):
+        """Удаляет куски, на которые не ссылается ни один снимок; возвращает их число."""
+        referenced = set()
+        for snapshot in self.snapshots():
+            for entry in self.load_snapshot(snapshot)['files']:
+                referenced.update(entry['chunks'])
+        unused = [name for name in self.backend.list('chunks/') if name.rsplit('/', 1)[1] not in referenced]
+        if not dry_run:
+            for name in unused:
+                self.backend.delete(name)
+            self._known = None
+        return len(unused)
+
+    def write_file(self, entry, out):
+        for chunk_id in entry['chunks']:
+            out.write(self.read_chunk(chunk_id))
+
+    def restore(self, snapshot, target):
+        snapshot = self.load_snapshot(snapshot)
+        target = os.path.abspath(target)
+        for entry in snapshot['files']:
+            path = os.path.normpath(os.path.join(target, entry['path']))
+            if not path.startswith(target + os.sep):
+                raise ValueError(f"Недопустимый путь в снимке: {entry['path']}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as out:
+                self.write_file(entry, out)
+            os.chmod(path, entry['mode'])
+            if entry['mtime_ns'] is not None:
+                os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return len(snapshot['files'])
+
+
+def site_sources(folder):
+    """(путь относительно folder, полный путь) для всех обычных файлов папки."""
+    for root, _, names in os.walk(folder):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                yield os.path.relpath(path, folder), path
+
+
+def open_store(spec, workers=None, cache_path=None):
+    backend = open_backend(spec, email=os.getenv('MEGA_EMAIL'), password=os.getenv('MEGA_PASSWORD'),
+                           cache_path=cache_path)
+    return ChunkStore(backend, os.getenv('ZIP_PASSWORD'), workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Хранилище бэкапов с дедупликацией")
+    parser.add_argument('--store', default=os.getenv('BACKUP_STORE'), help="local:<папка> или mega:<папка>")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('snapshots', help="список снимков")
+    show_parser = sub.add_parser('show', help="файлы снимка")
+    show_parser.add_argument('snapshot')
+    restore_parser = sub.add_parser('restore', help="восстановить снимок в папку")
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('--to', required=True)
+    cat_parser = sub.add_parser('cat', help="вывести файл снимка в stdout")
+    cat_parser.add_argument('snapshot')
+    cat_parser.add_argument('path')
+    backup_parser = sub.add_parser('backup', help="сохранить папку или файл как снимок")
+    backup_parser.add_argument('name')
+    backup_parser.add_argument('source')
+    backup_parser.add_argument('--stamp', required=True, help="ГГГГММДД_ЧЧММСС")
+    args = parser.parse_args()
+    if not args.store:
+        raise SystemExit("Не задано хранилище: --store или BACKUP_STORE")
+
+    store = open_store(args.store)
+    if args.command == 'snapshots':
+        for snapshot in store.snapshots():
+            print(snapshot)
+    elif args.command == 'show':
+        for entry in store.load_snapshot(args.snapshot)['files']:
+            print(f"{entry['size']:>12}  {len(entry['chunks']):>5} кусков  {entry['path']}")
+    elif args.command == 'restore':
+        print(f"Восстановлено файлов: {store.restore(args.snapshot, args.to)}")
+    elif args.command == 'cat':
+        entries = {entry['path']: entry for entry in store.load_snapshot(args.snapshot)['files']}
+        if args.path not in entries:
+            raise SystemExit(f"В снимке нет {args.path}")
+        store.write_file(entries[args.path], sys.stdout.buffer)
+    elif args.command == 'backup':
+        if os.path.isdir(args.source):
+            sources = list(site_sources(args.source))
+        else:
+            sources = [(os.path.basename(args.source), args.source)]
+        snapshot = store.backup(args.name, args.stamp, sources, store.latest_snapshot(args.name))
+        print(f"{snapshot}: {store.stats}")
+
+
+if __name__ == "__main__":
+    main()
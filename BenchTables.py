@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import argparse
+import random
+import timeit
+from datetime import date, timedelta
+from decimal import Decimal
+
+from tabulate import tabulate
+
+from SupportCommon import BILL_TABLE, PAYMENTS_TABLE
+
+# Сравнение GridTable с tabulate на таблицах бота: «Баланс» (10 договоров) и «Платежі» (24 платежа).
+# Сначала проверяет, что вывод совпадает байт в байт на случайных данных, затем замеряет скорость.
+#
+#   python BenchTables.py                  # проверка + замер
+#   python BenchTables.py --check 20000    # больше случайных таблиц для проверки
+#
+# tabulate нужен только этому скрипту, боту он больше не требуется.
+
+TARIFFS = [
+    "Інтернет 100", "Інтернет 1000 Мбіт/с", "IPTV", "Оптика-Преміум", "Статична IP-адреса",
+    "Домашній\nінтернет", "Pon  500", "Гігабіт_для_офісу_24/7", "", None, "Бізнес 🚀 500",
+]
+PAYMENT_TYPES = ["Приват24", "Термінал", "Картка", None, ""]
+
+
+def random_agreement(rnd: random.Random):
+    kind = rnd.random()
+    if kind < 0.5:
+        return rnd.randint(1, 99999)
+    if kind < 0.8:
+        return str(rnd.randint(1, 9999999999))
+    return rnd.choice(["A-1024", "ФОП 77", "12/345", "  515 "])
+
+
+def bill_rows(rnd: random.Random, count: int = 10) -> list:
+    rows = []
+    for _ in range(count):
+        balance = Decimal(rnd.randint(-2000000, 2000000)) / 100
+        emoji = "✅" if balance >= 0 else "🔴"
+        rows.append([random_agreement(rnd), f"{emoji} {balance:.2f}₴", rnd.choice(TARIFFS)])
+    return rows
+
+
+def payment_rows(rnd: random.Random, count: int = 24) -> list:
+    rows = []
+    day = date(2024, 1, 1)
+    for _ in range(count):
+        money = Decimal(rnd.randint(1, 10000000)) / 100
+        day += timedelta(days=rnd.randint(0, 40))
+        rows.append([rnd.randint(1, 10 ** rnd.randint(1, 8)), random_agreement(rnd), f"{money}₴", day.strftime("%Y-%m-%d")])
+    return rows
+
+
+def reference(table, rows) -> str:
+    return tabulate(rows, headers=table.headers, tablefmt="grid", maxcolwidths=table.maxcolwidths)
+
+
+def check(iterations: int, seed: int) -> int:
+    """Число таблиц, где GridTable разошёлся с tabulate."""
+    rnd = random.Random(seed)
+    mismatches = 0
+    for i in range(iterations):
+        table, rows = (BILL_TABLE, bill_rows(rnd, rnd.randint(0, 12))) if i % 2 else \
+            (PAYMENTS_TABLE, payment_rows(rnd, rnd.randint(0, 30)))
+        expected = reference(table, rows)
+        actual = table.render(rows)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"Расхождение на строках {rows!r}:\n{expected}\n---\n{actual}\n")
+    print(f"Проверено таблиц: {iterations}, расхождений: {mismatches}")
+    return mismatches
+
+
+def bench(number: int, seed: int):
+    rnd = random.Random(seed)
+    shapes = [
+        ("баланс, 10 строк", BILL_TABLE, bill_rows(rnd, 10)),
+        ("платежі, 24 строки", PAYMENTS_TABLE, payment_rows(rnd, 24)),
+    ]
+    print(f"{'таблица':<20} {'tabulate, мкс':>14} {'GridTable, мкс':>15} {'ускорение':>10}")
+    for name, table, rows in shapes:
+        old = min(timeit.repeat(lambda: reference(table, rows), number=number, repeat=5)) / number
+        new = min(timeit.repeat(lambda: table.render(rows), number=number, repeat=5)) / number
+        print(f"{name:<20} {old * 1e6:>14.1f} {new * 1e6:>15.1f} {old / new:>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GridTable против tabulate")
+    parser.add_argument('--check', type=int, default=2000, help="сколько случайных таблиц сравнить")
+    parser.add_argument('--number', type=int, default=500, help="повторов на один замер")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if check(args.check, args.seed):
+        raise SystemExit(1)
+    bench(args.number, args.seed)
+
+
+if __name__ == "__main__":
+    main()
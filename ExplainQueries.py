@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+import pymysql
+from dotenv import load_dotenv
+
+from SupportCommon import (
+    BILL_SQL,
+    BIND_TELEGRAM_SQL,
+    IDENTITY_SQL,
+    LAST_QUESTION_ID_SQL,
+    NEW_QUESTIONS_SQL,
+    PAYMENTS_SQL,
+    PENDING_QUESTIONS_SQL,
+    USER_BY_PHONE_SQL,
+)
+
+# EXPLAIN для запросов бота и NewTask.py. Завершается с кодом 1, если какой-то запрос
+# читает таблицу целиком (type=ALL) или полностью сканирует индекс (type=index).
+#
+#   python ExplainQueries.py                     # проверить все запросы
+#   python ExplainQueries.py --allow addr_cities # разрешить полный скан маленького справочника
+#
+# Нужны только параметры базы: DB_HOST, DB_USER, DB_PASSWORD, DB_NAME.
+
+load_dotenv()
+
+database_config = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME'),
+    'charset': 'utf8',
+}
+# LIMIT для запросов NewTask.py (TASK_BATCH_SIZE по умолчанию)
+TASK_BATCH_SIZE = 50
+
+# Типы доступа, при которых читается вся таблица или весь индекс
+FULL_SCAN_TYPES = ('ALL', 'index')
+
+# название -> (запрос, параметры для EXPLAIN)
+QUERIES = {
+    'user_by_phone': (USER_BY_PHONE_SQL, ('501234567',)),
+    'bind_telegram': (BIND_TELEGRAM_SQL, (0, (0,))),
+    'identity': (IDENTITY_SQL, (0,)),
+    'balance': (BILL_SQL, ((0,),)),
+    'payments': (PAYMENTS_SQL, ((0,),)),
+    'newtask_pending': (PENDING_QUESTIONS_SQL, (TASK_BATCH_SIZE,)),
+    'newtask_new': (NEW_QUESTIONS_SQL, (0, TASK_BATCH_SIZE)),
+    'newtask_last_id': (LAST_QUESTION_ID_SQL, ()),
+}
+
+
+def explain(cursor, sql: str, params) -> list[dict]:
+    cursor.execute("EXPLAIN " + sql.strip().rstrip(';'), params)
+    return cursor.fetchall()
+
+
+def full_scans(plan: list[dict], allow: set) -> list[dict]:
+    return [
+        row for row in plan
+        if row.get('type') in FULL_SCAN_TYPES and row.get('table') not in allow
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка планов запросов бота и NewTask")
+    parser.add_argument('--allow', nargs='*', default=[], metavar='TABLE',
+                        help="алиасы таблиц, которым разрешён полный скан")
+    parser.add_argument('--only', nargs='*', choices=sorted(QUERIES), help="проверить только эти запросы")
+    args = parser.parse_args()
+    allow = set(args.allow)
+
+    failed = []
+    with pymysql.connect(**database_config, cursorclass=pymysql.cursors.DictCursor) as conn:
+        with conn.cursor() as cursor:
+            for name in args.only or QUERIES:
+                sql, params = QUERIES[name]
+                plan = explain(cursor, sql, params)
+                scans = full_scans(plan, allow)
+                print(f"{'FAIL' if scans else 'ok  '} {name}")
+                for row in plan:
+                    print(f"     {row.get('table')!s:<16} type={row.get('type')!s:<7} key={row.get('key')!s:<32} "
+                          f"rows={row.get('rows')!s:<8} {row.get('Extra') or ''}")
+                if scans:
+                    failed.append(name)
+
+    if failed:
+        raise SystemExit(f"Полный скан в запросах: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+import argparse
+import http.client
+import itertools
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Локальная замена Telegram Bot API для нагрузочных тестов без сети.
+#
+# 1. Запустить фейковый API и генератор нагрузки:
+#    python FakeTelegram.py load --users 200 --messages 5
+# 2. Запустить бота, направив его на фейковый API:
+#    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_MODE=webhook \
+#    WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_SECRET=test python SupportHappy.py
+#
+# Для режима polling бота запускают без BOT_MODE, а генератор — с --mode polling:
+# тогда обновления отдаются боту через фейковый getUpdates.
+
+# Кнопки, которые не требуют базы данных
+DEFAULT_TEXTS = ["/start", "💰 Оплата", "👤 Кабінет"]
+# Вместо текста пользователь делится контактом (номер даёт phone_for в run_load)
+CONTACT_TEXT = "<contact>"
+
+
+# =====================================
+#        Фейковый Bot API
+# =====================================
+class FakeTelegram:
+    """Состояние фейкового API: принятые вызовы, ответы по чатам и очередь getUpdates."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.calls = {}           # метод -> количество вызовов
+        self.replies = {}         # chat_id -> количество отправленных в чат сообщений
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.updates = queue.SimpleQueue()
+        self._message_ids = itertools.count(1)
+
+    def handle(self, method: str, params: dict):
+        with self.cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method == 'setWebhook':
+            with self.cond:
+                self.webhook_url = params.get('url')
+                self.webhook_secret = params.get('secret_token')
+                self.cond.notify_all()
+            return True
+        if method == 'getUpdates':
+            return self._get_updates(float(params.get('timeout') or 0))
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            with self.cond:
+                self.replies[chat_id] = self.replies.get(chat_id, 0) + 1
+                self.cond.notify_all()
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        # deleteMessage, deleteWebhook, answerCallbackQuery и прочее
+        return True
+
+    def _get_updates(self, timeout: float):
+        result = []
+        try:
+            result.append(self.updates.get(timeout=min(timeout, 1.0)))
+            while len(result) < 100:
+                result.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return result
+
+    def reply_count(self, chat_id: int) -> int:
+        with self.cond:
+            return self.replies.get(chat_id, 0)
+
+    def wait_reply(self, chat_id: int, count: int, timeout: float) -> bool:
+        with self.cond:
+            return self.cond.wait_for(lambda: self.replies.get(chat_id, 0) >= count, timeout)
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake: FakeTelegram = None
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        # /bot<token>/<method>
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return self._send(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+
+        result = self.fake.handle(parts[1], params)
+        self._send(200, {'ok': True, 'result': result})
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def _send(self, code: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(host: str, port: int) -> tuple[FakeTelegram, FakeApiServer]:
+    fake = FakeTelegram()
+    handler = type('BoundFakeApiHandler', (FakeApiHandler,), {'fake': fake})
+    server = FakeApiServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return fake, server
+
+
+# =====================================
+#        Генератор нагрузки
+# =====================================
+def make_update(update_id: int, chat_id: int, text: str, phone: str | None = None) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+    }
+    if phone is None:
+        message['text'] = text
+    else:
+        message['contact'] = {'phone_number': phone, 'first_name': f'user{chat_id}', 'user_id': chat_id}
+    return {'update_id': update_id, 'message': message}
+
+
+class WebhookClient:
+    """Keep-alive соединение с вебхуком бота."""
+
+    def __init__(self, url: str, secret: str | None):
+        self.url = urlsplit(url)
+        self.secret = secret
+        self.connection = None
+
+    def post(self, update: dict):
+        body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.secret
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+            try:
+                self.connection.request('POST', self.url.path or '/', body=body, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                # Сервер мог закрыть keep-alive соединение — переподключаемся один раз
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_load(fake: FakeTelegram, users: int, messages: int, texts: list, mode: str,
+             webhook: str | None, secret: str | None, reply_timeout: float, first_chat_id: int = 1,
+             phone_for=None) -> dict:
+    """
+    Каждый пользователь нажимает кнопку и ждёт ответа бота, прежде чем нажать следующую.
+    Возвращает задержки (от отправки обновления до ответа бота) и пропускную способность.
+    CONTACT_TEXT в texts отправляет контакт с номером phone_for(chat_id).
+    """
+    update_ids = itertools.count(int(time.time()) * 1000)
+    latencies = []
+    lock = threading.Lock()
+    errors = [0]
+
+    def user(chat_id: int):
+        client = WebhookClient(webhook, secret) if mode == 'webhook' else None
+        expected = fake.reply_count(chat_id)
+        for i in range(messages):
+            text = texts[i % len(texts)]
+            phone = phone_for(chat_id) if text == CONTACT_TEXT and phone_for else None
+            update = make_update(next(update_ids), chat_id, text, phone)
+            started = time.monotonic()
+            try:
+                if client:
+                    status = client.post(update)
+                    if status != 200:
+                        raise RuntimeError(f"вебхук ответил {status}")
+                else:
+                    fake.updates.put(update)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            expected += 1
+            if fake.wait_reply(chat_id, expected, reply_timeout):
+                with lock:
+                    latencies.append(time.monotonic() - started)
+            else:
+                with lock:
+                    errors[0] += 1
+                expected = fake.reply_count(chat_id)
+
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=user, args=(first_chat_id + n,), daemon=True)
+        for n in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    return {
+        'users': users,
+        'updates': len(latencies),
+        'errors': errors[0],
+        'elapsed': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+# =====================================
+#          Точка входа (main)
+# =====================================
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API и генератор нагрузки")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = sub.add_parser('serve', help="только поднять фейковый API")
+    load_parser = sub.add_parser('load', help="поднять фейковый API и нагрузить бота")
+    for p in (serve_parser, load_parser):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8081)
+
+    load_parser.add_argument('--mode', choices=['webhook', 'polling'], default='webhook')
+    load_parser.add_argument('--webhook', help="адрес вебхука (по умолчанию тот, что бот передал в setWebhook)")
+    load_parser.add_argument('--secret', help="секрет вебхука (по умолчанию из setWebhook)")
+    load_parser.add_argument('--users', type=int, default=100)
+    load_parser.add_argument('--messages', type=int, default=5)
+    load_parser.add_argument('--texts', nargs='+', default=DEFAULT_TEXTS)
+    load_parser.add_argument('--reply-timeout', type=float, default=30)
+    load_parser.add_argument('--wait-bot', type=float, default=60, help="сколько ждать setWebhook от бота")
+    args = parser.parse_args()
+
+    fake, server = serve(args.host, args.port)
+    print(f"Фейковый Bot API: http://{args.host}:{args.port}")
+
+    if args.command == 'serve':
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    webhook, secret = args.webhook, args.secret
+    if args.mode == 'webhook' and not webhook:
+        print("Ожидаем setWebhook от бота...")
+        with fake.cond:
+            if not fake.cond.wait_for(lambda: fake.webhook_url, args.wait_bot):
+                raise SystemExit("Бот не вызвал setWebhook")
+        webhook = fake.webhook_url
+        secret = secret or fake.webhook_secret
+
+    result = run_load(fake, args.users, args.messages, args.texts, args.mode,
+                      webhook, secret, args.reply_timeout)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
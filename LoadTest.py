@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pymysql
+from dotenv import load_dotenv
+
+from FakeTelegram import CONTACT_TEXT, run_load, serve
+from MigratePhones import INDEX_NAME
+from SupportCommon import normalize_phone
+
+# Нагрузочный тест бота без сети и без боевой базы.
+#
+# 1. Заполнить тестовую базу (по умолчанию supportbot_loadtest на DB_HOST из .env):
+#    python LoadTest.py seed --subscribers 100000
+# 2. Прогнать настоящий SupportHappy.py против фейкового Bot API и тестовой базы:
+#    python LoadTest.py run --users 200 --messages 20
+# 3. Сравнить результаты разных версий:
+#    python LoadTest.py compare
+#
+# Результаты дописываются в LOADTEST_RESULTS (JSONL) вместе с git-ревизией. Файл по умолчанию
+# лежит рядом со скриптом и в .gitignore: он переживает checkout других версий для compare.
+# Абонент n привязан к чату CHAT_ID_BASE + n, пользователь нагрузки k — к абоненту k.
+
+load_dotenv()
+
+LOADTEST_DB_NAME = os.getenv('LOADTEST_DB_NAME', 'supportbot_loadtest')
+LOADTEST_RESULTS = os.getenv('LOADTEST_RESULTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadtest_results.jsonl'))
+
+database_config = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'charset': 'utf8mb4',
+}
+
+CHAT_ID_BASE = 7_000_000_000
+BATCH_SIZE = 5000
+
+# Нажатия по умолчанию: экраны из базы и кнопки без неё
+DEFAULT_TEXTS = ["💳 Баланс", "💯 Платежі", "👤 Кабінет", "💰 Оплата", "💳 Баланс", "/start"]
+
+# Лимиты отправки бота снимаются: фейковый API их не требует, а иначе тест меряет ограничитель
+UNLIMITED_SEND_ENV = {
+    'SEND_CHAT_RATE': '1000',
+    'SEND_CHAT_BURST': '1000',
+    'SEND_GLOBAL_RATE': '100000',
+}
+
+CITIES = ["Київ", "Біла Церква", "Бровари", "Вишневе", "Ірпінь"]
+STREETS = ["Шевченка", "Лесі Українки", "Незалежності", "Соборна", "Героїв Майдану", "Садова", "Мирна"]
+TARIFFS = ["Інтернет 100", "Інтернет 500", "Інтернет 1000", "IPTV Базовий", "IPTV Преміум", "Статична IP-адреса"]
+PAYMENT_TYPES = ["Приват24", "Термінал", "Картка", "Каса", None]
+
+SCHEMA = [
+    '''CREATE TABLE addr_cities (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        name VARCHAR(64) NOT NULL
+    )''',
+    '''CREATE TABLE addr_streets (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        city INT NOT NULL,
+        name VARCHAR(128) NOT NULL,
+        KEY (city)
+    )''',
+    '''CREATE TABLE addr_houses (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        street INT NOT NULL,
+        name VARCHAR(32) NOT NULL,
+        KEY (street)
+    )''',
+    '''CREATE TABLE bill_prices (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        name VARCHAR(128) NOT NULL
+    )''',
+    '''CREATE TABLE clients (
+        id INT PRIMARY KEY,
+        agreement VARCHAR(32) NOT NULL,
+        name VARCHAR(128) NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        house INT NOT NULL,
+        apartment VARCHAR(16) NOT NULL DEFAULT '',
+        telegram_chat_id BIGINT NULL,
+        KEY (telegram_chat_id),
+        KEY (house)
+    )''',
+    f'''CREATE TABLE client_contacts (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        agreement_id INT NOT NULL,
+        type VARCHAR(16) NOT NULL,
+        value VARCHAR(64) NOT NULL,
+        main TINYINT NOT NULL DEFAULT 0,
+        phone_norm VARCHAR(16) NULL,
+        KEY (agreement_id),
+        KEY {INDEX_NAME} (phone_norm, main)
+    )''',
+    '''CREATE TABLE client_prices (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        agreement INT NOT NULL,
+        price INT NOT NULL,
+        time_start DATETIME NOT NULL,
+        time_stop DATETIME NULL,
+        KEY (agreement, time_stop)
+    )''',
+    '''CREATE TABLE paymants (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        agreement INT NOT NULL,
+        money DECIMAL(12, 2) NOT NULL,
+        time DATETIME NOT NULL,
+        payment_type VARCHAR(64) NULL,
+        KEY (agreement, time)
+    )''',
+]
+TABLES = ['addr_cities', 'addr_streets', 'addr_houses', 'bill_prices',
+          'clients', 'client_contacts', 'client_prices', 'paymants']
+
+
+def phone_of(client_id: int) -> str:
+    """Основной телефон абонента; последние 9 цифр уникальны до 10 млн абонентов."""
+    return f"+380 {50 + client_id % 50:02d} {client_id:07d}"
+
+
+def chat_of(client_id: int) -> int:
+    return CHAT_ID_BASE + client_id
+
+
+# =====================================
+#        Тестовая база
+# =====================================
+def insert_rows(conn, table: str, columns: list, rows) -> int:
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    batch = []
+    total = 0
+    with conn.cursor() as cursor:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                conn.commit()
+                total += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+            conn.commit()
+            total += len(batch)
+    print(f"{table}: {total}")
+    return total
+
+
+def seed(subscribers: int, payments: int, seed_value: int, drop: bool):
+    rnd = random.Random(seed_value)
+    conn = pymysql.connect(**database_config)
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{LOADTEST_DB_NAME}` CHARACTER SET utf8mb4")
+        cursor.execute(f"USE `{LOADTEST_DB_NAME}`")
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN %s",
+            (tuple(TABLES),)
+        )
+        if cursor.fetchone()[0]:
+            if not drop:
+                raise SystemExit(f"В {LOADTEST_DB_NAME} уже есть таблицы; добавьте --drop, чтобы пересоздать их")
+            for table in TABLES:
+                cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cursor.execute("SELECT @@SESSION.sql_mode")
+        if 'ONLY_FULL_GROUP_BY' in cursor.fetchone()[0]:
+            print("Внимание: ONLY_FULL_GROUP_BY включён, запрос экрана «Баланс» может завершаться ошибкой")
+    conn.commit()
+
+    started = time.monotonic()
+    insert_rows(conn, 'addr_cities', ['id', 'name'], ((i + 1, name) for i, name in enumerate(CITIES)))
+    streets = [(i + 1, i % len(CITIES) + 1, f"вул. {name}") for i, name in enumerate(STREETS * len(CITIES))]
+    insert_rows(conn, 'addr_streets', ['id', 'city', 'name'], streets)
+    houses_count = max(1, subscribers // 40)
+    insert_rows(conn, 'addr_houses', ['id', 'street', 'name'],
+                ((i + 1, i % len(streets) + 1, str(i // len(streets) + 1)) for i in range(houses_count)))
+    insert_rows(conn, 'bill_prices', ['id', 'name'], ((i + 1, name) for i, name in enumerate(TARIFFS)))
+
+    insert_rows(conn, 'clients', ['id', 'agreement', 'name', 'balance', 'house', 'apartment', 'telegram_chat_id'], (
+        (n, str(100000 + n), f"Абонент {n}", round(rnd.uniform(-500, 1500), 2),
+         rnd.randint(1, houses_count), str(rnd.randint(1, 200)), chat_of(n))
+        for n in range(1, subscribers + 1)
+    ))
+
+    def contacts():
+        for n in range(1, subscribers + 1):
+            phone = phone_of(n)
+            yield n, 'PHONE', phone, 1, normalize_phone(phone)
+            if n % 3 == 0:
+                extra = f"0{rnd.randint(500000000, 999999999)}"
+                yield n, 'PHONE', extra, 0, normalize_phone(extra)
+            if n % 5 == 0:
+                yield n, 'EMAIL', f"user{n}@example.com", 0, None
+    insert_rows(conn, 'client_contacts', ['agreement_id', 'type', 'value', 'main', 'phone_norm'], contacts())
+
+    start = datetime(2020, 1, 1)
+
+    def prices():
+        for n in range(1, subscribers + 1):
+            # Закрытый тариф в истории и один-два действующих
+            yield n, rnd.randint(1, len(TARIFFS)), start, start + timedelta(days=365)
+            for price in rnd.sample(range(1, len(TARIFFS) + 1), rnd.choice((1, 1, 2))):
+                yield n, price, start + timedelta(days=365), None
+    insert_rows(conn, 'client_prices', ['agreement', 'price', 'time_start', 'time_stop'], prices())
+
+    def payment_rows():
+        for n in range(1, subscribers + 1):
+            for _ in range(rnd.randint(0, payments * 2)):
+                yield (n, round(rnd.uniform(50, 900), 2),
+                       start + timedelta(seconds=rnd.randint(0, 5 * 365 * 86400)), rnd.choice(PAYMENT_TYPES))
+    insert_rows(conn, 'paymants', ['agreement', 'money', 'time', 'payment_type'], payment_rows())
+
+    conn.close()
+    print(f"База {LOADTEST_DB_NAME} заполнена за {time.monotonic() - started:.1f} с")
+
+
+# =====================================
+#        Прогон нагрузки
+# =====================================
+def git_revision() -> str:
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return rev + ('-dirty' if dirty else '')
+
+
+def start_bot(args, api_port: int, secret: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{api_port}',
+        'DB_NAME': LOADTEST_DB_NAME,
+        'BOT_MODE': args.mode,
+        'WEBHOOK_URL': f'http://127.0.0.1:{args.webhook_port}/telegram',
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(args.webhook_port),
+        'WEBHOOK_SECRET': secret,
+    })
+    if not args.telegram_limits:
+        env.update(UNLIMITED_SEND_ENV)
+    for item in args.bot_env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SupportHappy.py')
+    return subprocess.Popen([sys.executable, script], env=env)
+
+
+def wait_bot(fake, mode: str, timeout: float) -> bool:
+    with fake.cond:
+        if mode == 'webhook':
+            return fake.cond.wait_for(lambda: fake.webhook_url, timeout)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with fake.cond:
+            if fake.calls.get('getUpdates'):
+                return True
+        time.sleep(0.1)
+    return False
+
+
+def run(args):
+    fake, server = serve('127.0.0.1', args.api_port)
+    secret = secrets.token_hex(16)
+    bot = start_bot(args, args.api_port, secret)
+    try:
+        if not wait_bot(fake, args.mode, args.wait_bot):
+            raise SystemExit("Бот не подключился к фейковому API")
+        phone_for = lambda chat_id: phone_of(chat_id - CHAT_ID_BASE)  # noqa: E731
+
+        if args.warmup:
+            run_load(fake, args.users, args.warmup, args.texts, args.mode,
+                     fake.webhook_url, secret, args.reply_timeout, chat_of(1), phone_for)
+        result = run_load(fake, args.users, args.messages, args.texts, args.mode,
+                          fake.webhook_url, secret, args.reply_timeout, chat_of(1), phone_for)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(15)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        server.shutdown()
+
+    record = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'rev': git_revision(),
+        'label': args.label,
+        'mode': args.mode,
+        'messages': args.messages,
+        'texts': args.texts,
+        'telegram_limits': args.telegram_limits,
+        **result,
+    }
+    with open(args.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    if result['errors']:
+        print(f"Без ответа или с ошибкой: {result['errors']} обновлений")
+
+
+def scenario(record: dict) -> tuple:
+    return (record['mode'], record['users'], record['messages'],
+            tuple(record['texts']), record.get('telegram_limits', False))
+
+
+def compare(path: str, last: int):
+    """Результаты по сценариям: каждая строка сравнивается с предыдущим прогоном того же сценария."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        raise SystemExit(f"Нет результатов в {path}")
+
+    scenarios = {}
+    for record in records:
+        scenarios.setdefault(scenario(record), []).append(record)
+
+    for (mode, users, messages, texts, limits), runs in scenarios.items():
+        print(f"\n{mode}, {users} польз. × {messages} нажатий, {len(texts)} кнопок"
+              f"{', лимиты Telegram' if limits else ''}")
+        print(f"{'время':<20} {'ревизия':<14} {'upd/s':>8} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'ошибки':>7} {'Δ upd/s':>8}")
+        previous = None
+        for record in runs[-last:]:
+            delta = ''
+            if previous and previous['updates_per_sec']:
+                delta = f"{(record['updates_per_sec'] / previous['updates_per_sec'] - 1) * 100:+.1f}%"
+            print(f"{record['time']:<20} {record['rev']:<14} {record['updates_per_sec']:>8} "
+                  f"{record['p50_ms']:>8} {record['p95_ms']:>8} {record['p99_ms']:>8} {record['errors']:>7} {delta:>8}")
+            previous = record
+
+
+# =====================================
+#          Точка входа (main)
+# =====================================
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест SupportHappy.py")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = sub.add_parser('seed', help="создать и заполнить тестовую базу")
+    seed_parser.add_argument('--subscribers', type=int, default=10000)
+    seed_parser.add_argument('--payments', type=int, default=12, help="в среднем платежей на абонента")
+    seed_parser.add_argument('--seed', type=int, default=1)
+    seed_parser.add_argument('--drop', action='store_true', help="пересоздать таблицы тестовой базы")
+
+    run_parser = sub.add_parser('run', help="запустить бота и нагрузить его")
+    run_parser.add_argument('--mode', choices=['webhook', 'polling'], default='webhook')
+    run_parser.add_argument('--users', type=int, default=100)
+    run_parser.add_argument('--messages', type=int, default=10)
+    run_parser.add_argument('--warmup', type=int, default=1, help="нажатий на пользователя до замера")
+    run_parser.add_argument('--texts', nargs='+', default=DEFAULT_TEXTS,
+                            help=f"кнопки по кругу; {CONTACT_TEXT} — поделиться номером")
+    run_parser.add_argument('--label', default='', help="пометка прогона в результатах")
+    run_parser.add_argument('--telegram-limits', action='store_true', help="не снимать лимиты отправки бота")
+    run_parser.add_argument('--bot-env', action='append', default=[], metavar='KEY=VALUE',
+                            help="переменная окружения для бота, например BOT_WORKERS=16")
+    run_parser.add_argument('--api-port', type=int, default=8081)
+    run_parser.add_argument('--webhook-port', type=int, default=8443)
+    run_parser.add_argument('--reply-timeout', type=float, default=30)
+    run_parser.add_argument('--wait-bot', type=float, default=60)
+    run_parser.add_argument('--results', default=LOADTEST_RESULTS)
+
+    compare_parser = sub.add_parser('compare', help="сравнить сохранённые результаты")
+    compare_parser.add_argument('--results', default=LOADTEST_RESULTS)
+    compare_parser.add_argument('--last', type=int, default=10, help="сколько прогонов сценария показать")
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed(args.subscribers, args.payments, args.seed, args.drop)
+    elif args.command == 'run':
+        run(args)
+    else:
+        compare(args.results, args.last)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+import pymysql
+from dotenv import load_dotenv
+
+from SupportCommon import PHONE_SUFFIX_LEN, normalize_phone
+
+# Миграция для поиска абонента по телефону через индекс вместо LIKE '%<номер>'.
+# Добавляет в client_contacts колонку phone_norm (последние 9 цифр номера) и индекс по ней.
+#
+#   python MigratePhones.py --dry-run   # показать SQL
+#   python MigratePhones.py             # применить и проверить
+#   python MigratePhones.py --verify    # только проверить совпадение с normalize_phone()
+#
+# На MySQL 8 / MariaDB колонка генерируемая (STORED) и заполняется самим сервером.
+# Там, где нет REGEXP_REPLACE (MySQL 5.7), колонка обычная: её заполняет этот скрипт,
+# а новые и изменённые контакты — триггеры.
+
+load_dotenv()
+
+database_config = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME'),
+    'charset': 'utf8mb4',
+}
+
+BATCH_SIZE = 1000
+INDEX_NAME = 'idx_client_contacts_phone_norm'
+
+# Разделители, которые убираются там, где нет REGEXP_REPLACE
+PHONE_SEPARATORS = (' ', '+', '-', '(', ')', '.', '/')
+
+
+def phone_norm_expr(row: str = '', regexp: bool = True) -> str:
+    """SQL-аналог normalize_phone(): только цифры, последние PHONE_SUFFIX_LEN."""
+    digits = f"{row}value"
+    if regexp:
+        digits = f"REGEXP_REPLACE({digits}, '[^0-9]', '')"
+    else:
+        for separator in PHONE_SEPARATORS:
+            digits = f"REPLACE({digits}, '{separator}', '')"
+    return f"IF({row}type = 'PHONE', RIGHT({digits}, {PHONE_SUFFIX_LEN}), NULL)"
+
+
+def column_exists(cursor) -> bool:
+    cursor.execute(
+        '''
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'client_contacts' AND COLUMN_NAME = 'phone_norm'
+        '''
+    )
+    return cursor.fetchone() is not None
+
+def index_exists(cursor) -> bool:
+    cursor.execute(
+        '''
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'client_contacts' AND INDEX_NAME = %s
+        ''',
+        (INDEX_NAME,)
+    )
+    return cursor.fetchone() is not None
+
+def supports_regexp_replace(cursor) -> bool:
+    try:
+        cursor.execute("SELECT REGEXP_REPLACE('+38 (050)', '[^0-9]', '')")
+        return cursor.fetchone()[0] == '38050'
+    except pymysql.MySQLError:
+        return False
+
+
+def migration_sql(generated: bool) -> list[str]:
+    if generated:
+        return [
+            f"ALTER TABLE client_contacts "
+            f"ADD COLUMN phone_norm VARCHAR(16) AS ({phone_norm_expr()}) STORED, "
+            f"ADD INDEX {INDEX_NAME} (phone_norm, main)",
+        ]
+    statements = [
+        f"ALTER TABLE client_contacts "
+        f"ADD COLUMN phone_norm VARCHAR(16) NULL, "
+        f"ADD INDEX {INDEX_NAME} (phone_norm, main)",
+    ]
+    for event in ('INSERT', 'UPDATE'):
+        statements.append(
+            f"CREATE TRIGGER client_contacts_phone_norm_{event.lower()} "
+            f"BEFORE {event} ON client_contacts FOR EACH ROW "
+            f"SET NEW.phone_norm = {phone_norm_expr('NEW.', regexp=False)}"
+        )
+    return statements
+
+
+def backfill(conn) -> int:
+    """Заполняет phone_norm пачками по BATCH_SIZE различных номеров."""
+    with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute("SELECT DISTINCT value FROM client_contacts WHERE type = 'PHONE'")
+        values = [row[0] for row in cursor]
+
+    updated = 0
+    with conn.cursor() as cursor:
+        for start in range(0, len(values), BATCH_SIZE):
+            batch = values[start:start + BATCH_SIZE]
+            cursor.executemany(
+                "UPDATE client_contacts SET phone_norm = %s WHERE type = 'PHONE' AND value = %s",
+                [(normalize_phone(value), value) for value in batch]
+            )
+            conn.commit()
+            updated += len(batch)
+            print(f"Заполнено номеров: {updated}/{len(values)}")
+    return updated
+
+
+def verify(conn) -> int:
+    """Сравнивает phone_norm с normalize_phone(); возвращает число расхождений."""
+    mismatches = 0
+    total = 0
+    with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute("SELECT value, phone_norm FROM client_contacts WHERE type = 'PHONE'")
+        for value, phone_norm in cursor:
+            total += 1
+            expected = normalize_phone(value)
+            if (phone_norm or '') != expected:
+                mismatches += 1
+                if mismatches <= 20:
+                    print(f"Расхождение: {value!r} -> {phone_norm!r}, ожидалось {expected!r}")
+    print(f"Проверено телефонов: {total}, расхождений: {mismatches}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс нормализованных телефонов client_contacts")
+    parser.add_argument('--dry-run', action='store_true', help="только показать SQL")
+    parser.add_argument('--verify', action='store_true', help="только проверить заполнение")
+    args = parser.parse_args()
+
+    with pymysql.connect(**database_config) as conn:
+        with conn.cursor() as cursor:
+            generated = supports_regexp_replace(cursor)
+            has_column = column_exists(cursor)
+            has_index = index_exists(cursor)
+
+        if args.verify:
+            raise SystemExit(1 if verify(conn) else 0)
+
+        if has_column and has_index:
+            print("Колонка phone_norm и индекс уже есть.")
+        else:
+            statements = migration_sql(generated)
+            if has_column:
+                statements = [f"ALTER TABLE client_contacts ADD INDEX {INDEX_NAME} (phone_norm, main)"]
+            for statement in statements:
+                print(statement + ";")
+                if not args.dry_run:
+                    with conn.cursor() as cursor:
+                        cursor.execute(statement)
+            if args.dry_run:
+                return
+            conn.commit()
+            if not generated and not has_column:
+                backfill(conn)
+
+        raise SystemExit(1 if verify(conn) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+import pymysql
+from dotenv import load_dotenv
+
+# Индекс для выборки неотправленных заявок NewTask.py:
+#   WHERE is_sent_tg = 'NO' AND dest_time >= CURDATE() AND dest_time < CURDATE() + INTERVAL 1 DAY
+#
+#   python MigrateQuestions.py --dry-run   # показать SQL
+#   python MigrateQuestions.py             # применить
+#
+# Индекс строится онлайн (ALGORITHM=INPLACE, LOCK=NONE), запись в questions не блокируется.
+# Проверить планы запросов после миграции: python ExplainQueries.py
+
+load_dotenv()
+
+database_config = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME'),
+    'charset': 'utf8mb4',
+}
+
+INDEX_NAME = 'idx_questions_sent_dest_time'
+INDEX_COLUMNS = '(is_sent_tg, dest_time)'
+
+
+def index_exists(cursor) -> bool:
+    cursor.execute(
+        '''
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'questions' AND INDEX_NAME = %s
+        ''',
+        (INDEX_NAME,)
+    )
+    return cursor.fetchone() is not None
+
+
+def migration_sql() -> str:
+    return f"ALTER TABLE questions ADD INDEX {INDEX_NAME} {INDEX_COLUMNS}, ALGORITHM=INPLACE, LOCK=NONE"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс questions для выборки неотправленных заявок")
+    parser.add_argument('--dry-run', action='store_true', help="только показать SQL")
+    args = parser.parse_args()
+
+    statement = migration_sql()
+    if args.dry_run:
+        print(statement + ";")
+        return
+
+    with pymysql.connect(**database_config) as conn:
+        with conn.cursor() as cursor:
+            if index_exists(cursor):
+                print(f"Индекс {INDEX_NAME} уже есть.")
+                return
+            print(statement + ";")
+            cursor.execute(statement)
+        conn.commit()
+    print("Готово.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import argparse
 import os
+import random
 import re
+import time
+import requests
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime
@@ -8,12 +12,36 @@ import pymysql.cursors
 
 from dotenv import load_dotenv
 
+from SupportCommon import LAST_QUESTION_ID_SQL, NEW_QUESTIONS_SQL, PENDING_QUESTIONS_SQL
+
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
 # Configuration
 bot_token = os.getenv('TASK_BOT_TOKEN')
 chat_id = os.getenv('TASK_CHAT_ID')
+# Сколько неотправленных заявок обрабатывать за один запуск
+BATCH_SIZE = int(os.getenv('TASK_BATCH_SIZE', 50))
+# Режим --daemon: интервал опроса растёт от MIN до MAX (секунды), пока новых заявок нет
+POLL_MIN = float(os.getenv('TASK_POLL_MIN', 1))
+POLL_MAX = float(os.getenv('TASK_POLL_MAX', 5))
+# Как часто перепроверять все неотправленные заявки на сегодня (неудачные отправки, заявки на завтра)
+SWEEP_INTERVAL = float(os.getenv('TASK_SWEEP_INTERVAL', 300))
+# Пауза перед переподключением к базе растёт вдвое после каждой ошибки, но не больше (секунды)
+RECONNECT_MAX = float(os.getenv('TASK_RECONNECT_MAX', 60))
+# Лимит Telegram для группы — около 20 сообщений в минуту
+GROUP_RATE = float(os.getenv('TASK_GROUP_RATE_PER_MIN', 20)) / 60
+GROUP_BURST = int(os.getenv('TASK_GROUP_BURST', 3))
+# Попыток на одно сообщение
+SEND_ATTEMPTS = int(os.getenv('TASK_SEND_ATTEMPTS', 5))
+SEND_BACKOFF = float(os.getenv('TASK_SEND_BACKOFF', 1))
+SEND_BACKOFF_MAX = float(os.getenv('TASK_SEND_BACKOFF_MAX', 60))
+# 429 не тратят попытки; сколько всего ждать по retry_after на одно сообщение (секунды)
+SEND_RATE_WAIT_MAX = float(os.getenv('TASK_SEND_RATE_WAIT_MAX', 600))
+# Если заявок в пачке больше порога, они уходят сводками вместо отдельных сообщений (0 — никогда)
+DIGEST_THRESHOLD = int(os.getenv('TASK_DIGEST_THRESHOLD', 5))
+# Лимит Telegram — 4096 символов в сообщении, оставляем запас
+DIGEST_MAX_LENGTH = 4000
 
 
 database_config = {
@@ -60,25 +88,22 @@ def create_button(current_date):
     return(markup.add(button))
 
 
-def get_latest_question(conn):
-    query = '''
-        SELECT q.created, e.`name` AS created_employee, q.reason, s.agreement,
-               CONCAT('г.', c.name, ', ', st.name, ', д.', h.`name`, ', под.', s.entrance, ', эт.', s.floor, ', кв.', s.apartment) AS addr,
-               q.phone, q.`comment`, q.dest_time, re.name AS responsible_employee, e.telegram_id, q.is_sent_tg, q.id
-        FROM questions_full q
-        JOIN clients s ON q.agreement = s.id
-        JOIN addr_houses h ON h.id = s.house
-        JOIN addr_streets st ON st.id = h.street
-        JOIN addr_cities c ON c.id = st.city
-        LEFT JOIN employees e ON e.id = q.created_employee
-        LEFT JOIN employees re ON re.id = q.responsible_employee
-        WHERE CAST(q.dest_time AS date) = CAST(NOW() AS date)
-        ORDER BY q.created DESC
-        LIMIT 1
-    '''
+def get_pending_questions(conn, limit=BATCH_SIZE):
+    """Неотправленные заявки на сегодня, от старых к новым, не больше limit."""
+    with conn.cursor() as cursor:
+        cursor.execute(PENDING_QUESTIONS_SQL, (limit,))
+        return cursor.fetchall()
+
+def get_new_questions(conn, after_id, limit=BATCH_SIZE):
+    """Неотправленные заявки на сегодня с id больше after_id: диапазон по первичному ключу."""
+    with conn.cursor() as cursor:
+        cursor.execute(NEW_QUESTIONS_SQL, (after_id, limit))
+        return cursor.fetchall()
+
+def get_last_question_id(conn):
     with conn.cursor() as cursor:
-        cursor.execute(query)
-        return cursor.fetchone()
+        cursor.execute(LAST_QUESTION_ID_SQL)
+        return cursor.fetchone()[0]
 
 def format_message(data):
     agreement_number = data[3]
@@ -105,34 +130,232 @@ def format_message(data):
     )
 
 
-def send_telegram_message(bot, chat_id, message, button):
-    try:
-        bot.send_message(chat_id, message, reply_markup=button, parse_mode='HTML')
-        print("Message sent successfully!")
-    except Exception as e:
-        print(f"An error occurred while sending the photo: {e}")
+def format_digest_line(data):
+    """Одна строка сводки: время, причина, договор, адрес, время выезда и исполнитель."""
+    agreement_link = f'https://localhost/abonents/detail?agreement={data[3]}'
+    address = data[4] if data[4] is None or len(data[4]) <= 80 else data[4][:79] + '…'
+    line = (
+        f"{get_html_symbol(data[2])} <b>{data[0].strftime('%H:%M')}</b> {data[2]} "
+        f"<a href='{agreement_link}'>{data[3]}</a>, {address}, 🕒 {data[7].strftime('%H:%M')}"
+    )
+    if data[8] is not None:
+        line += f", {data[8]}"
+    return line
+
+
+def build_digests(questions, max_length=DIGEST_MAX_LENGTH):
+    """Делит заявки на сводки не длиннее max_length; возвращает [(текст, заявки)]."""
+    groups = []
+    lines, group, length = [], [], 0
+    for data in questions:
+        line = format_digest_line(data)
+        if group and length + len(line) + 1 > max_length - 64:     # 64 — запас под заголовок
+            groups.append((lines, group))
+            lines, group, length = [], [], 0
+        lines.append(line)
+        group.append(data)
+        length += len(line) + 1
+
+    if group:
+        groups.append((lines, group))
+
+    digests = []
+    for number, (lines, group) in enumerate(groups, 1):
+        part = f" ({number}/{len(groups)})" if len(groups) > 1 else ''
+        header = f"<b>Новые заявки: {len(group)}</b>{part}\n\n"
+        digests.append((header + "\n".join(lines), group))
+    return digests
+
+
+def prepare_messages(questions):
+    """[(текст, кнопка, id заявок)]: по сообщению на заявку или сводки при всплеске."""
+    if DIGEST_THRESHOLD and len(questions) > DIGEST_THRESHOLD:
+        return [
+            (text, create_button(group[0][7]), [data[11] for data in group])
+            for text, group in build_digests(questions)
+        ]
+    return [(format_message(data), create_button(data[7]), [data[11]]) for data in questions]
+
+
+class GroupSender:
+    """
+    Отправка заявок в чат группы по одной, в порядке создания, в пределах лимита чата.
+    На 429 отправка ждёт retry_after, сетевые ошибки и 5xx повторяются с растущей паузой,
+    остальные ошибки API (например, неверный HTML) не повторяются.
+    """
 
-def update_question_status(conn, question_id):
+    def __init__(self, bot, chat_id, rate=GROUP_RATE, burst=GROUP_BURST, attempts=SEND_ATTEMPTS,
+                 backoff=SEND_BACKOFF, backoff_max=SEND_BACKOFF_MAX, rate_wait_max=SEND_RATE_WAIT_MAX):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.rate = rate
+        self.burst = burst
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.rate_wait_max = rate_wait_max
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _wait_turn(self):
+        """Ждёт свободный токен и конец паузы после 429."""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if delay <= 0:
+                self._tokens -= 1
+                return
+            time.sleep(delay)
+
+    def _block(self, retry_after: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def send(self, message, button) -> bool:
+        """True — Telegram подтвердил доставку."""
+        attempt = 0
+        rate_waited = 0.0
+        while attempt < self.attempts:
+            self._wait_turn()
+            try:
+                self.bot.send_message(self.chat_id, message, reply_markup=button, parse_mode='HTML')
+                return True
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    rate_waited += retry_after
+                    if rate_waited > self.rate_wait_max:
+                        print(f"Giving up: rate-limited for {rate_waited:.0f}s")
+                        return False
+                    print(f"Telegram 429, retry after {retry_after}s")
+                    self._block(retry_after)
+                    continue
+                if e.error_code < 500:
+                    print(f"Message rejected by Telegram: {e}")
+                    return False
+                error = e
+            except (requests.RequestException, telebot.apihelper.ApiException) as e:
+                error = e
+            attempt += 1
+            if attempt < self.attempts:
+                delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+                print(f"Send failed ({error}), attempt {attempt}/{self.attempts}, retry in {delay:.1f}s")
+                time.sleep(delay)
+        print(f"Giving up after {self.attempts} attempts")
+        return False
+
+    def send_messages(self, messages) -> list:
+        """
+        Отправляет сообщения из prepare_messages() по очереди, чтобы в чате они шли в порядке
+        создания заявок; возвращает id заявок из подтверждённых сообщений.
+        """
+        return [question_id for message, button, ids in messages if self.send(message, button)
+                for question_id in ids]
+
+
+sender = GroupSender(bot, chat_id)
+# Доставленные заявки, которые не удалось пометить в базе: повторно не отправляются
+unmarked = set()
+
+def update_questions_status(conn, question_ids) -> bool:
+    """Помечает заявки отправленными одним запросом."""
+    if not question_ids:
+        return True
+    placeholders = ', '.join(['%s'] * len(question_ids))
     try:
         with conn.cursor() as cursor:
-            cursor.execute(f"UPDATE questions SET is_sent_tg='YES' WHERE id={question_id}")
+            cursor.execute(f"UPDATE questions SET is_sent_tg='YES' WHERE id IN ({placeholders})", list(question_ids))
         conn.commit()
-        print(f"Record with id={question_id} updated successfully.")
+        print(f"Records updated successfully: {len(question_ids)}.")
+        return True
     except Exception as e:
         print(f"An error occurred during UPDATE: {e}")
+        return False
+
+def send_questions(conn, questions):
+    """Отправляет заявки и помечает отправленными только подтверждённые Telegram; возвращает их id."""
+    questions = [data for data in questions if data[11] not in unmarked]
+    sent = sender.send_messages(prepare_messages(questions))
+    print(f"Sent {len(sent)} of {len(questions)} questions")
+    unmarked.update(sent)
+    if update_questions_status(conn, sorted(unmarked)):
+        unmarked.clear()
+    return sent
+
+def sweep(conn):
+    questions = get_pending_questions(conn)
+    print(f"Pending questions: {len(questions)}")
+    send_questions(conn, questions)
+
+def watch():
+    """
+    Постоянный режим: одно соединение с базой и отметка последнего просмотренного id.
+    Новые заявки ищутся по q.id > отметки; раз в SWEEP_INTERVAL и при смене дня
+    перепроверяются все неотправленные заявки на сегодня. Если база недоступна
+    (в том числе при запуске), соединение открывается заново с растущей паузой.
+    """
+    conn = None
+    last_id = None
+    next_sweep = 0.0
+    today = None
+    interval = POLL_MIN
+    failures = 0
+
+    try:
+        while True:
+            try:
+                if conn is None:
+                    conn = pymysql.connect(**database_config, autocommit=True)
+                if last_id is None:
+                    last_id = get_last_question_id(conn)
+                    print(f"Watching questions after id={last_id}")
+
+                if time.monotonic() >= next_sweep or datetime.now().date() != today:
+                    sweep(conn)
+                    next_sweep = time.monotonic() + SWEEP_INTERVAL
+                    today = datetime.now().date()
+
+                questions = get_new_questions(conn, last_id)
+                failures = 0
+                if questions:
+                    last_id = questions[-1][11]
+                    send_questions(conn, questions)
+                    interval = POLL_MIN
+                    if len(questions) == BATCH_SIZE:
+                        continue        # заявок больше, чем в одной пачке — сразу за следующей
+                else:
+                    interval = min(interval * 2, POLL_MAX)
+            except pymysql.MySQLError as e:
+                # После обрыва бывает не только OperationalError, но и InterfaceError (0, '')
+                failures += 1
+                interval = min(POLL_MIN * 2 ** failures, RECONNECT_MAX)
+                print(f"Database error: {e}, reconnecting in {interval:.0f}s")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except pymysql.MySQLError:
+                        pass
+                    conn = None
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if conn is not None:
+            conn.close()
 
 def main():
-    t = datetime.now().strftime("%m/%d/%Y, %H:%M")
+    parser = argparse.ArgumentParser(description="Уведомления о новых заявках в Telegram")
+    parser.add_argument('--daemon', action='store_true', help="работать постоянно вместо одного запуска из cron")
+    args = parser.parse_args()
+
+    if args.daemon:
+        watch()
+        return
 
     with pymysql.connect(**database_config) as conn:
-        data = get_latest_question(conn)
-        print(format_date(data[7]))
-
-        if data and data[10] == 'NO':  # Check if is_sent_tg is 'NO'
-            message = format_message(data)
-            button = create_button(data[7]) 
-            send_telegram_message(bot, chat_id, message, button)
-            update_question_status(conn, data[11])
+        sweep(conn)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import os
+import re
+import subprocess
+import tarfile
+
+from Backup import (
+    BACKUP_DIR,
+    COMPRESS_COMMAND,
+    DECRYPT_COMMAND,
+    SITE_MANIFEST_MEMBER,
+    SITE_SUFFIX,
+    ZIP_PASSWORD,
+    file_sha256,
+)
+
+# Восстановление папки сайта на любой момент из полного и инкрементальных архивов Backup.py.
+#
+#   python RestoreBackup.py list                                  # какие точки восстановления есть
+#   python RestoreBackup.py site --to /tmp/site                   # последнее состояние
+#   python RestoreBackup.py site --to /tmp/site --at 20240131_030000 --verify
+#
+# Архивы берутся из BACKUP_DIR или из --dir (например, скачанные с mega.nz).
+# Нужен ZIP_PASSWORD в окружении или .env.
+
+SITE_ARCHIVE_RE = re.compile(r'^site_backup_(\d{8}_\d{6})_(full|incr)' + re.escape(SITE_SUFFIX) + '$')
+
+
+def site_archives(directory):
+    """[(дата, вид, путь)] архивов сайта по возрастанию даты."""
+    archives = []
+    for name in os.listdir(directory):
+        match = SITE_ARCHIVE_RE.match(name)
+        if match:
+            archives.append((match.group(1), match.group(2), os.path.join(directory, name)))
+    return sorted(archives)
+
+
+def restore_chain(archives, at=None):
+    """Последний полный архив не позже at и все инкрементальные после него до at включительно."""
+    candidates = [archive for archive in archives if at is None or archive[0] <= at]
+    for i in range(len(candidates) - 1, -1, -1):
+        if candidates[i][1] == 'full':
+            return candidates[i:]
+    return []
+
+
+def check_link(manifest, stamp, kind, base, previous):
+    """Архив должен быть тем, что написано в имени, и продолжать previous из цепочки полного base."""
+    if manifest.get('created') != stamp or manifest.get('kind') != kind:
+        raise SystemExit(f"Манифест архива {stamp} ({manifest.get('created')}, {manifest.get('kind')}) не совпадает с именем")
+    if kind != 'incr':
+        return
+    if manifest.get('full') != base:
+        raise SystemExit(f"Архив {stamp} собран от полного {manifest.get('full')}, а не от {base}")
+    # В архивах, созданных до появления поля previous, проверить пропуск нельзя
+    if 'previous' in manifest and manifest['previous'] != previous:
+        raise SystemExit(f"Цепочка прервана: архив {stamp} продолжает {manifest['previous']}, а перед ним {previous}")
+
+
+def extract_archive(path, target, check=None):
+    """
+    Расшифровывает и распаковывает архив потоком; возвращает его манифест.
+    check(manifest) вызывается до распаковки файлов (манифест — первый элемент архива).
+    """
+    decrypt = subprocess.Popen(
+        DECRYPT_COMMAND + ['-in', path], stdout=subprocess.PIPE,
+        env=dict(os.environ, BACKUP_PASSPHRASE=ZIP_PASSWORD),
+    )
+    decompress = subprocess.Popen([COMPRESS_COMMAND[0], '-dc'], stdin=decrypt.stdout, stdout=subprocess.PIPE)
+    decrypt.stdout.close()
+
+    manifest = None
+    with tarfile.open(fileobj=decompress.stdout, mode='r|') as tar:
+        for member in tar:
+            if member.name == SITE_MANIFEST_MEMBER:
+                manifest = json.load(tar.extractfile(member))
+                if check:
+                    check(manifest)
+                continue
+            # filter='data' не даёт выйти за пределы target через ../ и ссылки
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, target, filter='data')
+            else:
+                tar.extract(member, target)
+    decompress.stdout.close()
+    if decompress.wait() != 0 or decrypt.wait() != 0:
+        raise SystemExit(f"Не удалось расшифровать или распаковать {path}")
+    if manifest is None:
+        raise SystemExit(f"В архиве {path} нет манифеста")
+    return manifest
+
+
+def remove_deleted(target, files):
+    """Удаляет файлы, которых нет в манифесте, и опустевшие после этого папки."""
+    removed = 0
+    for root, dirs, names in os.walk(target, topdown=False):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, target) not in files:
+                os.remove(path)
+                removed += 1
+        if root != target and not os.listdir(root):
+            os.rmdir(root)
+    return removed
+
+
+def verify(target, files):
+    mismatches = 0
+    for path, (size, _, sha256) in files.items():
+        full_path = os.path.join(target, path)
+        if not os.path.isfile(full_path) or file_sha256(full_path) != sha256:
+            mismatches += 1
+            if mismatches <= 20:
+                print(f"Не совпадает: {path}")
+    print(f"Проверено файлов: {len(files)}, расхождений: {mismatches}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Восстановление сайта из архивов Backup.py")
+    parser.add_argument('--dir', default=BACKUP_DIR, help="папка с архивами")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="показать архивы сайта")
+    site_parser = sub.add_parser('site', help="восстановить папку сайта")
+    site_parser.add_argument('--to', required=True, help="куда восстановить (пустая или новая папка)")
+    site_parser.add_argument('--at', help="момент ГГГГММДД_ЧЧММСС, по умолчанию последний архив")
+    site_parser.add_argument('--verify', action='store_true', help="сверить sha256 файлов с манифестом")
+    args = parser.parse_args()
+
+    archives = site_archives(args.dir)
+    if args.command == 'list':
+        for stamp, kind, path in archives:
+            print(f"{datetime.datetime.strptime(stamp, '%Y%m%d_%H%M%S')}  {kind:<4}  {os.path.getsize(path) / 1024 / 1024:>9.1f} МБ  {path}")
+        return
+
+    if not ZIP_PASSWORD:
+        raise SystemExit("Не задан ZIP_PASSWORD")
+    chain = restore_chain(archives, args.at)
+    if not chain:
+        raise SystemExit("Нет полного архива сайта на этот момент")
+    os.makedirs(args.to, exist_ok=True)
+    if os.listdir(args.to):
+        raise SystemExit(f"Папка {args.to} не пуста")
+
+    base, previous = chain[0][0], None
+    for stamp, kind, path in chain:
+        print(f"Распаковка {kind} {stamp}: {path}")
+        manifest = extract_archive(path, args.to, lambda m: check_link(m, stamp, kind, base, previous))
+        previous = stamp
+    removed = remove_deleted(args.to, manifest['files'])
+    print(f"Восстановлено на {chain[-1][0]}: файлов {len(manifest['files'])}, удалено по манифесту {removed}")
+
+    if args.verify and verify(args.to, manifest['files']):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
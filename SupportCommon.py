@@ -0,0 +1,1067 @@
+import atexit
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import pickle
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import textwrap
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from contextvars import ContextVar
+from datetime import datetime
+
+from dotenv import load_dotenv
+from telebot import types
+
+try:
+    # Ширина эмодзи и CJK в моноширинном шрифте — так же считает tabulate, если wcwidth установлен
+    from wcwidth import wcswidth
+except ImportError:
+    wcswidth = None
+
+# Общее для SupportHappy.py и SupportHappyAsync.py: настройки, SQL-запросы, рендер экранов,
+# меню, очередь заявок и хранилища состояний; здесь же запросы NewTask.py. Импорт модуля ничего не запускает — не создаёт
+# бота, не открывает файлов и не стартует потоков, — поэтому его же импортируют служебные
+# скрипты (MigratePhones.py, LoadTest.py, ExplainQueries.py, BenchTables.py).
+
+# =====================================
+#        Загрузка переменных среды
+# =====================================
+load_dotenv()
+
+# =====================================
+#        Общие настройки
+# =====================================
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+URL = os.getenv('VITE_SERVICE_API_URL')
+KEY = os.getenv('VITE_SERVICE_API_KEY')
+
+# Адрес Bot API; переопределяется, чтобы направить бота на FakeTelegram.py
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Лимиты Telegram на отправку: ~1 сообщение/с в один чат и ~30 сообщений/с на бота
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', 1))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+
+# Размер пула и ограничения времени жизни соединений (в секундах)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))
+
+
+# =====================================
+#             Логирование
+# =====================================
+# Обработчики только кладут записи в очередь, в файл пишет фоновый поток (QueueListener),
+# поэтому запись лога, ротация и сжатие не задерживают ответ пользователю.
+LOG_FILE = os.getenv('LOG_FILE', '/tmp/SupportBot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# text — прежний формат «время - уровень - сообщение», json — одна запись JSON на строку
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# Ротация по размеру (байты); 0 — ротация по времени LOG_ROTATE_WHEN (midnight, H, D, W0...)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+# Сколько сжатых (.gz) архивов лога хранить
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 14))
+# Доля записываемых частых INFO-событий (нажатия кнопок и т.п.), 1 — писать все
+LOG_INFO_SAMPLE = float(os.getenv('LOG_INFO_SAMPLE', 1.0))
+
+# Частые INFO-события помечаются extra=LOG_SAMPLED и попадают в лог с вероятностью LOG_INFO_SAMPLE
+LOG_SAMPLED = {'sampled': True}
+
+# chat_id и имя выполняющегося обработчика, их проставляет instrumented()
+log_chat_id = ContextVar('log_chat_id', default=None)
+log_handler = ContextVar('log_handler', default=None)
+
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи chat_id и handler обработчика, который пишет в лог."""
+
+    def filter(self, record):
+        record.chat_id = log_chat_id.get()
+        record.handler = log_handler.get()
+        return True
+
+
+class LogSamplingFilter(logging.Filter):
+    """Прореживает помеченные INFO-записи; предупреждения и ошибки проходят всегда."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno > logging.INFO or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    В отличие от стандартного QueueHandler не склеивает traceback с сообщением:
+    он остаётся в exc_text и попадает в отдельное поле JSON.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'chat_id', None) is not None:
+            entry['chat_id'] = record.chat_id
+        if getattr(record, 'handler', None):
+            entry['handler'] = record.handler
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _gzip_rotator(source: str, dest: str):
+    """Сжимает отротированный файл; выполняется в потоке QueueListener."""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    if LOG_MAX_BYTES:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding='utf-8'
+        )
+    file_handler.namer = lambda name: name + '.gz'
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(
+        JsonLogFormatter() if LOG_FORMAT == 'json'
+        else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    )
+
+    # Фильтры стоят на QueueHandler: они выполняются в потоке обработчика, где известен его контекст
+    queue_handler = LogQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(LogSamplingFilter(LOG_INFO_SAMPLE))
+    queue_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    # Дописать оставшиеся в очереди записи при выходе
+    atexit.register(listener.stop)
+    return listener
+
+
+# =====================================
+#        Кэш абонентов
+# =====================================
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', 600))
+# Готовые тексты экранов «Баланс» и «Платежі»; размер ограничен числом записей,
+# а сам текст — лимитом Telegram в 4096 символов
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 5000))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 60))
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()   # ключ -> (истекает, значение)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expires, value) in self._data.items() if expires > now]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+# Договор, привязанный к чату. К одному чату может быть привязано несколько договоров
+ClientIdentity = namedtuple('ClientIdentity', ['client_id', 'agreement', 'phone', 'name'])
+
+# telegram_chat_id -> tuple[ClientIdentity]; пустой кортеж — чат ни к чему не привязан
+identity_cache = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+# (telegram_chat_id, экран) -> отрендеренный текст ответа
+SCREEN_BALANCE = 'balance'
+SCREEN_PAYMENTS = 'payments'
+SCREENS = (SCREEN_BALANCE, SCREEN_PAYMENTS)
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def invalidate_screens(chat_id: int, screens=SCREENS):
+    """Сбрасывает закэшированные экраны чата."""
+    for screen in screens:
+        response_cache.invalidate((chat_id, screen))
+
+def invalidate_client_screens(client_id: int, screens=SCREENS):
+    """Сбрасывает экраны всех чатов, к которым привязан договор, — после платежа или изменения баланса."""
+    for chat_id, identity in identity_cache.items():
+        if any(client.client_id == client_id for client in identity):
+            invalidate_screens(chat_id, screens)
+
+def forget_chat(chat_id: int):
+    identity_cache.invalidate(chat_id)
+    invalidate_screens(chat_id)
+
+
+def client_ids(identity: tuple) -> tuple:
+    return tuple(client.client_id for client in identity)
+
+
+# =====================================
+#        SQL-запросы
+# =====================================
+# Общие для SupportHappy.py и SupportHappyAsync.py
+# Поиск по индексу client_contacts.phone_norm (см. MigratePhones.py)
+USER_BY_PHONE_SQL = '''
+    SELECT c.id, c.agreement, cp.value phone, c.telegram_chat_id
+    FROM client_contacts cp
+    JOIN clients c ON c.id = cp.agreement_id
+    WHERE cp.phone_norm = %s
+      AND cp.type = 'PHONE'
+      AND cp.main = 1
+'''
+
+BIND_TELEGRAM_SQL = '''
+    UPDATE clients
+    SET telegram_chat_id=%s
+    WHERE id IN %s
+'''
+
+IDENTITY_SQL = '''
+    SELECT c.id, c.agreement, cp.value phone, c.name
+    FROM clients c
+    LEFT JOIN client_contacts cp
+        ON cp.agreement_id = c.id
+        AND cp.main = 1
+        AND cp.type = 'PHONE'
+    WHERE c.telegram_chat_id=%s
+'''
+
+BILL_SQL = '''
+    SELECT
+        c.agreement,
+        c.balance,
+        REPLACE(GROUP_CONCAT(DISTINCT bill_prices.name ORDER BY bill_prices.name SEPARATOR ', '), ' ', '\n') AS tariff,
+        CONCAT(
+            REPLACE(ac.name, ' ', '\n'), ', ',
+            REPLACE(s.name, ' ', '\n'), ', ',
+            REPLACE(ah.name, ' ', '\n'), ', кв. ',
+            REPLACE(c.apartment, ' ', '\n')
+        ) AS address
+    FROM clients c
+    JOIN addr_houses ah ON ah.id = c.house
+    JOIN addr_streets s ON s.id = ah.street
+    JOIN addr_cities ac ON ac.id = s.city
+    JOIN client_prices ON client_prices.agreement = c.id AND client_prices.time_stop IS NULL
+    JOIN bill_prices ON bill_prices.id = client_prices.price
+    WHERE c.id IN %s
+    GROUP BY c.agreement, c.balance, address
+    ORDER BY client_prices.id DESC
+    LIMIT 10;
+'''
+
+PAYMENTS_SQL = '''
+    SELECT
+        p.id,
+        c.agreement,
+        p.money,
+        CAST(time AS DATE) time,
+        p.payment_type
+    FROM paymants p
+    JOIN clients c ON p.agreement = c.id
+    WHERE p.agreement IN %s
+    ORDER BY time DESC
+    LIMIT 24;
+'''
+
+
+# =====================================
+#        SQL-запросы NewTask.py
+# =====================================
+# Здесь, а не в NewTask.py, чтобы ExplainQueries.py проверял их без токена бота заявок
+QUESTIONS_SQL = '''
+    SELECT q.created, e.`name` AS created_employee, q.reason, s.agreement,
+           CONCAT('г.', c.name, ', ', st.name, ', д.', h.`name`, ', под.', s.entrance, ', эт.', s.floor, ', кв.', s.apartment) AS addr,
+           q.phone, q.`comment`, q.dest_time, re.name AS responsible_employee, e.telegram_id, q.is_sent_tg, q.id
+    FROM questions_full q
+    JOIN clients s ON q.agreement = s.id
+    JOIN addr_houses h ON h.id = s.house
+    JOIN addr_streets st ON st.id = h.street
+    JOIN addr_cities c ON c.id = st.city
+    LEFT JOIN employees e ON e.id = q.created_employee
+    LEFT JOIN employees re ON re.id = q.responsible_employee
+'''
+# Полуоткрытый диапазон по самой колонке, чтобы работал индекс (см. MigrateQuestions.py)
+DEST_TODAY_SQL = "q.dest_time >= CURDATE() AND q.dest_time < CURDATE() + INTERVAL 1 DAY"
+
+PENDING_QUESTIONS_SQL = f'''{QUESTIONS_SQL}
+    WHERE q.is_sent_tg = 'NO'
+      AND {DEST_TODAY_SQL}
+    ORDER BY q.created, q.id
+    LIMIT %s
+'''
+
+NEW_QUESTIONS_SQL = f'''{QUESTIONS_SQL}
+    WHERE q.id > %s
+      AND q.is_sent_tg = 'NO'
+      AND {DEST_TODAY_SQL}
+    ORDER BY q.id
+    LIMIT %s
+'''
+
+LAST_QUESTION_ID_SQL = "SELECT COALESCE(MAX(id), 0) FROM questions"
+
+
+# =====================================
+#     Ограничение скорости отправки
+# =====================================
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд осталось до появления целого токена."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+# =====================================
+#        Вспомогательные функции
+# =====================================
+def sanitize_input(input_text: str) -> str:
+    return re.sub(r"[<>'\";]", "", input_text)
+
+# Номер без кода страны: для Украины это последние 9 цифр (+380 50 123 45 67 -> 501234567)
+PHONE_SUFFIX_LEN = 9
+
+def normalize_phone(phone: str) -> str:
+    # Должно совпадать с выражением колонки client_contacts.phone_norm в MigratePhones.py
+    return re.sub(r"[^0-9]", "", phone or "")[-PHONE_SUFFIX_LEN:]
+
+
+# =====================================
+#        Менюшки
+# =====================================
+
+def get_phone_keyboard() -> types.ReplyKeyboardMarkup:
+    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+    button = types.KeyboardButton("📞 Надіслати номер телефону", request_contact=True)
+    keyboard.add(button)
+    return keyboard
+
+MAIN_MENU_TEXTS = ("💳 Баланс", "💯 Платежі", "💰 Оплата", "👤 Кабінет", "📞 Підтримка")
+BACK_TO_MENU_TEXT = "↩️ Повернутись до головного меню"
+
+def get_main_menu() -> types.ReplyKeyboardMarkup:
+    menu = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
+    menu.add(*[types.KeyboardButton(text) for text in MAIN_MENU_TEXTS])
+    return menu
+
+def get_support_menu() -> types.ReplyKeyboardMarkup:
+    # Клавиатура, которая позволит вернуться в главное меню
+    support_menu = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+    support_menu.add(types.KeyboardButton(BACK_TO_MENU_TEXT))
+    return support_menu
+
+def get_pay_menu() -> types.InlineKeyboardMarkup:
+    menu = types.InlineKeyboardMarkup()
+    menu.add(
+        types.InlineKeyboardButton(
+            '💳 EasyPay',
+            url='https://easypay.ua/ua/catalog/internet/happylink'
+        ),
+        types.InlineKeyboardButton(
+            '🏦 Privat24',
+            url=(
+                'https://next.privat24.ua/payments/form/'
+                '%7B%22token%22%3A%22b9b67f5b-1f2c-47c4-bb1f-be8d48609dc0%22%7D'
+            )
+        ),
+    )
+    menu.add(
+        types.InlineKeyboardButton('📊 Реквізити', callback_data='show_requisites_handler')
+    )
+    return menu
+
+
+# =====================================
+#        Формирование ответов
+# =====================================
+NO_SERVICES_TEXT = "<b>Не має активних послуг</b>. \nБудь ласка, зверніться до підтримки."
+NO_PAYMENTS_TEXT = "Платежі не знайдено. Будь ласка, зверніться до підтримки."
+
+# --- Таблицы для <pre> ---
+# Раньше таблицы строил tabulate(..., tablefmt="grid", maxcolwidths=[...]). GridTable повторяет
+# его вывод байт в байт для наших раскладок (числа, строки, None; без ANSI-кодов), но ширины,
+# переносчики строк и рамки считает один раз при создании. Сравнение и замер: BenchTables.py
+
+# Символы, на которых textwrap/splitlines меняют строку, и пробел в конце
+_WRAP_SLOW_RE = re.compile(r'[\t\n\x0b\x0c\r\x1c-\x1e\x85\u2028\u2029]| $')
+_THOUSANDS_RE = re.compile(r"^(([+-]?[0-9]{1,3})(?:,([0-9]{3}))*)?(?(1)\.[0-9]*|\.[0-9]+)?$")
+
+# Типы ячеек, как у tabulate: колонка получает самый общий тип своих ячеек
+_TYPE_NONE, _TYPE_BOOL, _TYPE_INT, _TYPE_FLOAT, _TYPE_STR = range(5)
+_NUMERIC_TYPES = (_TYPE_INT, _TYPE_FLOAT)
+
+
+def text_width(text: str) -> int:
+    """Ширина строки в колонках моноширинного шрифта."""
+    if wcswidth is None or text.isascii() and text.isprintable():
+        return len(text)
+    return wcswidth(text)
+
+
+def _is_number(value) -> bool:
+    """Число или строка-число (кроме переполнения в inf)."""
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        return False
+    if not isinstance(value, (str, bytes)):
+        return True
+    return number - number == 0 or value.lower() in ('inf', '-inf', 'nan')
+
+
+def _classify(value) -> tuple[int, bool]:
+    """Тип ячейки и признак числа; числа не переносятся и выравниваются вправо."""
+    kind = type(value)
+    if kind is int:
+        return _TYPE_INT, True
+    if kind is float:
+        return _TYPE_FLOAT, True
+    if value is None:
+        return _TYPE_NONE, False
+    if kind is str:
+        if not value:
+            return _TYPE_NONE, False
+        if value == "True" or value == "False":
+            return _TYPE_BOOL, False
+        try:
+            int(value)
+            return _TYPE_INT, True
+        except ValueError:
+            pass
+        number = _is_number(value)
+        if _THOUSANDS_RE.match(value):
+            return (_TYPE_FLOAT if "." in value else _TYPE_INT), number
+        return (_TYPE_FLOAT if number else _TYPE_STR), number
+    if hasattr(value, 'isoformat'):
+        return _TYPE_STR, False
+    if kind is bool:
+        return _TYPE_BOOL, True
+    number = _is_number(value)
+    return (_TYPE_FLOAT if number else _TYPE_STR), number
+
+
+def _after_point(text: str) -> int:
+    """Число знаков после точки для выравнивания по разделителю; -1 — точки нет."""
+    if not (_is_number(text) or _THOUSANDS_RE.match(text)):
+        return -1
+    try:
+        int(text)
+        return -1
+    except ValueError:
+        pass
+    pos = text.rfind(".")
+    pos = text.lower().rfind("e") if pos < 0 else pos
+    return len(text) - pos - 1 if pos >= 0 else -1
+
+
+class _CellWrapper(textwrap.TextWrapper):
+    """textwrap с шириной по text_width: эмодзи занимает две колонки, как в переносах tabulate."""
+
+    def _wrap_chunks(self, chunks):
+        lines = []
+        width = self.width
+        chunks.reverse()
+        while chunks:
+            cur_line = []
+            cur_len = 0
+            if chunks[-1].strip() == "" and lines:
+                del chunks[-1]
+            while chunks:
+                chunk_len = text_width(chunks[-1])
+                if cur_len + chunk_len > width:
+                    break
+                cur_line.append(chunks.pop())
+                cur_len += chunk_len
+
+            # Слово длиннее колонки режется по ширине символов
+            if chunks and text_width(chunks[-1]) > width:
+                space_left = width - cur_len
+                if space_left > 0:
+                    chunk = chunks[-1]
+                    i = 1
+                    while i <= len(chunk) and text_width(chunk[:i]) <= space_left:
+                        i += 1
+                    cur_line.append(chunk[:i - 1])
+                    chunks[-1] = chunk[i - 1:]
+                elif not cur_line:
+                    cur_line.append(chunks.pop())
+                cur_len = sum(map(text_width, cur_line))
+
+            if cur_line and cur_line[-1].strip() == "":
+                del cur_line[-1]
+            if cur_line:
+                lines.append("".join(cur_line))
+        return lines
+
+
+class GridTable:
+    """Таблица tablefmt="grid" с заголовками и ограничением ширины колонок."""
+
+    def __init__(self, headers, maxcolwidths):
+        self.headers = list(headers)
+        self.maxcolwidths = list(maxcolwidths)
+        self.header_widths = [text_width(header) for header in self.headers]
+        self.min_widths = [width + 2 for width in self.header_widths]
+        self.wrappers = [
+            _CellWrapper(width=width) if width else None
+            for width in self.maxcolwidths
+        ]
+
+    def _wrap(self, text: str, wrapper: _CellWrapper) -> str:
+        if text_width(text) <= wrapper.width and text.strip() and not _WRAP_SLOW_RE.search(text):
+            return text
+        return "\n".join(
+            "\n".join(wrapper.wrap(line))
+            for line in text.splitlines()
+            if line.strip() != ""
+        )
+
+    def _cell(self, value, column: int) -> tuple:
+        """Значение ячейки после переноса по ширине колонки и его тип."""
+        cell_type, number = _classify(value)
+        wrapper = self.wrappers[column]
+        if number or wrapper is None:
+            return value, cell_type
+        text = "" if value is None else str(value)
+        wrapped = self._wrap(text, wrapper)
+        if wrapped is not text:
+            cell_type = _classify(wrapped)[0]
+        return wrapped, cell_type
+
+    @staticmethod
+    def _format(value, column_type: int) -> str:
+        if value is None:
+            return ""
+        if column_type == _TYPE_FLOAT and value != "":
+            if isinstance(value, str) and "," in value:
+                value = value.replace(",", "")
+            try:
+                return format(float(value), "g")
+            except (ValueError, TypeError):
+                pass
+        return f"{value}"
+
+    def _column(self, cells: tuple, column: int) -> tuple[list, int, bool]:
+        """Строки ячеек колонки, дополненные пробелами, ширина колонки и выравнивание вправо."""
+        column_type = max(cell_type for _, cell_type in cells)
+        numeric = column_type in _NUMERIC_TYPES
+        texts = [self._format(value, column_type) for value, _ in cells]
+        if column_type == _TYPE_FLOAT:
+            # Дробные числа выравниваются по десятичной точке
+            decimals = [_after_point(text) for text in texts]
+            max_decimals = max(decimals)
+            texts = [text + (max_decimals - dec) * " " for text, dec in zip(texts, decimals)]
+        elif not numeric:
+            texts = [text.strip() for text in texts]
+
+        # Пустая ячейка многострочной таблицы не занимает строк — как у tabulate
+        cells_lines = [text.split("\n") if text else [] for text in texts]
+        widths = [[text_width(line) for line in lines] for lines in cells_lines]
+        width = max(self.min_widths[column], *(max(w, default=0) for w in widths))
+
+        if numeric:
+            padded = [[" " * (width - w) + line for line, w in zip(lines, line_widths)]
+                      for lines, line_widths in zip(cells_lines, widths)]
+        else:
+            padded = [[line + " " * (width - w) for line, w in zip(lines, line_widths)]
+                      for lines, line_widths in zip(cells_lines, widths)]
+        return padded, width, numeric
+
+    def render(self, rows) -> str:
+        rows = [[self._cell(value, i) for i, value in enumerate(row)] for row in rows]
+        if rows:
+            columns = [self._column(cells, i) for i, cells in enumerate(zip(*rows))]
+        else:
+            columns = [([], width, False) for width in self.min_widths]
+        multiline = any(
+            isinstance(value, str) and ("\n" in value or "\r" in value)
+            for row in rows for value, _ in row
+        )
+
+        widths = [width for _, width, _ in columns]
+        border = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+        header = "| " + " | ".join(
+            " " * (width - header_width) + title if numeric else title + " " * (width - header_width)
+            for title, header_width, (_, width, numeric) in zip(self.headers, self.header_widths, columns)
+        ) + " |"
+        lines = [border, header, border.replace("-", "=")]
+        blanks = [" " * width for width in widths]
+        for row_index in range(len(rows)):
+            if row_index:
+                lines.append(border)
+            cells = [padded[row_index] for padded, _, _ in columns]
+            height = max(map(len, cells)) if multiline else 1
+            for line_index in range(height):
+                lines.append("| " + " | ".join(
+                    cell[line_index] if line_index < len(cell) else blank
+                    for cell, blank in zip(cells, blanks)
+                ) + " |")
+        lines.append(border)
+        return "\n".join(lines)
+
+BILL_TABLE = GridTable(["Договір #", "Баланс", "Тариф"], maxcolwidths=[8, 12, 15])
+PAYMENTS_TABLE = GridTable(["id", "Договір", "Сума", "Дата"], maxcolwidths=[5, 5, 15, 15])
+
+def render_bill(bill_records) -> str:
+    table = []
+    addresses = []
+
+    for row in bill_records:
+        agreement = row[0]
+        balance = row[1]
+        balance_emoji = "✅" if balance >= 0 else "🔴"
+        formatted_balance = f"{balance_emoji} {balance:.2f}₴"
+
+        table.append([agreement, formatted_balance, row[2]])  # Добавили договор
+        addresses.append(f"#{agreement}: {row[3]}")  # Сохраняем адрес отдельно
+
+    # Создаем таблицу
+    table_text = BILL_TABLE.render(table)
+
+    # Создаем список адресов
+    addresses_text = "\n".join(addresses)
+
+    # Формируем итоговое сообщение
+    return (
+        f"<b>Деталі договорів:</b>\n\n"
+        f"<pre>{table_text}</pre>\n\n"
+        f"<b>Опис:</b>\n{addresses_text}"
+    )
+
+def render_payments(payment_records) -> str:
+    table = []
+    payments_type = []
+
+    for row in payment_records:
+        id = row[0]
+        agreement = row[1]
+        formatted_money = f'{row[2]}₴'
+        formatted_date = row[3].strftime("%Y-%m-%d")
+        payment_type = row[4] if row[4] else "Немає опису"
+        table.append([id, agreement, formatted_money, formatted_date])  # Добавили договор
+        payments_type.append(f"id# {id}: {payment_type}")  # Сохраняем описание отдельно
+
+    # Создаем таблицу
+    table_text = PAYMENTS_TABLE.render(table)
+
+    # Создаем список комментариев
+    comments_text = "\n".join(payments_type)
+
+    # Формируем итоговое сообщение
+    return (
+        f"<b>Останні платежі:</b>\n\n"
+        f"<pre>{table_text}</pre>\n\n"
+        f"<b>Опис:</b>\n{comments_text}"
+    )
+
+# экран -> (запрос по id договоров, рендер, текст при пустом результате)
+SCREEN_QUERIES = {
+    SCREEN_BALANCE: (BILL_SQL, render_bill, NO_SERVICES_TEXT),
+    SCREEN_PAYMENTS: (PAYMENTS_SQL, render_payments, NO_PAYMENTS_TEXT),
+}
+
+
+def get_requisites_text() -> str:
+    data = {
+        "Рекомендована сума для оплати": "[Абонплата] грн/міс",
+        "Отримувач": "ТОВ \"Хеппілінк Україна\"",
+        "IBAN": "UA113052990000026002035033913",
+        "РНОКПП": "45589308",
+        "В АТ КБ": "«ПриватБанк»",
+        "Призначення платежу": "Оплата за інтернет, особовий рахунок № [Ваш рахунок]"
+    }
+    table_text = "\n".join([f"{key}: {value}" for key, value in data.items()])
+    return f"<b>Платіжна інформація:</b>\n\n{table_text}"
+
+def make_support_ticket(user_data, text: str) -> dict:
+    phone, agreement_id, name = user_data
+    now = datetime.now()
+    dt_string = now.strftime("%d.%m.%Y %H:%M:%S")
+    return {
+        "agreement_id": agreement_id,
+        "reason_id": 10,
+        "phone": phone,
+        "destination_time": dt_string,
+        "comment": "\n" + sanitize_input(text)
+    }
+
+def support_api_headers() -> dict:
+    return {
+        'Content-type': 'application/json',
+        'X-Auth-Key': KEY
+    }
+
+
+# =====================================
+#      Очередь заявок в поддержку
+# =====================================
+# Заявка сначала записывается в локальный SQLite-файл, и пользователь сразу получает
+# подтверждение. Фоновые потоки отправляют заявки в сервис по keep-alive соединениям
+# и повторяют неудачные попытки с растущей паузой, так что заявка не теряется,
+# даже если сервис недоступен или бот перезапустился.
+OUTBOX_DB_PATH = os.getenv('OUTBOX_DB_PATH', '/tmp/SupportBotOutbox.sqlite3')
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 2))
+# Сколько заявок поток забирает за раз и на сколько секунд они закрепляются за ним
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 20))
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 120))
+# Пауза перед повтором: OUTBOX_BACKOFF * 2^попытка, но не больше OUTBOX_BACKOFF_MAX
+OUTBOX_BACKOFF = float(os.getenv('OUTBOX_BACKOFF', 2))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', 600))
+SUPPORT_API_TIMEOUT = float(os.getenv('SUPPORT_API_TIMEOUT', 15))
+
+Ticket = namedtuple('Ticket', ['id', 'key', 'body', 'attempts'])
+
+
+class TicketOutbox:
+    """
+    Заявки, ожидающие отправки в сервис поддержки.
+
+    У каждой заявки свой ключ идемпотентности: он передаётся в заголовке
+    Idempotency-Key при каждой попытке, чтобы повтор после обрыва связи
+    не создал вторую заявку. Забранные заявки закрепляются за потоком на
+    время lease; если поток упал, их заберёт другой, когда lease истечёт.
+    Заявки, которые сервис отверг (4xx), остаются в файле со статусом failed.
+    """
+
+    def __init__(self, path: str, lease: float, backoff: float, backoff_max: float):
+        self.path = path
+        self.lease = lease
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.added = threading.Event()
+        self._local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS tickets ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, chat_id INTEGER, '
+            'body TEXT NOT NULL, created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+            "next_attempt REAL NOT NULL, status TEXT NOT NULL DEFAULT 'pending', last_error TEXT)"
+        )
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS tickets_due ON tickets (status, next_attempt)'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # FULL: подтверждение пользователю уходит только после записи на диск
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+        return connection
+
+    def add(self, chat_id: int, body: dict) -> str:
+        key = uuid.uuid4().hex
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO tickets (key, chat_id, body, created, next_attempt) VALUES (?, ?, ?, ?, ?)',
+            (key, chat_id, json.dumps(body, ensure_ascii=False), now, now)
+        )
+        self.added.set()
+        return key
+
+    def claim(self, limit: int) -> list[Ticket]:
+        """Забирает до limit готовых к отправке заявок в порядке поступления."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                "SELECT id, key, body, attempts FROM tickets "
+                "WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            connection.executemany(
+                'UPDATE tickets SET next_attempt = ? WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows]
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return [Ticket(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def next_delay(self, limit: float) -> float:
+        """Через сколько секунд наступит ближайшая попытка, но не больше limit."""
+        due = self._connection().execute(
+            "SELECT MIN(next_attempt) FROM tickets WHERE status = 'pending'"
+        ).fetchone()[0]
+        return limit if due is None else min(limit, max(0.0, due - time.time()))
+
+    def release(self, tickets: list[Ticket]):
+        """Возвращает неотправленные заявки в очередь без ожидания lease."""
+        self._connection().executemany(
+            'UPDATE tickets SET next_attempt = ? WHERE id = ?',
+            [(time.time(), ticket.id) for ticket in tickets]
+        )
+
+    def retry_delay(self, attempts: int, retry_after=None) -> float:
+        """Экспоненциальная пауза со случайным разбросом, чтобы повторы не шли пачкой."""
+        delay = min(self.backoff_max, self.backoff * 2 ** attempts) * random.uniform(0.5, 1.0)
+        try:
+            return max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            return delay
+
+    def complete(self, ticket: Ticket, status: int | None, error: str = '', retry_after=None) -> str:
+        """
+        Записывает результат попытки отправки: status — HTTP-код ответа
+        или None, если ответа не было. Возвращает 'delivered', 'retry' или 'failed'.
+        """
+        connection = self._connection()
+        if status is not None and 200 <= status < 300:
+            connection.execute('DELETE FROM tickets WHERE id = ?', (ticket.id,))
+            return 'delivered'
+        if status is None or status in (408, 425, 429) or status >= 500:
+            delay = self.retry_delay(ticket.attempts, retry_after)
+            connection.execute(
+                'UPDATE tickets SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?',
+                (time.time() + delay, error, ticket.id)
+            )
+            logging.warning(
+                f"Заявка {ticket.key} не отправлена (попытка {ticket.attempts + 1}, {status or error}), "
+                f"повтор через {delay:.0f} с"
+            )
+            return 'retry'
+        connection.execute(
+            "UPDATE tickets SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+            (error, ticket.id)
+        )
+        logging.error(f"Сервис отклонил заявку {ticket.key} ({status}): {ticket.body}")
+        return 'failed'
+
+    def stats(self) -> dict:
+        counts = dict(self._connection().execute(
+            'SELECT status, COUNT(*) FROM tickets GROUP BY status'
+        ).fetchall())
+        oldest = self._connection().execute(
+            "SELECT MIN(created) FROM tickets WHERE status = 'pending'"
+        ).fetchone()[0]
+        return {
+            'pending': counts.get('pending', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_age': round(time.time() - oldest, 1) if oldest else 0.0,
+        }
+
+
+# =====================================
+#  Логика состояний; для поддержки
+# =====================================
+# memory — состояние живёт в процессе; sqlite — общий файл для нескольких процессов
+# бота на одном сервере, переживает перезапуск
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', '/tmp/SupportBotState.sqlite3')
+# Через сколько секунд забывается незавершённый диалог
+STATE_TTL = float(os.getenv('STATE_TTL', 86400))
+
+
+class MemoryStateStore:
+    """Хранилище состояний в памяти процесса с временем жизни записей."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = {}   # ключ -> (истекает, значение)
+        self._lock = threading.Lock()
+        self._purged = time.monotonic()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                return default
+            return item[1]
+
+    def set(self, key: str, value, ttl: float | None = None):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + (ttl or self.ttl), value)
+            if now - self._purged > 60:
+                self._data = {k: item for k, item in self._data.items() if item[0] > now}
+                self._purged = now
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop(self, key: str, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= time.monotonic():
+                return default
+            return item[1]
+
+
+class SQLiteStateStore:
+    """
+    Хранилище состояний в SQLite-файле.
+
+    Значения сериализуются pickle, у каждой записи своё время истечения.
+    Соединения открываются по одному на поток, журнал WAL позволяет
+    нескольким процессам читать и писать одновременно.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._purged = 0.0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+        )
+        self._connection().execute('CREATE INDEX IF NOT EXISTS state_expires ON state (expires)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, default=None):
+        row = self._connection().execute(
+            'SELECT value FROM state WHERE key = ? AND expires > ?', (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, key: str, value, ttl: float | None = None):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value), now + (ttl or self.ttl))
+        )
+        if now - self._purged > 60:
+            connection.execute('DELETE FROM state WHERE expires <= ?', (now,))
+            self._purged = now
+
+    def delete(self, key: str):
+        self._connection().execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def pop(self, key: str, default=None):
+        """Читает и удаляет запись в одной транзакции: значение достанется только одному процессу."""
+        connection = self._connection()
+        # pop вызывается на каждое обновление, а запись есть редко: без неё обходимся
+        # чтением в WAL, не захватывая блокировку записи общего файла
+        if not connection.execute('SELECT 1 FROM state WHERE key = ?', (key,)).fetchone():
+            return default
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value, expires FROM state WHERE key = ?', (key,)
+            ).fetchone()
+            if row:
+                connection.execute('DELETE FROM state WHERE key = ?', (key,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return pickle.loads(row[0]) if row and row[1] > time.time() else default
+
+
+def open_state_store():
+    """Хранилище состояний, выбранное STATE_BACKEND."""
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteStateStore(STATE_DB_PATH, STATE_TTL)
+    return MemoryStateStore(STATE_TTL)
+
+def state_key(chat_id: int) -> str:
+    return f"state:{chat_id}"
@@ -1,17 +1,76 @@
+import bisect
+import functools
+import heapq
+import hmac
+import itertools
 import logging
 import os
-import re
+import queue
+import sqlite3
+import threading
 import time
-from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
 
 import pymysql
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from telebot import TeleBot, types, apihelper
-from tabulate import tabulate
-
-
-
+from telebot.handler_backends import HandlerBackend
+
+from SupportCommon import (
+    BACK_TO_MENU_TEXT,
+    BIND_TELEGRAM_SQL,
+    BOT_TOKEN,
+    DB_POOL_MAX_IDLE,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    IDENTITY_SQL,
+    LOG_SAMPLED,
+    MAIN_MENU_TEXTS,
+    OUTBOX_BACKOFF,
+    OUTBOX_BACKOFF_MAX,
+    OUTBOX_BATCH,
+    OUTBOX_DB_PATH,
+    OUTBOX_LEASE,
+    OUTBOX_WORKERS,
+    PHONE_SUFFIX_LEN,
+    SCREEN_BALANCE,
+    SCREEN_PAYMENTS,
+    SCREEN_QUERIES,
+    SEND_CHAT_BURST,
+    SEND_CHAT_RATE,
+    SEND_GLOBAL_RATE,
+    SUPPORT_API_TIMEOUT,
+    TELEGRAM_API_URL,
+    URL,
+    USER_BY_PHONE_SQL,
+    ClientIdentity,
+    Ticket,
+    TicketOutbox,
+    TokenBucket,
+    client_ids,
+    forget_chat,
+    get_main_menu,
+    get_pay_menu,
+    get_phone_keyboard,
+    get_requisites_text,
+    get_support_menu,
+    identity_cache,
+    log_chat_id,
+    log_handler,
+    make_support_ticket,
+    normalize_phone,
+    open_state_store,
+    response_cache,
+    setup_logging,
+    state_key,
+    support_api_headers,
+)
 
 
 # Запуск бота
@@ -25,28 +84,517 @@ load_dotenv()
 # =====================================
 #        Глобальные настройки
 # =====================================
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-URL = os.getenv('VITE_SERVICE_API_URL')
-KEY = os.getenv('VITE_SERVICE_API_KEY')
+# Токен, адреса API и лимиты отправки, общие с SupportHappyAsync.py, — в SupportCommon.py
 
-# Время задержки отправки сообщения
-MESSAGE_DELAY_TIME = 1.1
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес вебхука, который регистрируется в Telegram (HTTPS обычно завершает nginx)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
 
+# Потоки, которые отправляют исходящие сообщения
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+
+# Количество потоков-обработчиков входящих обновлений
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 8))
+# Как часто писать в лог загрузку диспетчера (секунды, 0 — не писать)
+BOT_STATS_INTERVAL = float(os.getenv('BOT_STATS_INTERVAL', 300))
+
+
+# =====================================
+#             Логирование
+# =====================================
+# Настройки, фильтры и форматтер логов — в SupportCommon.py
+log_listener = setup_logging()
+
+# =====================================
+#              Метрики
+# =====================================
+# Метрики отдаются в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics
+# (0 — не запускать сервер метрик)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+# Границы корзин гистограмм задержки, секунды
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Metrics:
+    """
+    Счётчики, gauge и гистограммы в текстовом формате Prometheus.
+
+    Кроме собственных метрик отдаёт статистику компонентов бота: функции
+    stats() регистрируются через collect() и опрашиваются при каждом запросе.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}     # имя -> {метки: значение}
+        self._gauges = {}
+        self._histograms = {}   # имя -> {метки: [счётчики корзин..., +Inf, сумма]}
+        self._collectors = []   # (префикс, stats, метки)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def add(self, name: str, delta: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collect(self, prefix: str, stats, counters=(), **labels):
+        """
+        Добавляет числовые поля stats() как метрики prefix_<поле>; списки — по потокам.
+        Поля из counters — накопительные итоги, они отдаются как counter prefix_<поле>_total.
+        """
+        self._collectors.append((prefix, stats, frozenset(counters), tuple(sorted(labels.items()))))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            histograms = {
+                name: {key: list(counts) for key, counts in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name, series in sorted(metrics.items()):
+                lines.append(f'# TYPE {name} {kind}')
+                lines.extend(f'{name}{_label_text(key)} {value}' for key, value in sorted(series.items()))
+
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for name, series in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, counts in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_label_text(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_label_text(key)} {counts[-1]}')
+                lines.append(f'{name}_count{_label_text(key)} {cumulative}')
+
+        # Серии одной метрики от разных компонентов должны идти подряд
+        collected = {}      # имя -> (тип, серии)
+        for prefix, stats, counters, labels in self._collectors:
+            try:
+                values = stats()
+            except Exception as e:
+                logging.error(f"Метрики {prefix}: {e}")
+                continue
+            for field, value in values.items():
+                samples = (
+                    [(labels + (('worker', i),), item) for i, item in enumerate(value)]
+                    if isinstance(value, (list, tuple)) else [(labels, value)]
+                )
+                name, kind = (
+                    (f'{prefix}_{field}_total', 'counter') if field in counters else (f'{prefix}_{field}', 'gauge')
+                )
+                collected.setdefault(name, (kind, []))[1].extend(
+                    (key, sample) for key, sample in samples
+                    if isinstance(sample, (int, float)) and not isinstance(sample, bool)
+                )
+        for name, (kind, samples) in collected.items():
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{_label_text(key)} {sample}' for key, sample in samples)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(METRICS_BUCKETS)
+
+
+def instrumented(handler):
+    """
+    Время выполнения, ошибки и число одновременно выполняющихся вызовов обработчика.
+    Ставится под @bot.message_handler, чтобы бот регистрировал уже обёрнутую функцию.
+    Заодно проставляет chat_id и имя обработчика для записей лога.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        event = args[0] if args else None
+        message = event.message if isinstance(event, types.CallbackQuery) else event
+        chat = getattr(message, 'chat', None)
+        chat_token = log_chat_id.set(chat.id if chat else None)
+        handler_token = log_handler.set(name)
+        metrics.add('bot_handler_in_flight', 1, handler=name)
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+            metrics.add('bot_handler_in_flight', -1, handler=name)
+            log_handler.reset(handler_token)
+            log_chat_id.reset(chat_token)
+
+    return wrapper
+
+
+_telegram_sessions = threading.local()
+
+def telegram_request(method: str, url: str, **kwargs):
+    """Отправляет запрос к Bot API вместо telebot и замеряет его время по методам API."""
+    session = getattr(_telegram_sessions, 'session', None)
+    if session is None:
+        session = _telegram_sessions.session = requests.Session()
+    api_method = url.rsplit('/', 1)[-1]
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.inc('bot_telegram_errors_total', method=api_method, code='network')
+        raise
+    finally:
+        metrics.observe('bot_telegram_seconds', time.perf_counter() - started, method=api_method)
+    if response.status_code != 200:
+        metrics.inc('bot_telegram_errors_total', method=api_method, code=response.status_code)
+    return response
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_metrics_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Метрики: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+# =====================================
+#        Диспетчер обновлений
+# =====================================
+def update_chat_key(update: types.Update) -> int | None:
+    """Чат, к которому относится обновление; обновления одного чата обрабатываются по порядку."""
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for event in (update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event:
+            return event.chat.id
+    return None
+
+
+class UpdateDispatcher:
+    """
+    Пул потоков для обработки обновлений.
+
+    Разные чаты обрабатываются параллельно, а обновления одного чата — строго
+    по очереди, иначе register_next_step_handler и user_state увидят
+    сообщения пользователя не в том порядке.
+    """
+
+    def __init__(self, process, workers: int, stats_interval: float = 0):
+        self._process = process
+        self.workers = workers
+        self.stats_interval = stats_interval
+
+        self._lock = threading.Lock()
+        self._pending = {}                  # ключ чата -> deque ещё не обработанных обновлений
+        self._ready = queue.SimpleQueue()   # ключи чатов, которые можно брать в работу
+        self._depth = 0
+        self._busy = [0.0] * workers
+        self._handled = [0] * workers
+        self._threads = []
+        self._started = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._started = time.monotonic()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(i,), name=f"dispatcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.stats_interval:
+            threading.Thread(target=self._report, name="dispatcher-stats", daemon=True).start()
+
+    def stop(self, timeout: float | None = None):
+        self._stopped.set()
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, update: types.Update):
+        key = update_chat_key(update)
+        if key is None:
+            key = ('update', update.update_id)
+        with self._lock:
+            self._depth += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                # Чат уже в очереди или в работе — обновление дождётся своей очереди
+                pending.append(update)
+                return
+            self._pending[key] = deque([update])
+        self._ready.put(key)
+
+    def _worker(self, index: int):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                update = self._pending[key][0]
+
+            started = time.monotonic()
+            try:
+                self._process([update])
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            self._busy[index] += time.monotonic() - started
+            self._handled[index] += 1
+
+            with self._lock:
+                pending = self._pending[key]
+                pending.popleft()
+                self._depth -= 1
+                if not pending:
+                    del self._pending[key]
+                    continue
+            self._ready.put(key)
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - (self._started or time.monotonic()), 1e-9)
+        with self._lock:
+            depth = self._depth
+            chats = len(self._pending)
+        return {
+            'queue_depth': depth,
+            'chats': chats,
+            'handled': list(self._handled),
+            'utilisation': [round(busy / elapsed, 3) for busy in self._busy],
+        }
+
+    def _report(self):
+        while not self._stopped.wait(self.stats_interval):
+            stats = self.stats()
+            logging.info(
+                f"Диспетчер: очередь {stats['queue_depth']}, чатов {stats['chats']}, "
+                f"загрузка потоков {stats['utilisation']}"
+            )
+
+
+class DispatchingTeleBot(TeleBot):
+    """TeleBot, который передаёт полученные обновления в UpdateDispatcher."""
+
+    dispatcher = None
+
+    def process_new_updates(self, updates):
+        if self.dispatcher is None:
+            return super().process_new_updates(updates)
+        for update in updates:
+            # Смещение getUpdates двигаем сразу, не дожидаясь обработки
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatcher.submit(update)
+
+    def handle_updates(self, updates):
+        super().process_new_updates(updates)
 
-# Настройка логирования
-logging.basicConfig(
-    filename='/tmp/SupportBot.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 
 # Инициализация бота
-bot = TeleBot(BOT_TOKEN, threaded=False)
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+apihelper.CUSTOM_REQUEST_SENDER = telegram_request
+bot = DispatchingTeleBot(BOT_TOKEN, threaded=False)
+dispatcher = UpdateDispatcher(bot.handle_updates, workers=BOT_WORKERS, stats_interval=BOT_STATS_INTERVAL)
+metrics.collect('bot_dispatcher', dispatcher.stats, counters=('handled',))
 
 # =====================================
-#        Функции для работы с БД
+#        Пул соединений с БД
 # =====================================
-def get_db_connection():
+class PoolTimeout(pymysql.err.OperationalError):
+    """Свободное соединение не появилось за DB_POOL_TIMEOUT секунд."""
+
+
+class ConnectionPool:
+    """
+    Ограниченный потокобезопасный пул соединений pymysql.
+
+    При выдаче соединение проверяется ping'ом, а слишком долго простаивавшие
+    или слишком старые соединения пересоздаются. При возврате открытая
+    транзакция откатывается, чтобы следующий обработчик не видел старый снимок.
+    """
+
+    def __init__(self, connect, size, timeout, max_idle, max_lifetime):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+
+        self._cond = threading.Condition()
+        self._idle = []       # [(connection, released_at)], берём с конца — самые «тёплые»
+        self._created = {}    # connection -> время создания
+        self._opened = 0
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def _open(self):
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[connection] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        with self._cond:
+            self._created.pop(connection, None)
+            self._opened -= 1
+            self._cond.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        started = time.monotonic()
+        connection = None
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"Нет свободных соединений за {self.timeout} с")
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self.waits += 1
+                self.wait_time += waited
+            self.checkouts += 1
+
+            if self._idle:
+                connection, released_at = self._idle.pop()
+            else:
+                self._opened += 1
+
+        if connection is None:
+            return self._open()
+
+        now = time.monotonic()
+        expired = (
+            now - released_at > self.max_idle
+            or now - self._created.get(connection, now) > self.max_lifetime
+        )
+        if not expired:
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except pymysql.MySQLError:
+                self.reconnects += 1
+
+        # Соединение устарело или оборвалось — меняем на новое, не отдавая слот
+        with self._cond:
+            self._created.pop(connection, None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+        return self._open()
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока with; ошибка подключения — обычный pymysql.MySQLError."""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def release(self, connection):
+        try:
+            connection.rollback()
+        except Exception:
+            self._discard(connection)
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'size': self.size,
+                'opened': self._opened,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': round(self.wait_time, 3),
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+            }
+
+
+def _connect_db():
     return pymysql.connect(
         host=os.getenv('DB_HOST'),
         user=os.getenv('DB_USER'),
@@ -55,69 +603,242 @@ def get_db_connection():
         charset='utf8mb4'
     )
 
+
+db_pool = ConnectionPool(
+    _connect_db,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    max_lifetime=DB_POOL_MAX_LIFETIME,
+)
+metrics.collect(
+    'bot_db_pool', db_pool.stats, counters=('checkouts', 'waits', 'wait_time', 'timeouts', 'reconnects')
+)
+metrics.collect('bot_cache', identity_cache.stats, counters=('hits', 'misses'), cache='identity')
+metrics.collect('bot_cache', response_cache.stats, counters=('hits', 'misses'), cache='response')
+
+
+# =====================================
+#        Функции для работы с БД
+# =====================================
 def get_user_by_phone(phone_number: str, telegram_id: int) -> bool | None:
-    connection = get_db_connection()
+    phone = normalize_phone(phone_number)
+    if len(phone) < PHONE_SUFFIX_LEN:
+        return False
+
     try:
-        with connection.cursor() as cursor:
-            user_exists = cursor.execute(
-                '''
-                SELECT c.id, c.agreement, cp.value phone
-                FROM clients c
-                LEFT JOIN client_contacts cp 
-                    ON cp.agreement_id = c.id
-                    AND cp.main = 1
-                    AND cp.type = 'PHONE'
-                WHERE cp.type = 'PHONE'
-                  AND cp.value LIKE %s
-                LIMIT 1
-                ''',
-                ("%" + phone_number)
-            )
-            if user_exists:
-                cursor.execute(
-                    '''
-                    UPDATE clients
-                    LEFT JOIN client_contacts
-                        ON clients.id = client_contacts.agreement_id
-                        AND client_contacts.main = 1
-                        AND client_contacts.type = 'PHONE'
-                    SET clients.telegram_chat_id=%s
-                    WHERE client_contacts.value LIKE %s
-                    ''',
-                    (telegram_id, "%" + phone_number)
-                )
-                connection.commit()
+        with db_pool.connection() as connection, connection.cursor() as cursor:
+            with metrics.timer('bot_db_query_seconds', query='user_by_phone'):
+                cursor.execute(USER_BY_PHONE_SQL, (phone,))
+                rows = cursor.fetchall()
+            if rows:
+                previous_chats = {row[3] for row in rows if row[3]}
+                with metrics.timer('bot_db_query_seconds', query='bind_telegram'):
+                    cursor.execute(BIND_TELEGRAM_SQL, (telegram_id, tuple(row[0] for row in rows)))
+                    connection.commit()
+                # Договоры перепривязаны: забываем и новый чат, и чаты, которым они принадлежали раньше
+                for chat_id in previous_chats | {telegram_id}:
+                    forget_chat(chat_id)
                 return True
             return False
     except pymysql.MySQLError as e:
+        metrics.inc('bot_db_errors_total', query='user_by_phone')
         logging.error(f"Ошибка базы данных: {e}")
         return None
-    finally:
-        connection.close()
 
-def get_user_by_telegram_id(telegram_id: int):
-    connection = get_db_connection()
+def get_identity(telegram_id: int) -> tuple | None:
+    """Договоры, привязанные к чату; None — ошибка БД."""
+    identity = identity_cache.get(telegram_id)
+    if identity is not None:
+        return identity
+
     try:
-        with connection.cursor() as cursor:
-            cursor.execute(
-                '''
-                SELECT cp.value phone, c.id, c.name
-                FROM clients c
-                LEFT JOIN client_contacts cp
-                    ON cp.agreement_id = c.id
-                    AND cp.main = 1
-                    AND cp.type = 'PHONE'
-                WHERE c.telegram_chat_id=%s
-                ''',
-                (telegram_id,)
-            )
-            user_data = cursor.fetchone()
-            return user_data
+        with db_pool.connection() as connection, connection.cursor() as cursor, \
+                metrics.timer('bot_db_query_seconds', query='identity'):
+            cursor.execute(IDENTITY_SQL, (telegram_id,))
+            identity = tuple(ClientIdentity(*row) for row in cursor.fetchall())
     except pymysql.MySQLError as e:
+        metrics.inc('bot_db_errors_total', query='identity')
         logging.error(f"Ошибка базы данных: {e}")
         return None
-    finally:
-        connection.close()
+
+    identity_cache.set(telegram_id, identity)
+    return identity
+
+def get_user_by_telegram_id(telegram_id: int):
+    identity = get_identity(telegram_id)
+    if not identity:
+        return None
+    client = identity[0]
+    return client.phone, client.client_id, client.name
+
+
+# =====================================
+#     Планировщик исходящих сообщений
+# =====================================
+class _ChatQueue:
+    __slots__ = ('jobs', 'bucket', 'blocked_until', 'busy')
+
+    def __init__(self, bucket: TokenBucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.busy = False
+
+
+class SendScheduler:
+    """
+    Очередь исходящих вызовов Bot API.
+
+    Обработчики кладут отправку в очередь и сразу возвращаются, а рабочие
+    потоки отправляют сообщения, соблюдая лимит на чат и общий лимит бота.
+    Сообщения одного чата уходят строго по порядку; на ответ 429 чат
+    приостанавливается на retry_after секунд и сообщение отправляется повторно.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, chat_rate, chat_burst, global_rate, workers):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.workers = workers
+
+        self._cond = threading.Condition()
+        self._chats = {}      # chat_id -> _ChatQueue
+        self._ready = []      # куча (ready_at, seq, chat_id) чатов, готовых к отправке
+        self._seq = itertools.count()
+        self._threads = []
+        self._stopping = False
+        self._swept = time.monotonic()
+
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None):
+        """Дожидается отправки уже поставленных сообщений и останавливает потоки."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, chat_id: int, func, *args, **kwargs):
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+            chat.jobs.append((func, args, kwargs))
+            if len(chat.jobs) == 1 and not chat.busy:
+                self._schedule(chat_id, chat, time.monotonic())
+                self._cond.notify()
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        self.submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def _schedule(self, chat_id, chat, now):
+        ready_at = max(now + chat.bucket.delay(now), chat.blocked_until)
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+
+    def _sweep(self, now):
+        # Забываем чаты без очереди, у которых ведро уже полное
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.jobs and not chat.busy and chat.blocked_until <= now and chat.bucket.is_full(now):
+                del self._chats[chat_id]
+        self._swept = now
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if not self._ready:
+                    if self._stopping:
+                        return None
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                ready_at, _, chat_id = self._ready[0]
+                delay = max(ready_at - now, self.global_bucket.delay(now))
+                if delay <= 0:
+                    break
+                self._cond.wait(delay)
+
+            heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            job = chat.jobs.popleft()
+            chat.busy = True
+            self.global_bucket.take(now)
+            chat.bucket.take(now)
+            return chat_id, chat, job
+
+    def _worker(self):
+        while True:
+            task = self._next_job()
+            if task is None:
+                return
+            chat_id, chat, job = task
+            func, args, kwargs = job
+
+            retry_after = None
+            try:
+                func(*args, **kwargs)
+                ok = True
+            except apihelper.ApiTelegramException as e:
+                ok = False
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                else:
+                    logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+            except Exception as e:
+                ok = False
+                logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+
+            with self._cond:
+                now = time.monotonic()
+                chat.busy = False
+                if retry_after is not None:
+                    logging.info(f"Чат {chat_id}: 429, повтор через {retry_after} с")
+                    chat.jobs.appendleft(job)
+                    chat.blocked_until = now + retry_after
+                    self.retries += 1
+                elif ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                if chat.jobs:
+                    self._schedule(chat_id, chat, now)
+                    self._cond.notify()
+                if now - self._swept > self.SWEEP_INTERVAL:
+                    self._sweep(now)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'pending': sum(len(chat.jobs) for chat in self._chats.values()),
+                'chats': len(self._chats),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+            }
+
+
+send_queue = SendScheduler(
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    global_rate=SEND_GLOBAL_RATE,
+    workers=SEND_WORKERS,
+)
+metrics.collect('bot_send_queue', send_queue.stats, counters=('sent', 'failed', 'retries'))
 
 
 # =====================================
@@ -125,6 +846,7 @@ def get_user_by_telegram_id(telegram_id: int):
 # =====================================
 # Обработчик неподдерживаемых типов сообщений
 @bot.message_handler(content_types=['animation', 'audio', 'document', 'photo', 'sticker', 'video', 'video_note', 'voice', 'location', 'dice', 'poll'])
+@instrumented
 def unsupported_message_handler(message: types.Message):
     user_id = message.chat.id
     user_message_id = message.message_id
@@ -135,14 +857,12 @@ def unsupported_message_handler(message: types.Message):
 
     try:
         bot.delete_message(chat_id=user_id, message_id=user_message_id)
-        print(f"Сообщение {user_message_id} удалено.")
-        logging.info(f"Сообщение {user_message_id} удалено.")
+        logging.info(f"Сообщение {user_message_id} удалено.", extra=LOG_SAMPLED)
     except apihelper.ApiException as e:
-        print(f"Ошибка при удалении сообщения: {e}")
         logging.info(f"Ошибка при удалении сообщения: {e}")
 
     # Отправляем сообщение пользователю
-    bot.send_message(
+    send_queue.send_message(
         user_id,
         "На жаль, я не підтримую цей тип повідомлень. "
         "Будь ласка, скористайтеся текстовими повідомленнями.",
@@ -150,81 +870,201 @@ def unsupported_message_handler(message: types.Message):
     )
 
     # Логируем неподдерживаемое сообщение
-    logging.info(f"Користувач {user_id} надіслав неподтримуване повідомлення типу {message.content_type}.")
+    logging.info(f"Користувач {user_id} надіслав неподтримуване повідомлення типу {message.content_type}.", extra=LOG_SAMPLED)
         
 
+
 # =====================================
-#        Вспомогательные функции
+#        Формирование ответов
 # =====================================
-def sanitize_input(input_text: str) -> str:
-    return re.sub(r"[<>'\";]", "", input_text)
+def load_screen(chat_id: int, screen: str) -> str | None:
+    """Текст экрана из кэша, а при промахе — из БД. None — ошибка БД."""
+    key = (chat_id, screen)
+    message_text = response_cache.get(key)
+    if message_text is not None:
+        return message_text
+
+    identity = get_identity(chat_id)
+    if identity is None:
+        return None
+
+    sql, render, empty_text = SCREEN_QUERIES[screen]
+    records = ()
+    if identity:
+        try:
+            with db_pool.connection() as connection, connection.cursor() as cursor, \
+                    metrics.timer('bot_db_query_seconds', query=screen):
+                cursor.execute(sql, (client_ids(identity),))
+                records = cursor.fetchall()
+        except pymysql.MySQLError as e:
+            metrics.inc('bot_db_errors_total', query=screen)
+            logging.error(f"Помилка бази даних: {e}")
+            return None
+
+    if records:
+        with metrics.timer('bot_render_seconds', screen=screen):
+            message_text = render(records)
+    else:
+        message_text = empty_text
+    response_cache.set(key, message_text)
+    return message_text
 
 
 # =====================================
-#        Менюшки
+#      Очередь заявок в поддержку
 # =====================================
+# Заявки лежат в TicketOutbox (SupportCommon.py), фоновые потоки отправляют их в сервис
+
+
+class TicketDeliverer:
+    """Потоки, которые отправляют заявки из TicketOutbox в сервис поддержки."""
+
+    POLL_INTERVAL = 5
+
+    def __init__(self, outbox: TicketOutbox, url: str, workers: int, batch: int, timeout: float):
+        self.outbox = outbox
+        self.url = url
+        self.workers = workers
+        self.batch = batch
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        self.delivered = 0
+        self.retries = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"tickets-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None):
+        """Завершает текущие попытки; остальные заявки остаются в файле до следующего запуска."""
+        self._stop.set()
+        self.outbox.added.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _session(self) -> requests.Session:
+        # Своё keep-alive соединение у каждого потока; повторы делает сам TicketDeliverer
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(support_api_headers())
+        return session
+
+    def _worker(self):
+        session = self._session()
+        while not self._stop.is_set():
+            try:
+                tickets = self.outbox.claim(self.batch)
+                delay = 0 if tickets else self.outbox.next_delay(self.POLL_INTERVAL)
+            except sqlite3.Error as e:
+                logging.error(f"Очередь заявок недоступна: {e}")
+                self._stop.wait(self.POLL_INTERVAL)
+                continue
+            if not tickets:
+                self.outbox.added.wait(delay)
+                self.outbox.added.clear()
+                continue
+            for i, ticket in enumerate(tickets):
+                if self._stop.is_set():
+                    self.outbox.release(tickets[i:])
+                    break
+                self._deliver(session, ticket)
+        session.close()
+
+    def _deliver(self, session: requests.Session, ticket: Ticket):
+        try:
+            with metrics.timer('bot_support_api_seconds'):
+                response = session.post(
+                    self.url,
+                    json=ticket.body,
+                    headers={'Idempotency-Key': ticket.key},
+                    timeout=(min(5, self.timeout), self.timeout),
+                )
+        except requests.RequestException as e:
+            result = self.outbox.complete(ticket, None, str(e))
+        else:
+            logging.info(f"Сервис вернул ({response.status_code}): {response.text}")
+            result = self.outbox.complete(
+                ticket, response.status_code, response.text[:500], response.headers.get('Retry-After')
+            )
 
-def get_phone_keyboard() -> types.ReplyKeyboardMarkup:
-    keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    button = types.KeyboardButton("📞 Надіслати номер телефону", request_contact=True)
-    keyboard.add(button)
-    return keyboard
+        with self._lock:
+            if result == 'delivered':
+                self.delivered += 1
+            elif result == 'retry':
+                self.retries += 1
+            else:
+                self.failed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'delivered': self.delivered, 'retries': self.retries, 'rejected': self.failed}
+        stats.update(self.outbox.stats())
+        return stats
 
-def get_main_menu() -> types.ReplyKeyboardMarkup:
-    menu = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    menu.add(
-        types.KeyboardButton("💳 Баланс"),
-        types.KeyboardButton("💯 Платежі"),
-        types.KeyboardButton("💰 Оплата"),
-        types.KeyboardButton("👤 Кабінет"),
-        types.KeyboardButton("📞 Підтримка")
-    )
-    return menu
-
-def get_pay_menu() -> types.InlineKeyboardMarkup:
-    menu = types.InlineKeyboardMarkup()
-    menu.add(
-        types.InlineKeyboardButton(
-            '💳 EasyPay',
-            url='https://easypay.ua/ua/catalog/internet/happylink'
-        ),
-        types.InlineKeyboardButton(
-            '🏦 Privat24',
-            url=(
-                'https://next.privat24.ua/payments/form/'
-                '%7B%22token%22%3A%22b9b67f5b-1f2c-47c4-bb1f-be8d48609dc0%22%7D'
-            )
-        ),
-    )
-    menu.add(
-        types.InlineKeyboardButton('📊 Реквізити', callback_data='show_requisites_handler')
-    )
-    return menu
+
+ticket_outbox = TicketOutbox(OUTBOX_DB_PATH, OUTBOX_LEASE, OUTBOX_BACKOFF, OUTBOX_BACKOFF_MAX)
+ticket_deliverer = TicketDeliverer(ticket_outbox, URL, OUTBOX_WORKERS, OUTBOX_BATCH, SUPPORT_API_TIMEOUT)
+metrics.collect('bot_tickets', ticket_deliverer.stats, counters=('delivered', 'retries', 'rejected'))
 
 # =====================================
 #  Логика состояний; для поддержки
 # =====================================
-user_state = {}
+class StoreHandlerBackend(HandlerBackend):
+    """Реестр next-step обработчиков telebot поверх хранилища состояний."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def register_handler(self, handler_group_id, handler):
+        key = f"next_step:{handler_group_id}"
+        handlers = self.store.get(key) or []
+        handlers.append(handler)
+        self.store.set(key, handlers)
+
+    def clear_handlers(self, handler_group_id):
+        self.store.delete(f"next_step:{handler_group_id}")
+
+    def get_handlers(self, handler_group_id):
+        # pop, а не get + delete: иначе два процесса успеют прочитать обработчик и оба его выполнят
+        return self.store.pop(f"next_step:{handler_group_id}")
+
+
+state_store = open_state_store()
+bot.next_step_backend = StoreHandlerBackend(state_store)
 
 def set_user_state(chat_id: int, state: str | None):
-    user_state[chat_id] = state
+    if state is None:
+        state_store.delete(state_key(chat_id))
+    else:
+        state_store.set(state_key(chat_id), state)
 
 def get_user_state(chat_id: int) -> str | None:
-    return user_state.get(chat_id, None)
+    return state_store.get(state_key(chat_id))
 
 # =====================================
 #        Обработчики команд бота
 # =====================================
 @bot.message_handler(commands=['start'])
+@instrumented
 def start_handler(message: types.Message):
-    bot.send_message(
+    send_queue.send_message(
         message.chat.id,
         "Будь ласка, надішліть номер телефону, пов'язаний з вашим договором.",
         reply_markup=get_phone_keyboard()
     )
-    logging.info(f"Пользователь {message.chat.id} отправил /start")
+    logging.info(f"Пользователь {message.chat.id} отправил /start", extra=LOG_SAMPLED)
 
 @bot.message_handler(content_types=['contact'])
+@instrumented
 def contact_handler(message: types.Message):
     user_id = message.chat.id
     phone_number = message.contact.phone_number
@@ -234,8 +1074,7 @@ def contact_handler(message: types.Message):
     try:
         result = get_user_by_phone(phone_number, user_id)
         if result is True:
-            time.sleep(MESSAGE_DELAY_TIME)
-            bot.send_message(
+            send_queue.send_message(
                 user_id,
                 (
                     "<b>Ваш номер телефону знайдено!</b>\n"
@@ -245,278 +1084,122 @@ def contact_handler(message: types.Message):
                 reply_markup=get_main_menu()
             )
         elif result is False:
-            bot.send_message(
+            send_queue.send_message(
                 user_id,
                 "Ваш номер телефону не знайдено. "
                 "Спробуйте ще раз або зв'яжіться з підтримкою."
             )
         else:
-            bot.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+            send_queue.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
     except Exception as e:
         logging.error(f"Ошибка: {e}")
-        bot.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
-
-
-
-
+        send_queue.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
 
 
 @bot.message_handler(func=lambda msg: msg.text == "💳 Баланс")
+@instrumented
 def bill_handler(message: types.Message):
     user_id = message.chat.id
 
-    connection = get_db_connection()
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    c.agreement,
-                    c.balance,
-                    REPLACE(GROUP_CONCAT(DISTINCT bill_prices.name ORDER BY bill_prices.name SEPARATOR ', '), ' ', '\n') AS tariff,
-                    CONCAT(
-                        REPLACE(ac.name, ' ', '\n'), ', ',
-                        REPLACE(s.name, ' ', '\n'), ', ',
-                        REPLACE(ah.name, ' ', '\n'), ', кв. ',
-                        REPLACE(c.apartment, ' ', '\n')
-                    ) AS address
-                FROM clients c
-                JOIN addr_houses ah ON ah.id = c.house
-                JOIN addr_streets s ON s.id = ah.street
-                JOIN addr_cities ac ON ac.id = s.city
-                JOIN client_prices ON client_prices.agreement = c.id AND client_prices.time_stop IS NULL
-                JOIN bill_prices ON bill_prices.id = client_prices.price
-                WHERE c.telegram_chat_id=%s
-                GROUP BY c.agreement, c.balance, address, c.telegram_chat_id
-                ORDER BY client_prices.id DESC
-                LIMIT 10;
-                ''',
-                (user_id,)
-            )
-
-            bill_records = cursor.fetchall()
-            if bill_records:
-                headers = ["Договір #", "Баланс", "Тариф"]
-                table = []
-                addresses = []
-
-                for row in bill_records:
-                    agreement = row[0]
-                    balance = row[1]
-                    balance_emoji = "✅" if balance >= 0 else "🔴"
-                    formatted_balance = f"{balance_emoji} {balance:.2f}₴"
-
-                    table.append([agreement, formatted_balance, row[2]])  # Добавили договор
-                    addresses.append(f"#{agreement}: {row[3]}")  # Сохраняем адрес отдельно
-
-                # Создаем таблицу
-                table_text = tabulate(
-                    table,
-                    headers=headers,
-                    tablefmt="grid",
-                    maxcolwidths=[8, 12, 15],  # Ограничиваем ширину столбцов
-                )
-
-                # Создаем список адресов
-                addresses_text = "\n".join(addresses)
-
-                # Формируем итоговое сообщение
-                message_text = (
-                    f"<b>Деталі договорів:</b>\n\n"
-                    f"<pre>{table_text}</pre>\n\n"
-                    f"<b>Опис:</b>\n{addresses_text}"
-                )
-
-                time.sleep(MESSAGE_DELAY_TIME)
-                bot.send_message(
-                    user_id,
-                    text=message_text,
-                    parse_mode="HTML"
-                )
-            else:
-                time.sleep(MESSAGE_DELAY_TIME)
-                bot.send_message(
-                    user_id,
-                    "<b>Не має активних послуг</b>. \nБудь ласка, зверніться до підтримки.",
-                    parse_mode="HTML"
-                )
-    except pymysql.MySQLError as e:
-        logging.error(f"Помилка бази даних: {e}")
-        bot.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
-    finally:
-        connection.close()
-
-
+    message_text = load_screen(user_id, SCREEN_BALANCE)
+    if message_text is None:
+        send_queue.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+        return
+    send_queue.send_message(
+        user_id,
+        text=message_text,
+        parse_mode="HTML"
+    )
 
 
 @bot.message_handler(func=lambda msg: msg.text == "💯 Платежі")
+@instrumented
 def show_payment_handler(message: types.Message):
     user_id = message.chat.id
 
-    connection = get_db_connection()
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute(
-                '''
-                SELECT 
-                       p.id,
-                       c.agreement,
-                       p.money,
-                       CAST(time AS DATE) time,
-                       p.payment_type
-                FROM paymants p
-                JOIN clients c ON p.agreement = c.id
-                WHERE c.telegram_chat_id=%s
-                ORDER BY time DESC
-                LIMIT 24;
-                ''',
-                (user_id,)
-            )
-            payment_records = cursor.fetchall()
-            if payment_records:
-                headers = ["id", "Договір", "Сума", "Дата"]
-                table = []
-                payments_type = []
-
-                for row in payment_records:
-                    id = row[0]
-                    agreement = row[1]
-                    formatted_money = f'{row[2]}₴'
-                    formatted_date = row[3].strftime("%Y-%m-%d")
-                    payment_type = row[4] if row[4] else "Немає опису"
-                    table.append([id, agreement, formatted_money, formatted_date])  # Добавили договор
-                    payments_type.append(f"id# {id}: {payment_type}")  # Сохраняем описание отдельно
-
-                # Создаем таблицу
-                table_text = tabulate(
-                    table,
-                    headers=headers,
-                    tablefmt="grid",
-                    maxcolwidths=[5, 5, 15, 15],  # Ограничиваем ширину столбцов
-                )
-
-                # Создаем список комментариев
-                comments_text = "\n".join(payments_type)
-
-                # Формируем итоговое сообщение
-                message_text = (
-                    f"<b>Останні платежі:</b>\n\n"
-                    f"<pre>{table_text}</pre>\n\n"
-                    f"<b>Опис:</b>\n{comments_text}"
-                )
-
-                time.sleep(MESSAGE_DELAY_TIME)
-                bot.send_message(
-                    user_id,
-                    text=message_text,
-                    parse_mode="HTML"
-                )
-            else:
-                time.sleep(MESSAGE_DELAY_TIME)
-                bot.send_message(
-                    user_id,
-                    "Платежі не знайдено. Будь ласка, зверніться до підтримки.",
-                    parse_mode="HTML"
-                )
-    except pymysql.MySQLError as e:
-        logging.error(f"Помилка бази даних: {e}")
-        bot.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
-    finally:
-        connection.close()
-
+    message_text = load_screen(user_id, SCREEN_PAYMENTS)
+    if message_text is None:
+        send_queue.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+        return
+    send_queue.send_message(
+        user_id,
+        text=message_text,
+        parse_mode="HTML"
+    )
 
 
 @bot.message_handler(func=lambda msg: msg.text == "👤 Кабінет")
+@instrumented
 def lc_handler(message: types.Message):
     user_id = message.chat.id
 
-    time.sleep(MESSAGE_DELAY_TIME)
-    bot.send_message(
+    send_queue.send_message(
         user_id,
         'Натисніть на посилання, щоб відкрити:\n [👤 особистий кабінет](https://my.happylink.net.ua/)',
         parse_mode="MarkdownV2"
         
     )
-    logging.info(f"Користувач {user_id} натиснув '👤 Кабінет'.")
-
+    logging.info(f"Користувач {user_id} натиснув '👤 Кабінет'.", extra=LOG_SAMPLED)
 
 
 @bot.message_handler(func=lambda msg: msg.text == "💰 Оплата")
+@instrumented
 def pay_handler(message: types.Message):
     user_id = message.chat.id
 
-    time.sleep(MESSAGE_DELAY_TIME)
-    bot.send_message(
+    send_queue.send_message(
         user_id,
         "*💰 Оберіть зручний спосіб оплати:*",
         parse_mode="MarkdownV2",
         reply_markup=get_pay_menu()
     )
-    logging.info(f"Користувач {user_id} натиснув 'Поповнити рахунок'.")
-
+    logging.info(f"Користувач {user_id} натиснув 'Поповнити рахунок'.", extra=LOG_SAMPLED)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'show_requisites_handler')
+@instrumented
 def show_requisites_handler(call: types.CallbackQuery):
     user_id = call.message.chat.id
 
     try:
-        data = {
-            "Рекомендована сума для оплати": "[Абонплата] грн/міс",
-            "Отримувач": "ТОВ \"Хеппілінк Україна\"",
-            "IBAN": "UA113052990000026002035033913",
-            "РНОКПП": "45589308",
-            "В АТ КБ": "«ПриватБанк»",
-            "Призначення платежу": "Оплата за інтернет, особовий рахунок № [Ваш рахунок]"
-        }
-        table_text = "\n".join([f"{key}: {value}" for key, value in data.items()])
-
-        time.sleep(MESSAGE_DELAY_TIME)
-        bot.send_message(
+        send_queue.send_message(
             user_id,
-            f"<b>Платіжна інформація:</b>\n\n{table_text}",
+            get_requisites_text(),
             parse_mode="HTML"
         )
     except Exception as e:
         logging.error(f"Помилка: {e}")
-        bot.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
-
+        send_queue.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
 
 
 # =====================================
 #   Блок 📞 Підтримка;
 # =====================================
 @bot.message_handler(func=lambda msg: msg.text == "📞 Підтримка")
+@instrumented
 def contact_support_handler(message: types.Message):
     user_id = message.chat.id
     # Устанавливаем состояние, что мы ждём ввода текста для поддержки
     set_user_state(user_id, "support_waiting_text")
 
-    # Создаём клавиатуру, которая позволит вернуться в главное меню
-    support_menu = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    # Кнопка возврата
-    back_button = types.KeyboardButton("↩️ Повернутись до головного меню")
-    support_menu.add(back_button)
-    
-    time.sleep(MESSAGE_DELAY_TIME)
-    msg = bot.send_message(
+    send_queue.send_message(
         user_id,
         "Введіть, будь ласка, текст повідомлення для підтримки "
         "або поверніться до головного меню:",
-        reply_markup=support_menu
+        reply_markup=get_support_menu()
     )
-    bot.register_next_step_handler(msg, process_support_message)
+    bot.register_next_step_handler_by_chat_id(user_id, process_support_message)
 
+@instrumented
 def process_support_message(message: types.Message):
     user_id = message.chat.id
     state = get_user_state(user_id)
 
     # Если пользователь нажал кнопку &laquo;↩️ Повернутись до головного меню&raquo;
-    if message.text == "↩️ Повернутись до головного меню":
+    if message.text == BACK_TO_MENU_TEXT:
         set_user_state(user_id, None)
 
-        time.sleep(MESSAGE_DELAY_TIME)
-        bot.send_message(
+        send_queue.send_message(
             user_id,
             "Ви повернулися до головного меню.",
             reply_markup=get_main_menu()
@@ -524,17 +1207,9 @@ def process_support_message(message: types.Message):
         return
 
     # Проверяем, не нажал ли пользователь вместо текста одну из кнопок главного меню
-    main_menu_texts = {
-        "💳 Баланс",
-        "💯 Платежі",
-        "💰 Оплата",
-        "👤 Кабінет",
-        "📞 Підтримка"
-    }
-    if message.text in main_menu_texts and state == "support_waiting_text":
-
-        time.sleep(MESSAGE_DELAY_TIME)
-        bot.send_message(
+    if message.text in MAIN_MENU_TEXTS and state == "support_waiting_text":
+
+        send_queue.send_message(
             user_id,
             "Ви натиснули кнопку меню, проте ми очікуємо текст повідомлення.\n"
             "Будь ласка, введіть текст для підтримки або поверніться до головного меню:"
@@ -547,43 +1222,26 @@ def process_support_message(message: types.Message):
 
     if not user_data:
 
-        time.sleep(MESSAGE_DELAY_TIME)
-        bot.send_message(user_id, "Не вдалося знайти ваш запис у базі.")
+        send_queue.send_message(user_id, "Не вдалося знайти ваш запис у базі.")
         set_user_state(user_id, None)
         return
 
-    phone, agreement_id, name = user_data
-    now = datetime.now()
-    dt_string = now.strftime("%d.%m.%Y %H:%M:%S")
-
-    headers = {
-        'Content-type': 'application/json',
-        'X-Auth-Key': KEY
-    }
-    body = {
-        "agreement_id": agreement_id,
-        "reason_id": 10,
-        "phone": phone,
-        "destination_time": dt_string,
-        "comment": "\n" + sanitize_input(message.text)
-    }
+    body = make_support_ticket(user_data, message.text)
 
+    # Заявку отправит ticket_deliverer; здесь только надёжно сохраняем её
     try:
-        response = requests.post(URL, json=body, headers=headers)
-        logging.info(f"Сервис вернул: {response.text}")
-    except Exception as e:
-        logging.error(f"Ошибка при отправке заявки: {e}")
+        ticket_outbox.add(user_id, body)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка при сохранении заявки: {e}")
 
-        time.sleep(MESSAGE_DELAY_TIME)
-        bot.send_message(
+        send_queue.send_message(
             user_id,
             "Виникла помилка при відправці заявки. Спробуйте пізніше."
         )
         set_user_state(user_id, None)
         return
     
-    time.sleep(MESSAGE_DELAY_TIME)
-    bot.send_message(
+    send_queue.send_message(
         user_id,
         "<b>Повідомлення отримано!</b>\nОчікуйте, ми зв’яжемося з вами.",
         parse_mode="HTML",
@@ -591,13 +1249,91 @@ def process_support_message(message: types.Message):
     )
     set_user_state(user_id, None)
 
+# =====================================
+#          Режим вебхука
+# =====================================
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает обновления от Telegram и передаёт их в диспетчер."""
+
+    protocol_version = 'HTTP/1.1'   # keep-alive: Telegram переиспользует соединения
+    timeout = 75                    # закрываем простаивающие keep-alive соединения
+
+    def do_POST(self):
+        if urlsplit(self.path).path != urlsplit(WEBHOOK_URL).path:
+            return self._reply(404)
+
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if WEBHOOK_SECRET and not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return self._reply(403, close=True)
+
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            return self._reply(411, close=True)
+        if int(length) > WEBHOOK_MAX_BODY:
+            # Тело не читаем, поэтому соединение дальше использовать нельзя
+            return self._reply(413, close=True)
+
+        body = self.rfile.read(int(length))
+        try:
+            update = types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            logging.error(f"Некорректное обновление от вебхука: {e}")
+            return self._reply(400)
+
+        bot.process_new_updates([update])
+        self._reply(200)
+
+    def _reply(self, code: int, close: bool = False):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128    # по умолчанию 5 — при всплеске соединения сбрасываются
+
+
+def run_webhook():
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logging.info(f"Вебхук {WEBHOOK_URL} слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
 # =====================================
 #          Точка входа (main)
 # =====================================
 def main():
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        # Без адреса set_webhook(url=None) молча снимет вебхук, а каждое обновление получит 404
+        logging.critical("BOT_MODE=webhook, но WEBHOOK_URL не задан")
+        raise SystemExit("BOT_MODE=webhook требует WEBHOOK_URL")
     logging.info("Бот запущен")
-    print("Бот запущен")
-    bot.infinity_polling()
+    if METRICS_PORT:
+        run_metrics_server()
+    send_queue.start()
+    ticket_deliverer.start()
+    dispatcher.start()
+    bot.dispatcher = dispatcher
+    try:
+        if BOT_MODE == 'webhook':
+            run_webhook()
+        else:
+            bot.remove_webhook()
+            bot.infinity_polling()
+    finally:
+        dispatcher.stop(timeout=10)
+        send_queue.stop(timeout=10)
+        ticket_deliverer.stop(timeout=SUPPORT_API_TIMEOUT)
 
 if __name__ == "__main__":
     main()
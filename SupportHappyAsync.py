@@ -0,0 +1,540 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+import aiohttp
+import aiomysql
+import pymysql
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware
+
+from SupportCommon import (
+    BACK_TO_MENU_TEXT,
+    BIND_TELEGRAM_SQL,
+    BOT_TOKEN,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_SIZE,
+    IDENTITY_SQL,
+    LOG_SAMPLED,
+    MAIN_MENU_TEXTS,
+    OUTBOX_BACKOFF,
+    OUTBOX_BACKOFF_MAX,
+    OUTBOX_BATCH,
+    OUTBOX_DB_PATH,
+    OUTBOX_LEASE,
+    PHONE_SUFFIX_LEN,
+    SCREEN_BALANCE,
+    SCREEN_PAYMENTS,
+    SCREEN_QUERIES,
+    SEND_CHAT_BURST,
+    SEND_CHAT_RATE,
+    SEND_GLOBAL_RATE,
+    SUPPORT_API_TIMEOUT,
+    TELEGRAM_API_URL,
+    URL,
+    USER_BY_PHONE_SQL,
+    ClientIdentity,
+    SQLiteStateStore,
+    TicketOutbox,
+    TokenBucket,
+    client_ids,
+    forget_chat,
+    get_main_menu,
+    get_pay_menu,
+    get_phone_keyboard,
+    get_requisites_text,
+    get_support_menu,
+    identity_cache,
+    make_support_ticket,
+    normalize_phone,
+    open_state_store,
+    response_cache,
+    setup_logging,
+    state_key,
+    support_api_headers,
+)
+
+# Асинхронный вариант SupportHappy.py: тот же набор обработчиков, но весь ввод-вывод
+# (MySQL, Bot API, сервис заявок) неблокирующий, и один процесс без потоков
+# обслуживает тысячи одновременных диалогов.
+# python SupportHappyAsync.py
+
+# =====================================
+#        Глобальные настройки
+# =====================================
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# Создаются в main(), внутри цикла событий
+db_pool: aiomysql.Pool | None = None
+http: aiohttp.ClientSession | None = None
+
+
+# =====================================
+#        Отправка сообщений
+# =====================================
+class AsyncSender:
+    """
+    Асинхронный аналог SendScheduler: те же лимиты на чат и на бота.
+
+    Сообщения одного чата отправляются по очереди под замком чата,
+    а на ответ 429 отправка повторяется через retry_after секунд.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, chat_rate, chat_burst, global_rate):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}   # chat_id -> (asyncio.Lock, TokenBucket)
+        self._swept = time.monotonic()
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = (asyncio.Lock(), TokenBucket(self.chat_rate, self.chat_burst))
+        lock, bucket = chat
+
+        async with lock:
+            while True:
+                now = time.monotonic()
+                delay = max(bucket.delay(now), self.global_bucket.delay(now))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                bucket.take(now)
+                self.global_bucket.take(now)
+                try:
+                    return await bot.send_message(chat_id, text, **kwargs)
+                except asyncio_helper.ApiTelegramException as e:
+                    if e.error_code != 429:
+                        logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+                        return None
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logging.info(f"Чат {chat_id}: 429, повтор через {retry_after} с")
+                    await asyncio.sleep(retry_after)
+                except Exception as e:
+                    logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+                    return None
+                finally:
+                    self._sweep()
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept < self.SWEEP_INTERVAL:
+            return
+        for chat_id, (lock, bucket) in list(self._chats.items()):
+            if not lock.locked() and bucket.is_full(now):
+                del self._chats[chat_id]
+        self._swept = now
+
+
+sender = AsyncSender(SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GLOBAL_RATE)
+
+
+# =====================================
+#        Функции для работы с БД
+# =====================================
+async def fetch_all(sql: str, args) -> tuple:
+    async with db_pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(sql, args)
+            return await cursor.fetchall()
+
+async def get_user_by_phone(phone_number: str, telegram_id: int) -> bool | None:
+    phone = normalize_phone(phone_number)
+    if len(phone) < PHONE_SUFFIX_LEN:
+        return False
+
+    try:
+        async with db_pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(USER_BY_PHONE_SQL, (phone,))
+                rows = await cursor.fetchall()
+                if rows:
+                    previous_chats = {row[3] for row in rows if row[3]}
+                    await cursor.execute(BIND_TELEGRAM_SQL, (telegram_id, tuple(row[0] for row in rows)))
+                    await connection.commit()
+                    for chat_id in previous_chats | {telegram_id}:
+                        forget_chat(chat_id)
+                    return True
+                return False
+    except pymysql.MySQLError as e:
+        logging.error(f"Ошибка базы данных: {e}")
+        return None
+
+async def get_identity(telegram_id: int) -> tuple | None:
+    identity = identity_cache.get(telegram_id)
+    if identity is not None:
+        return identity
+    try:
+        rows = await fetch_all(IDENTITY_SQL, (telegram_id,))
+    except pymysql.MySQLError as e:
+        logging.error(f"Ошибка базы данных: {e}")
+        return None
+    identity = tuple(ClientIdentity(*row) for row in rows)
+    identity_cache.set(telegram_id, identity)
+    return identity
+
+async def load_screen(chat_id: int, screen: str) -> str | None:
+    key = (chat_id, screen)
+    message_text = response_cache.get(key)
+    if message_text is not None:
+        return message_text
+
+    identity = await get_identity(chat_id)
+    if identity is None:
+        return None
+
+    sql, render, empty_text = SCREEN_QUERIES[screen]
+    records = ()
+    if identity:
+        try:
+            records = await fetch_all(sql, (client_ids(identity),))
+        except pymysql.MySQLError as e:
+            logging.error(f"Помилка бази даних: {e}")
+            return None
+
+    message_text = render(records) if records else empty_text
+    response_cache.set(key, message_text)
+    return message_text
+
+async def get_user_by_telegram_id(telegram_id: int):
+    identity = await get_identity(telegram_id)
+    if not identity:
+        return None
+    client = identity[0]
+    return client.phone, client.client_id, client.name
+
+
+# =====================================
+#        Отправка заявок в поддержку
+# =====================================
+# Заявки лежат в том же файле-очереди, что и у SupportHappy.py (OUTBOX_DB_PATH),
+# а отправляет их задача цикла событий через общую aiohttp-сессию.
+TICKETS_POLL_INTERVAL = 5
+
+ticket_outbox = TicketOutbox(OUTBOX_DB_PATH, OUTBOX_LEASE, OUTBOX_BACKOFF, OUTBOX_BACKOFF_MAX)
+
+# Будит deliver_tickets(), когда обработчик сохранил новую заявку
+tickets_added = asyncio.Event()
+
+async def deliver_ticket(ticket):
+    headers = {**support_api_headers(), 'Idempotency-Key': ticket.key}
+    try:
+        async with http.post(URL, json=ticket.body, headers=headers) as response:
+            text = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await asyncio.to_thread(ticket_outbox.complete, ticket, None, str(e) or type(e).__name__)
+        return
+    logging.info(f"Сервис вернул ({response.status}): {text}")
+    await asyncio.to_thread(
+        ticket_outbox.complete, ticket, response.status, text[:500], response.headers.get('Retry-After')
+    )
+
+async def deliver_tickets():
+    while True:
+        try:
+            tickets = await asyncio.to_thread(ticket_outbox.claim, OUTBOX_BATCH)
+            delay = 0 if tickets else await asyncio.to_thread(ticket_outbox.next_delay, TICKETS_POLL_INTERVAL)
+        except sqlite3.Error as e:
+            logging.error(f"Очередь заявок недоступна: {e}")
+            tickets, delay = [], TICKETS_POLL_INTERVAL
+        if not tickets:
+            try:
+                await asyncio.wait_for(tickets_added.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            tickets_added.clear()
+            continue
+        # Ошибка одной заявки (например, "database is locked" при complete) не должна
+        # останавливать доставку: заявка вернётся в очередь, когда истечёт аренда
+        results = await asyncio.gather(*(deliver_ticket(ticket) for ticket in tickets), return_exceptions=True)
+        for ticket, result in zip(tickets, results):
+            if isinstance(result, Exception):
+                logging.error(f"Ошибка при доставке заявки {ticket.id}: {result}")
+
+
+# =====================================
+#  Игнорирование нетекстовых сообщений
+# =====================================
+@bot.message_handler(content_types=['animation', 'audio', 'document', 'photo', 'sticker', 'video', 'video_note', 'voice', 'location', 'dice', 'poll'])
+async def unsupported_message_handler(message: types.Message):
+    user_id = message.chat.id
+    user_message_id = message.message_id
+
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add(types.KeyboardButton("/start"))
+
+    try:
+        await bot.delete_message(chat_id=user_id, message_id=user_message_id)
+        logging.info(f"Сообщение {user_message_id} удалено.", extra=LOG_SAMPLED)
+    except asyncio_helper.ApiException as e:
+        logging.info(f"Ошибка при удалении сообщения: {e}")
+
+    await sender.send_message(
+        user_id,
+        "На жаль, я не підтримую цей тип повідомлень. "
+        "Будь ласка, скористайтеся текстовими повідомленнями.",
+        reply_markup=markup
+    )
+    logging.info(f"Користувач {user_id} надіслав неподтримуване повідомлення типу {message.content_type}.", extra=LOG_SAMPLED)
+
+
+# =====================================
+#    Порядок обновлений одного чата
+# =====================================
+class ChatOrderMiddleware(BaseMiddleware):
+    """
+    Асинхронный аналог UpdateDispatcher: каждое обновление — своя задача, но обновления
+    одного чата проходят фильтры и обработчики по очереди под замком чата, иначе два
+    быстрых сообщения пользователя увидят user_state не в том порядке.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'edited_message', 'callback_query']
+        self._locks = {}   # chat_id -> [asyncio.Lock, сколько обновлений держат или ждут замок]
+
+    @staticmethod
+    def chat_key(update) -> int:
+        if isinstance(update, types.CallbackQuery):
+            return update.message.chat.id if update.message else update.from_user.id
+        return update.chat.id
+
+    async def pre_process(self, update, data):
+        key = self.chat_key(update)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        # asyncio.Lock будит ожидающих в порядке очереди, то есть в порядке обновлений
+        await entry[0].acquire()
+
+    async def post_process(self, update, data, exception):
+        key = self.chat_key(update)
+        entry = self._locks[key]
+        entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
+
+
+bot.setup_middleware(ChatOrderMiddleware())
+
+
+# =====================================
+#        Состояние диалога
+# =====================================
+state_store = open_state_store()
+
+async def call_state_store(method, *args):
+    # SQLite-хранилище блокирует, поэтому его вызовы уходят из цикла событий в поток
+    if isinstance(state_store, SQLiteStateStore):
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+async def set_user_state(chat_id: int, state: str | None):
+    if state is None:
+        await call_state_store(state_store.delete, state_key(chat_id))
+    else:
+        await call_state_store(state_store.set, state_key(chat_id), state)
+
+async def get_user_state(chat_id: int) -> str | None:
+    return await call_state_store(state_store.get, state_key(chat_id))
+
+async def waiting_support_text(message: types.Message) -> bool:
+    return await get_user_state(message.chat.id) == "support_waiting_text"
+
+
+# =====================================
+#   Блок 📞 Підтримка;
+# =====================================
+# AsyncTeleBot не поддерживает register_next_step_handler, поэтому ожидание текста
+# для поддержки определяется по user_state. Обработчик стоит раньше кнопок меню,
+# чтобы перехватывать их, пока мы ждём текст.
+@bot.message_handler(func=waiting_support_text)
+async def process_support_message(message: types.Message):
+    user_id = message.chat.id
+
+    if message.text == BACK_TO_MENU_TEXT:
+        await set_user_state(user_id, None)
+        await sender.send_message(
+            user_id,
+            "Ви повернулися до головного меню.",
+            reply_markup=get_main_menu()
+        )
+        return
+
+    if message.text in MAIN_MENU_TEXTS:
+        await sender.send_message(
+            user_id,
+            "Ви натиснули кнопку меню, проте ми очікуємо текст повідомлення.\n"
+            "Будь ласка, введіть текст для підтримки або поверніться до головного меню:"
+        )
+        return
+
+    user_data = await get_user_by_telegram_id(user_id)
+    if not user_data:
+        await sender.send_message(user_id, "Не вдалося знайти ваш запис у базі.")
+        await set_user_state(user_id, None)
+        return
+
+    body = make_support_ticket(user_data, message.text)
+    try:
+        await asyncio.to_thread(ticket_outbox.add, user_id, body)
+        tickets_added.set()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка при сохранении заявки: {e}")
+        await sender.send_message(
+            user_id,
+            "Виникла помилка при відправці заявки. Спробуйте пізніше."
+        )
+        await set_user_state(user_id, None)
+        return
+
+    await sender.send_message(
+        user_id,
+        "<b>Повідомлення отримано!</b>\nОчікуйте, ми зв’яжемося з вами.",
+        parse_mode="HTML",
+        reply_markup=get_main_menu()
+    )
+    await set_user_state(user_id, None)
+
+@bot.message_handler(func=lambda msg: msg.text == "📞 Підтримка")
+async def contact_support_handler(message: types.Message):
+    user_id = message.chat.id
+    await set_user_state(user_id, "support_waiting_text")
+    await sender.send_message(
+        user_id,
+        "Введіть, будь ласка, текст повідомлення для підтримки "
+        "або поверніться до головного меню:",
+        reply_markup=get_support_menu()
+    )
+
+
+# =====================================
+#        Обработчики команд бота
+# =====================================
+@bot.message_handler(commands=['start'])
+async def start_handler(message: types.Message):
+    await sender.send_message(
+        message.chat.id,
+        "Будь ласка, надішліть номер телефону, пов'язаний з вашим договором.",
+        reply_markup=get_phone_keyboard()
+    )
+    logging.info(f"Пользователь {message.chat.id} отправил /start", extra=LOG_SAMPLED)
+
+@bot.message_handler(content_types=['contact'])
+async def contact_handler(message: types.Message):
+    user_id = message.chat.id
+    phone_number = message.contact.phone_number
+
+    logging.info(f"Пользователь {user_id} отправил номер телефона: {phone_number}")
+
+    result = await get_user_by_phone(phone_number, user_id)
+    if result is True:
+        await sender.send_message(
+            user_id,
+            (
+                "<b>Ваш номер телефону знайдено!</b>\n"
+                "Що ви хотіли б зробити?"
+            ),
+            parse_mode="HTML",
+            reply_markup=get_main_menu()
+        )
+    elif result is False:
+        await sender.send_message(
+            user_id,
+            "Ваш номер телефону не знайдено. "
+            "Спробуйте ще раз або зв'яжіться з підтримкою."
+        )
+    else:
+        await sender.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+
+@bot.message_handler(func=lambda msg: msg.text == "💳 Баланс")
+async def bill_handler(message: types.Message):
+    user_id = message.chat.id
+    message_text = await load_screen(user_id, SCREEN_BALANCE)
+    if message_text is None:
+        await sender.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+        return
+    await sender.send_message(user_id, text=message_text, parse_mode="HTML")
+
+@bot.message_handler(func=lambda msg: msg.text == "💯 Платежі")
+async def show_payment_handler(message: types.Message):
+    user_id = message.chat.id
+    message_text = await load_screen(user_id, SCREEN_PAYMENTS)
+    if message_text is None:
+        await sender.send_message(user_id, "Сталася помилка. Спробуйте пізніше.")
+        return
+    await sender.send_message(user_id, text=message_text, parse_mode="HTML")
+
+@bot.message_handler(func=lambda msg: msg.text == "👤 Кабінет")
+async def lc_handler(message: types.Message):
+    user_id = message.chat.id
+    await sender.send_message(
+        user_id,
+        'Натисніть на посилання, щоб відкрити:\n [👤 особистий кабінет](https://my.happylink.net.ua/)',
+        parse_mode="MarkdownV2"
+    )
+    logging.info(f"Користувач {user_id} натиснув '👤 Кабінет'.", extra=LOG_SAMPLED)
+
+@bot.message_handler(func=lambda msg: msg.text == "💰 Оплата")
+async def pay_handler(message: types.Message):
+    user_id = message.chat.id
+    await sender.send_message(
+        user_id,
+        "*💰 Оберіть зручний спосіб оплати:*",
+        parse_mode="MarkdownV2",
+        reply_markup=get_pay_menu()
+    )
+    logging.info(f"Користувач {user_id} натиснув 'Поповнити рахунок'.", extra=LOG_SAMPLED)
+
+@bot.callback_query_handler(func=lambda call: call.data == 'show_requisites_handler')
+async def show_requisites_handler(call: types.CallbackQuery):
+    await sender.send_message(call.message.chat.id, get_requisites_text(), parse_mode="HTML")
+
+
+# =====================================
+#          Точка входа (main)
+# =====================================
+async def main():
+    global db_pool, http
+
+    # autocommit, чтобы соединения пула не держали открытую транзакцию со старым снимком
+    db_pool = await aiomysql.create_pool(
+        host=os.getenv('DB_HOST'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        db=os.getenv('DB_NAME'),
+        charset='utf8mb4',
+        minsize=DB_POOL_MIN_SIZE,
+        maxsize=DB_POOL_SIZE,
+        pool_recycle=int(DB_POOL_MAX_LIFETIME),
+        autocommit=True,
+    )
+    http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=SUPPORT_API_TIMEOUT))
+    delivery = asyncio.create_task(deliver_tickets())
+
+    logging.info("Асинхронный бот запущен")
+    try:
+        await bot.delete_webhook()
+        await bot.infinity_polling()
+    finally:
+        # Заявки, которые не успели уйти, останутся в очереди до следующего запуска
+        delivery.cancel()
+        await http.close()
+        db_pool.close()
+        await db_pool.wait_closed()
+        await bot.close_session()
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+import BackupRemote
+
+
+class FakeMega:
+    """Аккаунт mega.nz в памяти: handle -> node, как в get_files() из mega.py."""
+
+    def __init__(self):
+        self.nodes = {'F1': {'t': 1, 'a': {'n': 'Happylink'}, 'p': 'root'}}
+        self.counter = 0
+        self.listings = 0
+        self.fail_uploads = 0
+
+    def login(self, email, password):
+        return self
+
+    def get_files(self):
+        self.listings += 1
+        return dict(self.nodes)
+
+    def create_folder(self, name):
+        self.counter += 1
+        handle = f"F{self.counter + 1}"
+        self.nodes[handle] = {'t': 1, 'a': {'n': name}, 'p': 'root'}
+        return [{'f': [{'h': handle}]}]
+
+    def upload(self, path, dest, dest_filename=None):
+        if self.fail_uploads:
+            self.fail_uploads -= 1
+            raise OSError('сеть')
+        self.counter += 1
+        node = {'h': f"N{self.counter}", 't': 0, 'a': {'n': dest_filename}, 'p': dest}
+        self.nodes[node['h']] = node
+        return {'f': [node]}
+
+    def destroy(self, handle):
+        self.nodes.pop(handle)
+
+    def names(self):
+        return sorted(node['a']['n'] for node in self.nodes.values() if node['t'] == 0)
+
+
+class MegaBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.account = FakeMega()
+        self.addCleanup(sys.modules.pop, 'mega', None)
+        sys.modules['mega'] = types.SimpleNamespace(Mega=lambda: self.account)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # Handle папки уже в кэше — как при втором и следующих запусках бэкапа
+        self.cache_path = os.path.join(tmp_dir.name, 'mega_cache.json')
+        with open(self.cache_path, 'w') as f:
+            json.dump({'e/Happylink': 'F1'}, f)
+
+    def backend(self):
+        return BackupRemote.open_backend('mega:Happylink', 'e', 'p', self.cache_path)
+
+    def test_put_same_name_with_cached_folder(self):
+        backend = self.backend()
+        backend.put('site/index', b'1')
+        backend.put('site/index', b'2')
+        self.assertEqual(self.account.names(), ['site~index'])
+        self.assertEqual(self.account.listings, 0)
+
+    def test_put_replaces_existing_after_listing(self):
+        self.backend().put('config', b'1')
+        backend = self.backend()
+        self.assertTrue(backend.exists('config'))
+        backend.put('config', b'2')
+        self.assertEqual(self.account.names(), ['config'])
+
+    def test_failed_put_keeps_old_file(self):
+        backend = self.backend()
+        backend.put('config', b'1')
+        self.account.fail_uploads = 2
+        with self.assertRaises(OSError):
+            backend.put('config', b'2')
+        self.assertEqual(self.account.names(), ['config'])
+        self.assertEqual(backend.list(), ['config'])
+
+
+if __name__ == '__main__':
+    unittest.main()